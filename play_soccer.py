@@ -1,12 +1,13 @@
 import pygame
-import torch
 import numpy as np
 import argparse
 import sys
 import os
+import time
+import threading
 import Box2D
-from torch.distributions.categorical import Categorical
 from ppo.environments.soccer import Soccer, UP, DOWN, LEFT, RIGHT, UP_LEFT, UP_RIGHT, DOWN_LEFT, DOWN_RIGHT, NO_OP, FPS
+from ppo.environments.soccer_actors import get_actor_backend, load_actor, sample_actions
 from pathlib import Path
 
 UP, DOWN = DOWN, UP
@@ -20,6 +21,9 @@ UP_RIGHT, DOWN_RIGHT = DOWN_RIGHT, UP_RIGHT
 # Constants
 KEY_REPEAT_DELAY = 100  # ms
 KEY_REPEAT_INTERVAL = 50  # ms
+LATENCY_REPORT_INTERVAL = 5 * FPS  # forward passes between inference latency reports
+DISPLAY_FPS = 60  # frames drawn per second, independent of the FPS simulation steps
+MAX_FRAME_TIME = 0.25  # seconds, longer stalls are not caught up on
 
 # Player control mappings (just the main direction keys)
 PLAYER_CONTROLS = {
@@ -57,36 +61,117 @@ PLAYER_DESCRIPTIONS = {
     3: "Blue Team - Right (Numpad 8/4/5/6 for movement, press two keys for diagonal movement)"
 }
 
-def load_actor_model(model_path):
-    """Load the actor model from the given path"""
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+def load_actor_model(model_path, backend="auto"):
+    """Load the actor model from the given path
+
+    backend is "torch" for .pth files, "onnx" for .onnx files or "auto" to choose by the file extension.
+    """
+    backend = get_actor_backend(model_path, backend)
     try:
-        # Set weights_only=False to load the entire model (compatible with models saved using torch.save(model))
-        actor = torch.load(model_path, map_location=device, weights_only=False)
-        actor.eval()
-        print(f"Successfully loaded model from {model_path}")
+        actor = load_actor(model_path, backend)
+        print(f"Successfully loaded model from {model_path} ({backend})")
         return actor
     except Exception as e:
         print(f"Error loading model: {e}")
-        print("\nTry running with an older version of PyTorch or modify the model saving/loading mechanism.")
+        if backend == "torch":
+            print("\nTry running with an older version of PyTorch or modify the model saving/loading mechanism.")
         sys.exit(1)
 
-def get_ai_action(actor, observation):
-    """Get the AI action given the observation"""
-    with torch.inference_mode():
-        observation_tensor = torch.tensor(observation, dtype=torch.float32).unsqueeze(0)
-        logits = actor(observation_tensor)
-        dist = Categorical(logits=logits)
-        action = dist.sample().item()
-    return action
+def get_ai_actions(actor, observations, player_indices, rng):
+    """Sample the actions of all AI players from a single batched forward pass"""
+    return sample_actions(actor(np.ascontiguousarray(observations[player_indices], dtype=np.float32)), rng)
+
+def report_latency(latencies):
+    """Print mean, 95th percentile and maximum of the per-frame inference times in seconds"""
+    latencies_ms = 1000 * np.array(latencies)
+    print(f"AI inference over {len(latencies_ms)} frames: mean {latencies_ms.mean():.3f} ms, "
+          f"p95 {np.percentile(latencies_ms, 95):.3f} ms, max {latencies_ms.max():.3f} ms")
+
+class AsyncInference:
+    """Samples the actions of the AI players on a worker thread
+
+    submit hands over the newest observations and returns at once, get_actions returns the
+    actions of the newest finished forward pass, so the game loop never waits for the actor.
+    Observations submitted while the worker is busy replace each other, only the newest is used.
+    An exception of the worker ends it and is raised again by the next get_actions or close.
+    """
+    def __init__(self, actor, player_indices, rng=None):
+        self.actor = actor
+        self.player_indices = player_indices
+        self.rng = rng if rng is not None else np.random.default_rng()
+        self.actions = np.full(len(player_indices), NO_OP)
+        self.latencies = []
+        self.pending = None
+        self.error = None
+        self.running = True
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, observations):
+        with self.condition:
+            self.pending = observations.copy()
+            self.condition.notify()
+
+    def get_actions(self):
+        self.raise_error()
+        return self.actions
 
-def player_control(env, human_players, actor_model, mode):
-    """Main game loop with player control"""
-    # creen = pygame.display.set_mode((600, 800))
-    # clock = pygame.time.Clock()
+    def raise_error(self):
+        """Raise the exception that ended the worker thread on the calling thread, once"""
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("AI inference failed") from error
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and self.pending is None:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                observations, self.pending = self.pending, None
+            inference_start = time.perf_counter()
+            try:
+                self.actions = get_ai_actions(self.actor, observations, self.player_indices, self.rng)
+            except Exception as e:
+                self.error = e
+                return
+            self.latencies.append(time.perf_counter() - inference_start)
+            if len(self.latencies) == LATENCY_REPORT_INTERVAL:
+                report_latency(self.latencies)
+                self.latencies = []
+
+    def close(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join()
+        if self.latencies:
+            report_latency(self.latencies)
+        self.raise_error()
+
+def player_control(env, human_players, actor_model, mode, display_fps=DISPLAY_FPS):
+    """Main game loop with player control
+
+    The simulation advances in fixed steps of 1/FPS seconds of game time, however long drawing
+    or inference take. Frames are drawn at display_fps, interpolating the bodies between the
+    last two steps, and the AI players are evaluated asynchronously by an AsyncInference.
+    """
     running = True
     observations, _ = env.reset()
     score = [0, 0]
+    ai_players = [idx for idx in range(env.num_agents) if idx not in human_players]
+    inference = AsyncInference(actor_model, ai_players) if ai_players else None
+    if inference is not None:
+        inference.submit(observations)
+    
+    # Fixed timestep state: unsimulated game time and the body states of the last two steps
+    step_time = 1.0 / FPS
+    accumulator = 0.0
+    previous_states = env.get_body_states().copy()
+    current_states = previous_states.copy()
+    clock = pygame.time.Clock()
     
     # Set window title
     if mode == "1p":
@@ -115,7 +200,12 @@ def player_control(env, human_players, actor_model, mode):
     print("\nPress ESC to quit")
     print("==========================\n")
     
+    last_time = time.perf_counter()
     while running:
+        now = time.perf_counter()
+        accumulator += min(now - last_time, MAX_FRAME_TIME)
+        last_time = now
+        
         # Initialize actions as NO_OP
         actions = [NO_OP] * env.num_agents
         
@@ -214,34 +304,42 @@ def player_control(env, human_players, actor_model, mode):
                         
             actions[player_idx] = action
         
-        # Get AI actions for non-human players
-        for player_idx in range(env.num_agents):
-            if player_idx not in human_players:
-                actions[player_idx] = get_ai_action(actor_model, observations[player_idx])
-        
-        # Take a step in the environment
-        observations, _, terminated, truncated, _ = env.step(actions)
-        
-        # Render the environment - explicitly use human mode
-        # screen.fill("purple")
-        env.render(mode="human")
-        
-        # Ensure the display is updated
-        # pygame.display.flip()
-        
-        # Update score display
-        if env.score != score:
-            score = env.score.copy()
-            print(f"Score: Red {score[0]} - {score[1]} Blue")
-        
-        # Reset if the episode is done
-        if terminated or truncated:
-            observations, _ = env.reset()
-            print("New game!")
+        # Advance the simulation by as many fixed steps as game time has passed
+        while running and accumulator >= step_time:
+            # Get AI actions for non-human players, from the newest finished forward pass
+            if inference is not None:
+                for player_idx, action in zip(ai_players, inference.get_actions().tolist()):
+                    actions[player_idx] = action
+            
+            # Take a step in the environment
+            observations, _, terminated, truncated, _ = env.step(actions)
+            previous_states[:] = current_states
+            current_states[:] = env.body_states
+            
+            # Update score display
+            if env.score != score:
+                score = env.score.copy()
+                print(f"Score: Red {score[0]} - {score[1]} Blue")
+            
+            # Reset if the episode is done
+            if terminated or truncated:
+                observations, _ = env.reset()
+                # No interpolation across the reset
+                previous_states[:] = current_states[:] = env.body_states
+                print("New game!")
+            
+            if inference is not None:
+                inference.submit(observations)
+            accumulator -= step_time
         
-        # Cap the frame rate
-        # clock.tick(FPS)
+        # Draw at display rate, interpolated between the last two simulation steps
+        alpha = accumulator / step_time
+        env.draw(previous_states + (current_states - previous_states) * alpha)
+        pygame.display.flip()
+        clock.tick(display_fps)
     
+    if inference is not None:
+        inference.close()
     env.close()
     pygame.quit()
 
@@ -252,7 +350,11 @@ def main():
     parser.add_argument("--player", type=int, default=0, choices=[0, 1, 2, 3], 
                         help="Which player to control in 1p mode (0=red left, 1=red right, 2=blue left, 3=blue right)")
     parser.add_argument("--model", type=str, default="models/actor.pth", 
-                        help="Path to the actor model file")
+                        help="Path to the actor model file (.pth, or .onnx to run it with onnxruntime)")
+    parser.add_argument("--backend", type=str, default="auto", choices=["auto", "onnx", "torch"],
+                        help="Inference backend: onnx (onnxruntime on the CPU), torch, or auto to choose by the model file extension")
+    parser.add_argument("--display-fps", type=int, default=DISPLAY_FPS,
+                        help="Frames drawn per second, the simulation always runs at FPS steps per second")
     args = parser.parse_args()
     
     # Check if model exists
@@ -298,10 +400,10 @@ def main():
             human_players = [0, args.player]  # Second player is red left
     
     # Load the actor model
-    actor_model = load_actor_model(model_path)
+    actor_model = load_actor_model(model_path, args.backend)
     
     # Start the game
-    player_control(env, human_players, actor_model, args.mode)
+    player_control(env, human_players, actor_model, args.mode, args.display_fps)
 
 if __name__ == "__main__":
     main()
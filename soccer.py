@@ -1,9 +1,9 @@
 # Box 2D pygame Soccer Environment for Gymnasium
 
-import pygame
 import Box2D
 from Box2D.b2 import (world, polygonShape, circleShape, staticBody, dynamicBody)
 import os
+import time
 import gymnasium as gym
 import numpy as np
 from gymnasium.spaces import Box, MultiDiscrete
@@ -20,10 +20,6 @@ except pygame.error:
     os.environ['SDL_VIDEODRIVER'] = 'dummy'
     pygame.display.init()"""
 
-from ppo.environments.utils import piecewise_function
-
-# Pygame initialization
-pygame.init()
 
 # Constants
 SCREEN_WIDTH = 600
@@ -66,6 +62,9 @@ GREEN = (0, 255, 0)
 YELLOW = (255, 255, 0)
 PURPLE = (128, 0, 128)
 
+# Stands in for "nobody" in toucher histories and arrays
+NO_TOUCHER = -1
+
 # Actions
 UP = 0
 UP_RIGHT = 1
@@ -97,32 +96,188 @@ DEFAULT_REWARD_SPECIFICATION = {
     "base_negative": -0.15,
 }
 
+# Box2D solver settings selectable with the physics_profile of Soccer. "fast" trades accuracy for
+# speed in bulk training, "precise" spends more solver iterations and never lets bodies sleep for evaluation
+PHYSICS_PROFILES = {
+    "fast": {"velocity_iterations": 3, "position_iterations": 1, "sleep": True},
+    "default": {"velocity_iterations": 6, "position_iterations": 2, "sleep": True},
+    "precise": {"velocity_iterations": 10, "position_iterations": 4, "sleep": False},
+}
+
+def derive_seed(root_seed, env_index):
+    """Seed of the env with global index env_index, derived from root_seed with a SeedSequence
+
+    The seeds of different envs are statistically independent and do not depend on how the
+    envs are split over vector envs or worker processes.
+    """
+    return int(np.random.SeedSequence(root_seed, spawn_key=(env_index,)).generate_state(1)[0])
+
+class HistoryBuffer:
+    """Preallocated ring buffer holding the last depth entries of a per-step history
+
+    Like a list, history[0] is the oldest and history[-1] the newest entry and len(history)
+    grows up to depth. Entries are written into the buffer, appending never allocates.
+    """
+    def __init__(self, depth, item_shape=(), dtype=np.float64, fill_value=0):
+        self.depth = depth
+        self.data = np.full((depth,) + tuple(item_shape), fill_value, dtype=dtype)
+        self.count = 0 # entries appended since the last clear
+
+    def __len__(self):
+        return min(self.count, self.depth)
+
+    def clear(self):
+        self.count = 0
+
+    def append(self, value):
+        self.data[self.count % self.depth] = value
+        self.count += 1
+
+    def next_slot(self):
+        """Append an entry and return it as a view to be written in place, for array entries"""
+        slot = self.data[self.count % self.depth]
+        self.count += 1
+        return slot
+
+    def __getitem__(self, index):
+        length = len(self)
+        if index < 0:
+            index += length
+        if not 0 <= index < length:
+            raise IndexError("history index out of range")
+        return self.data[(self.count - length + index) % self.depth]
+
+    def to_array(self):
+        """Copy of the entries ordered from oldest to newest"""
+        return self.data[np.arange(self.count - len(self), self.count) % self.depth]
+
+def get_default_positions(team_size):
+    """Default spawn position of every player for two teams of team_size players
+
+    Team 0 lines up in the bottom half and team 1 mirrored in the top half, in at most two
+    rows per team, each ordered from left to right and starting with the row nearest the own goal.
+    """
+    row_length = max(3, -(-team_size // 2))
+    num_rows = -(-team_size // row_length)
+    row_sizes = [team_size // num_rows + (row < team_size % num_rows) for row in range(num_rows)]
+    positions = []
+    for team in range(2):
+        for row, row_size in enumerate(row_sizes):
+            y = (1 + row) * GAME_HEIGHT / 6 if team == 0 else (5 - row) * GAME_HEIGHT / 6
+            positions.extend(((2 * k + 1) * GAME_WIDTH / (2 * row_size), y) for k in range(row_size))
+    return positions
+
+class ObservationTables:
+    """Precomputed per-agent lookup tables that turn the gathered body states into local observations
+
+    Body states are stored as rows [x, y, vx, vy], one per player followed by the ball.
+    For every agent the tables hold the order in which bodies appear in its observation
+    (own, teammates, enemies, ball), the sign flips and offsets of its local frame and
+    the normalization scale of each column. Players spawning in the right half of the field
+    mirror the x-axis and the top team mirrors the y-axis, see get_default_positions.
+    """
+    def __init__(self, num_agents, team_size):
+        self.num_agents = num_agents
+        self.team_size = team_size
+        self.num_bodies = num_agents + 1
+        self.observation_size = self.num_bodies * 4
+
+        self.body_order = np.zeros((num_agents, self.num_bodies), dtype=np.intp)
+        self.sign = np.ones((num_agents, 1, 4))
+        self.offset = np.zeros((num_agents, 1, 2))
+        default_positions = get_default_positions(team_size)
+        for i in range(num_agents):
+            team_start = (i // team_size) * team_size
+            team_end = team_start + team_size
+            teammate_indices = list(range(team_start, i)) + list(range(i + 1, team_end))
+            enemy_indices = list(range(0, team_start)) + list(range(team_end, num_agents))
+            self.body_order[i] = [i] + teammate_indices + enemy_indices + [num_agents]
+            # Right players mirror the x-axis, the top team mirrors the y-axis
+            if default_positions[i][0] > GAME_WIDTH / 2:
+                self.sign[i, 0, [0, 2]] = -1.0
+                self.offset[i, 0, 0] = GAME_WIDTH
+            if i // team_size == 1:
+                self.sign[i, 0, [1, 3]] = -1.0
+                self.offset[i, 0, 1] = GAME_HEIGHT
+        self.scale = np.array([GAME_WIDTH, GAME_HEIGHT, REALISTIC_MAXIMUM_VELOCITY, REALISTIC_MAXIMUM_VELOCITY], dtype=np.float64)
+
+    def compute(self, body_states, out=None):
+        """Compute normalized local observations from body states of shape (..., num_bodies, 4)
+
+        Returns a float32 array of shape (..., num_agents, observation_size). Leading
+        dimensions are kept, so a batch of environments can be processed at once.
+        """
+        local = np.take(body_states, self.body_order, axis=-2)
+        local *= self.sign
+        local[..., :2] += self.offset
+        local /= self.scale
+        local = local.reshape(local.shape[:-3] + (self.num_agents, self.observation_size))
+        if out is None:
+            return local.astype(np.float32)
+        out[...] = local
+        return out
+
+# Actions ordered by the angle of their local direction, in steps of 45 degrees starting at RIGHT
+ACTIONS_BY_ANGLE = np.array([RIGHT, UP_RIGHT, UP, UP_LEFT, LEFT, DOWN_LEFT, DOWN, DOWN_RIGHT])
+
+def chase_ball_policy(observations, rng, epsilon=0.2):
+    """Scripted policy moving every agent straight towards the ball, with epsilon random actions
+
+    Works on observations of shape (..., num_agents, observation_size) and is used to get
+    comparable rollouts in benchmarks and backend comparisons.
+    """
+    own_position = observations[..., 0:2]
+    ball_position = observations[..., -4:-2]
+    direction = (ball_position - own_position) * np.array([GAME_WIDTH, GAME_HEIGHT])
+    angle = np.arctan2(direction[..., 1], direction[..., 0])
+    actions = ACTIONS_BY_ANGLE[np.round(angle / (np.pi / 4)).astype(np.int64) % 8]
+    random_actions = rng.integers(0, 9, size=actions.shape)
+    return np.where(rng.random(actions.shape) < epsilon, random_actions, actions)
+
 class SoccerContactListener(Box2D.b2ContactListener):
+    """Registers ball touches in BeginContact, used with touch_detection="callback"
+
+    Box2D calls all four methods for every contact of the world, including player-wall and
+    player-player contacts, so the default touch_detection="scan" does without a listener.
+    """
     def __init__(self, env):
         Box2D.b2ContactListener.__init__(self)
         self.env = env
+        # Players that touched the ball in the world a state was restored from, until the next step
+        self.continued_contacts = None
     
-    def BeginContact(self, contact):
-        # Check if contact involves the ball
+    def get_ball_and_player(self, contact):
+        """The ball and player body of a ball-player contact, None for any other contact"""
         body_a = contact.fixtureA.body
         body_b = contact.fixtureB.body
 
         # Determine which body is the ball and which is the player
         if body_a.userData is None or body_b.userData is None:
-            return
+            return None
         if body_a.userData.get('type') == 'ball' and 'team' in body_b.userData:
-            ball, player = body_a, body_b
-        elif body_b.userData.get('type') == 'ball' and 'team' in body_a.userData:
-            ball, player = body_b, body_a
-        else:
+            return body_a, body_b
+        if body_b.userData.get('type') == 'ball' and 'team' in body_a.userData:
+            return body_b, body_a
+        return None
+
+    def BeginContact(self, contact):
+        # Check if contact involves the ball
+        bodies = self.get_ball_and_player(contact)
+        if bodies is None:
+            return
+        ball, player = bodies
+        agent = player.userData['id']
+        self.env.ball_contacts[agent] = True
+        # The restored world begins the contacts of the source again
+        if self.continued_contacts is not None and self.continued_contacts[agent]:
             return
-        # body_a is ball, body_b is player
         self.env.ball_touched[player.userData['team']] = True
-        self.env.ball_toucher = player.userData['id']
-        self.env.ball_touch_coordinate = ball.position
+        self.env.ball_toucher = agent
 
     def EndContact(self, contact):
-        pass
+        bodies = self.get_ball_and_player(contact)
+        if bodies is not None:
+            self.env.ball_contacts[bodies[1].userData['id']] = False
     
     def PreSolve(self, contact, oldManifold):
         pass
@@ -131,15 +286,18 @@ class SoccerContactListener(Box2D.b2ContactListener):
         pass
 
 class Soccer(gym.Env):
-    metadata = {"render_modes": ["human", "rgb_array"], "render_fps": FPS}
+    metadata = {"render_modes": ["human", "rgb_array", "rgb_array_headless"], "render_fps": FPS}
     
-    def __init__(self, render_mode=None, video_log_freq=100, env_id="Soccer-v0", seed=1, reward_specification=DEFAULT_REWARD_SPECIFICATION):
+    def __init__(self, render_mode=None, video_log_freq=100, env_id="Soccer-v0", seed=1, reward_specification=DEFAULT_REWARD_SPECIFICATION,
+                 physics_backend="box2d", numpy_physics=None, numpy_physics_index=0, reward_breakdown=False,
+                 episode_statistics=True, render_scale=1.0, record_video=False, trajectory_dir=None, history_length=3,
+                 team_size=2, deterministic=False, touch_detection="scan", action_repeat=1, physics_substeps=1,
+                 physics_profile="default"):
         super().__init__()
-        print(f"reward_specification: {reward_specification}")
         
         # Environment parameters
-        self.num_agents = 4
-        self.team_size = 2
+        self.team_size = team_size # players per team, the two teams play team_size vs team_size
+        self.num_agents = 2 * team_size
         self.num_teams = self.num_agents // self.team_size
         self.max_steps = 600
         self.video_log_freq = video_log_freq
@@ -147,60 +305,123 @@ class Soccer(gym.Env):
         self.env_id = env_id
         self.seed = seed
         self.reward_specification = reward_specification
+        self.physics_backend = physics_backend
+        self.reward_breakdown = reward_breakdown # add the weighted reward of every term to info["reward_terms"]
+        self.episode_statistics = episode_statistics # add per-term episode returns to info["episode"] at episode end
+        self.history_length = history_length # steps kept in the toucher, action and local position histories
+        # Seed the first reset with seed, never let bodies sleep and rebuild the world on every reset,
+        # so a trajectory only depends on the seed and the actions, see reset
+        self.deterministic = deterministic
+        # "scan" reads the ball touches from the contact list of the ball after every Box2D step,
+        # "callback" registers them in a SoccerContactListener, see register_box2d_touches
+        if touch_detection not in ("scan", "callback"):
+            raise ValueError(f"Unknown touch detection: {touch_detection}")
+        self.touch_detection = touch_detection
+        self.action_repeat = action_repeat # frames every step repeats its actions for, rewards are summed
+        self.physics_substeps = physics_substeps # physics steps of 1 / (FPS * physics_substeps) seconds per frame
+        # Solver iterations and sleeping of the Box2D world, see PHYSICS_PROFILES. The numpy backend ignores it
+        if physics_profile not in PHYSICS_PROFILES:
+            raise ValueError(f"Unknown physics profile: {physics_profile}")
+        self.physics_profile = physics_profile
+        self.velocity_iterations = PHYSICS_PROFILES[physics_profile]["velocity_iterations"]
+        self.position_iterations = PHYSICS_PROFILES[physics_profile]["position_iterations"]
+
+        # Lookup tables and buffer for the vectorized observation computation
+        self.observation_tables = ObservationTables(self.num_agents, self.team_size)
 
         # Observation and action spaces
         # Each agent observes: 
         # - own position (2) and velocity (2)
-        # - teammate position (2) and velocity (2)
-        # - enemy positions (2*2) and velocities (2*2)
+        # - teammate positions (2*(team_size-1)) and velocities (2*(team_size-1))
+        # - enemy positions (2*team_size) and velocities (2*team_size)
         # - ball position (2) and velocity (2)
-        # = 20 values total
+        # = 4 * (num_agents + 1) values total, 20 for 2 vs 2
+        observation_size = self.observation_tables.observation_size
         self.observation_space = Box(
             low=np.array([[0.0 if i % 4 <= 1 else -MAXIMUM_VELOCITY 
-                          for i in range(20)] for _ in range(self.num_agents)]),
+                          for i in range(observation_size)] for _ in range(self.num_agents)]),
             high=np.array([[0.0 if i % 4 <= 1 else MAXIMUM_VELOCITY 
-                           for i in range(20)] for _ in range(self.num_agents)]),
+                           for i in range(observation_size)] for _ in range(self.num_agents)]),
             dtype=np.float32
         )
         
         # 9 actions for each agent: UP, UP_RIGHT, RIGHT, DOWN_RIGHT, DOWN, DOWN_LEFT, LEFT, UP_LEFT, NO_OP
-        self.action_space = MultiDiscrete([9, 9, 9, 9])
+        self.action_space = MultiDiscrete([9] * self.num_agents)
+        self.body_states = np.zeros((self.num_agents + 1, 4))
+
+        # Global velocity of every (agent, action) pair, so actions are decoded with one lookup
+        self.action_velocities = self.build_action_velocities()
+        self.agent_indices = np.arange(self.num_agents)
+
+        # Ring buffers of the last history_length steps, cleared by reset
+        self.ball_toucher_history = HistoryBuffer(history_length, dtype=np.int64, fill_value=NO_TOUCHER) # agents that touched the ball, noone is NO_TOUCHER
+        self.action_history = HistoryBuffer(history_length, (self.num_agents,), dtype=np.int64)
+        self.local_position_history = HistoryBuffer(history_length, (self.num_agents, 2))
+
+        # Reward specification compiled into a list of active terms
+        self.compile_reward_specification()
         
         # Initialize pygame if rendering is needed
-        if self.render_mode is not None:
+        if self.render_mode == "rgb_array_headless":
+            # Rasterize into NumPy buffers, no pygame display needed
+            from ppo.environments.soccer_renderer import ArrayRenderer
+            self.renderer = ArrayRenderer(render_scale, self.num_agents, self.team_size)
+        elif self.render_mode is not None:
+            # pygame is only imported and initialized for the pygame render modes
+            import pygame
+            pygame.init()
             self.screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
             pygame.display.set_caption("Box2D Soccer")
             self.clock = pygame.time.Clock()
         
-        # Initialize Box2D world
-        self.world = world(gravity=(0, 0), doSleep=True)
-        
-        # Set up contact listener
-        self.contact_listener = SoccerContactListener(self)
-        self.world.contactListener = self.contact_listener
+        if physics_backend == "box2d":
+            # Initialize Box2D world with its contact listener
+            self.create_world()
+        elif physics_backend == "numpy":
+            # Batched NumPy physics, possibly shared with other envs (see SoccerVecEnv)
+            from ppo.environments.soccer_numpy_physics import NumpyPhysics
+            self.physics = numpy_physics if numpy_physics is not None else NumpyPhysics(1, self.num_agents)
+            self.physics_index = numpy_physics_index
+        else:
+            raise ValueError(f"Unknown physics backend: {physics_backend}")
         
-        # For video recording
-        self.frames = []
+        # Bodies are created by the first reset and reused afterwards
+        self.players = None
+        self.physics_parameters = None
+
+        # For video recording, every video_log_freq-th episode is streamed to disk
+        self.video_recorder = None
+        if record_video:
+            from ppo.environments.soccer_renderer import ArrayRenderer
+            from ppo.environments.soccer_video import VideoRecorder
+            self.video_renderer = ArrayRenderer(render_scale, self.num_agents, self.team_size)
+            self.video_recorder = VideoRecorder(fps=FPS)
+            current_datetime = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+            self.video_dir = Path(__file__).parent / "videos" / f"{env_id}__MAPPOSoccer__seed{seed}__{current_datetime}"
+
+        # For trajectory recording, every reset and step is appended to binary files in trajectory_dir
+        self.trajectory_writer = None
+        if trajectory_dir is not None:
+            from ppo.environments.soccer_trajectory import TrajectoryWriter
+            self.trajectory_writer = TrajectoryWriter(
+                trajectory_dir, self.num_agents, self.team_size,
+                metadata={"env_id": env_id, "seed": seed, "reward_specification": reward_specification,
+                          "history_length": history_length},
+            )
         self.step_count = 0
         self.episode_count = 0
         
         # Reset to initialize everything
-        self.reset()
+        self.reset(seed=seed if deterministic else None)
 
     def add_to_ball_toucher_history(self, agent_idx):
-        self.ball_toucher_history.append(agent_idx)
-        if len(self.ball_toucher_history) > 3:
-            self.ball_toucher_history.pop(0)
+        self.ball_toucher_history.append(NO_TOUCHER if agent_idx is None else agent_idx)
 
     def add_to_action_history(self, actions):
         self.action_history.append(actions)
-        if len(self.action_history) > 3:
-            self.action_history.pop(0)
 
     def add_to_local_position_history(self, local_position):
         self.local_position_history.append(local_position)
-        if len(self.local_position_history) > 3:
-            self.local_position_history.pop(0)
     
     def create_boundaries(self):
         # Create walls and goals
@@ -238,23 +459,14 @@ class Soccer(gym.Env):
             shapes=polygonShape(box=(wall_width/2, WALL_THICKNESS)),
         )
     
-    def create_players(self):
-        # Create 4 players (2 per team)
-        # Team 1: Players 0 and 1 (RED team - bottom)
-        # Team 2: Players 2 and 3 (BLUE team - top)
-        
-        self.players = []
-        
-        # Default positions
-        default_positions = [
-            (GAME_WIDTH/4, GAME_HEIGHT/6),         # Team 1 - Player 0 (bottom left)
-            (3*GAME_WIDTH/4, GAME_HEIGHT/6),       # Team 1 - Player 1 (bottom right)
-            (GAME_WIDTH/4, 5*GAME_HEIGHT/6),       # Team 2 - Player 2 (top left)
-            (3*GAME_WIDTH/4, 5*GAME_HEIGHT/6),     # Team 2 - Player 3 (top right)
-        ]
+    def get_spawn_positions(self):
+        """Draw a random spawn position around the default position of every player"""
+        # Default positions, for 2 vs 2 bottom left, bottom right, top left and top right
+        default_positions = get_default_positions(self.team_size)
         
+        spawn_positions = []
         # Add randomness to positions
-        for i, (x, y) in enumerate(default_positions):
+        for x, y in default_positions:
             # Add random offset within SPAWNING_RADIUS
             random_x = x + self.np_random.uniform(-SPAWNING_RADIUS, SPAWNING_RADIUS)
             random_y = y + self.np_random.uniform(-SPAWNING_RADIUS, SPAWNING_RADIUS)
@@ -262,20 +474,83 @@ class Soccer(gym.Env):
             # Ensure players stay within bounds
             random_x = max(PLAYER_SIZE, min(GAME_WIDTH - PLAYER_SIZE, random_x))
             random_y = max(PLAYER_SIZE, min(GAME_HEIGHT - PLAYER_SIZE, random_y))
-            
+            spawn_positions.append((random_x, random_y))
+        return spawn_positions
+
+    def create_players(self):
+        # Create team_size players per team
+        # Team 1: Players 0 to team_size - 1 (RED team - bottom)
+        # Team 2: Players team_size to num_agents - 1 (BLUE team - top)
+        
+        self.players = []
+        
+        for i, (random_x, random_y) in enumerate(self.get_spawn_positions()):
             # Create player
-            player = self.world.CreateDynamicBody(
-                position=(random_x, random_y),
-                fixtures=Box2D.b2FixtureDef(
-                    shape=polygonShape(box=(PLAYER_SIZE/2, PLAYER_SIZE/2)),
-                    density=PLAYER_DENSITY,
-                    friction=PLAYER_FRICTION,
-                ),
-            )
+            if self.physics_backend == "numpy":
+                from ppo.environments.soccer_numpy_physics import NumpyBody
+                player = NumpyBody(self.physics.player_position[self.physics_index], self.physics.player_velocity[self.physics_index], i)
+                player.position = (random_x, random_y)
+            else:
+                player = self.world.CreateDynamicBody(
+                    position=(random_x, random_y),
+                    fixtures=Box2D.b2FixtureDef(
+                        shape=polygonShape(box=(PLAYER_SIZE/2, PLAYER_SIZE/2)),
+                        density=PLAYER_DENSITY,
+                        friction=PLAYER_FRICTION,
+                    ),
+                )
             player.userData = {"team": i // self.team_size, "id": i}
             self.players.append(player)
-    
+
+    def reposition_players(self):
+        """Move the existing players to new spawn positions and stop them, instead of recreating them"""
+        for player, (random_x, random_y) in zip(self.players, self.get_spawn_positions()):
+            if self.physics_backend == "numpy":
+                player.position = (random_x, random_y)
+                player.linearVelocity = (0, 0)
+                continue
+            player.transform = ((random_x, random_y), 0.0)
+            player.linearVelocity = (0, 0)
+            player.angularVelocity = 0
+            player.awake = True
+
+    def get_physics_parameters(self):
+        """Parameters the bodies were built with, a change requires rebuilding the world"""
+        return (GAME_WIDTH, GAME_HEIGHT, GOAL_WIDTH, WALL_THICKNESS, PLAYER_SIZE, PLAYER_DENSITY, PLAYER_FRICTION,
+                BALL_RADIUS, BALL_DENSITY, BALL_FRICTION, BALL_RESTITUTION)
+
+    def create_world(self):
+        """Create an empty Box2D world, with the contact listener of this env if touches are detected by callback"""
+        self.world = world(gravity=(0, 0), doSleep=PHYSICS_PROFILES[self.physics_profile]["sleep"] and not self.deterministic)
+        self.contact_listener = None
+        if self.touch_detection == "callback":
+            self.contact_listener = SoccerContactListener(self)
+            self.world.contactListener = self.contact_listener
+
+    def build_world(self):
+        """Destroy all bodies and create the walls, players and ball from scratch"""
+        # Clear the world
+        if self.physics_backend == "box2d":
+            for body in self.world.bodies:
+                self.world.DestroyBody(body)
+        
+        # Create boundaries, players, and ball
+        if self.physics_backend == "box2d":
+            self.create_boundaries()
+        self.create_players()
+        self.create_ball()
+        self.bodies = self.players + [self.ball]
+        self.physics_parameters = self.get_physics_parameters()
+        # New bodies have no contacts yet
+        self.ball_contacts = [False] * self.num_agents
+
     def create_ball(self):
+        if self.physics_backend == "numpy":
+            from ppo.environments.soccer_numpy_physics import NumpyBody
+            self.ball = NumpyBody(self.physics.ball_position, self.physics.ball_velocity, self.physics_index)
+            self.ball.userData = {"type": "ball"}
+            self.reset_ball()
+            return
         self.ball = self.world.CreateDynamicBody(
             position=(GAME_WIDTH/2, GAME_HEIGHT/2),
             fixtures=Box2D.b2FixtureDef(
@@ -296,7 +571,7 @@ class Soccer(gym.Env):
         self.ball.angularVelocity = 0
         self.ball_touched = [False for _ in range(self.num_teams)]
         self.last_ball_toucher = None # last agent that touched the ball, isnt reset when noone touches it
-        self.ball_toucher_history = [] # history of agents that touched the ball, noone is None
+        self.ball_toucher_history.clear()
         self.ball_toucher = None # last agent that touched the ball, is reset when noone touches it
         self.last_ball_touch_coordinate = None # last coordinates of the ball, is not reset when noone touches it
         self.ball_touch_coordinate = None # coordinates of the ball, is reset when noone touches it
@@ -310,12 +585,26 @@ class Soccer(gym.Env):
             self.last_ball_touch_coordinate = self.ball_touch_coordinate.copy()
         self.ball_touch_coordinate = None
         
+    def get_ball_touch_coordinate(self, position=None):
+        """The current ball position, or the given (x, y), as a touch coordinate
+
+        A live b2Vec2 with Box2D. The numpy backend keeps the float64 state, which
+        NumpyBody.position would round to float32, like the reward state of SoccerVecEnv.
+        """
+        if self.physics_backend == "numpy":
+            return self.physics.ball_position[self.physics_index].copy() if position is None else np.array(position, dtype=np.float64)
+        return self.ball.position if position is None else Box2D.b2Vec2(*position)
+
     def check_goal(self):
-        ball_pos = self.ball.position
-        if ball_pos.y < 0:  # Bottom goal (Team 2 scores)
+        if self.physics_backend == "numpy":
+            # The float64 state, NumpyBody.position rounds to float32 like Box2D
+            ball_y = self.physics.ball_position[self.physics_index, 1]
+        else:
+            ball_y = self.ball.position.y
+        if ball_y < 0:  # Bottom goal (Team 2 scores)
             self.score[1] += 1
             return 1  # Team 2 scored
-        elif ball_pos.y > GAME_HEIGHT:  # Top goal (Team 1 scores)
+        elif ball_y > GAME_HEIGHT:  # Top goal (Team 1 scores)
             self.score[0] += 1
             return 0  # Team 1 scored
         return -1  # No goal
@@ -327,37 +616,15 @@ class Soccer(gym.Env):
         # Team 2 (top): y-axis points down
         # Left players: x-axis points right
         # Right players: x-axis points left
-        
-        x, y = pos
-        # Team 1 (bottom)
-        if agent_id == 0:  # Bottom left
-            new_pos = np.array([x, y])
-        elif agent_id == 1:  # Bottom right
-            new_pos = np.array([GAME_WIDTH - x, y])
-        # Team 2 (top)
-        elif agent_id == 2:  # Top left
-            new_pos = np.array([x, GAME_HEIGHT - y])
-        elif agent_id == 3:  # Top right
-            new_pos = np.array([GAME_WIDTH - x, GAME_HEIGHT - y])
+        tables = self.observation_tables
+        new_pos = np.asarray(pos, dtype=np.float64) * tables.sign[agent_id, 0, :2] + tables.offset[agent_id, 0]
         if normalize:
-            new_pos[0] = new_pos[0] / GAME_WIDTH
-            new_pos[1] = new_pos[1] / GAME_HEIGHT
+            new_pos = new_pos / tables.scale[:2]
         return new_pos
     
     def get_local_velocity(self, vel, agent_id, normalize=False):
         """Convert global velocity to local velocity for the given agent"""
-        vx, vy = vel
-        
-        # Team 1 (bottom)
-        if agent_id == 0:  # Bottom left
-            new_vel = np.array([vx, vy])
-        elif agent_id == 1:  # Bottom right
-            new_vel = np.array([-vx, vy])
-        # Team 2 (top)
-        elif agent_id == 2:  # Top left
-            new_vel = np.array([vx, -vy])
-        elif agent_id == 3:  # Top right
-            new_vel = np.array([-vx, -vy])
+        new_vel = np.asarray(vel, dtype=np.float64) * self.observation_tables.sign[agent_id, 0, 2:]
         if normalize:
             new_vel = new_vel / REALISTIC_MAXIMUM_VELOCITY
         return new_vel
@@ -365,304 +632,54 @@ class Soccer(gym.Env):
     def get_global_velocity(self, vel, agent_id):
         return self.get_local_velocity(vel, agent_id) # works because function is s
 
-    def get_observations(self):
-        """Get observations for all agents"""
-        observations = []
-        
-        for i in range(self.num_agents):
-            agent_observation = []
-            team_index = i // self.team_size
-            team_start = team_index * self.team_size
-            team_end = (team_index + 1) * self.team_size
-            
-            # Get teammate and enemy indices
-            teammate_indices = list(range(team_start, i)) + list(range(i + 1, team_end))
-            enemy_indices = list(range(0, team_start)) + list(range(team_end, self.num_agents))
-            
-            # Add own position and velocity (local coordinates)
-            own_pos = self.get_local_position(
-                (self.players[i].position.x, self.players[i].position.y), 
-                i,
-                normalize=True
-            )
-            own_vel = self.get_local_velocity(
-                (self.players[i].linearVelocity.x, self.players[i].linearVelocity.y),
-                i,
-                normalize=True
-            )
-            agent_observation.extend(own_pos)
-            agent_observation.extend(own_vel)
-            
-            # Add teammate positions and velocities (local coordinates)
-            for j in teammate_indices:
-                teammate_pos = self.get_local_position(
-                    (self.players[j].position.x, self.players[j].position.y),
-                    i,
-                    normalize=True
-                )
-                teammate_vel = self.get_local_velocity(
-                    (self.players[j].linearVelocity.x, self.players[j].linearVelocity.y),
-                    i,
-                    normalize=True
-                )
-                agent_observation.extend(teammate_pos)
-                agent_observation.extend(teammate_vel)
-            
-            # Add enemy positions and velocities (local coordinates)
-            for j in enemy_indices:
-                enemy_pos = self.get_local_position(
-                    (self.players[j].position.x, self.players[j].position.y),
-                    i,
-                    normalize=True
-                )
-                enemy_vel = self.get_local_velocity(
-                    (self.players[j].linearVelocity.x, self.players[j].linearVelocity.y),
-                    i,
-                    normalize=True
-                )
-                agent_observation.extend(enemy_pos)
-                agent_observation.extend(enemy_vel)
-            
-            # Add ball position and velocity (local coordinates)
-            ball_pos = self.get_local_position(
-                (self.ball.position.x, self.ball.position.y),
-                i,
-                normalize=True
-            )
-            ball_vel = self.get_local_velocity(
-                (self.ball.linearVelocity.x, self.ball.linearVelocity.y),
-                i,
-                normalize=True
-            )
-            agent_observation.extend(ball_pos)
-            agent_observation.extend(ball_vel)
-            
-            # Add to observations
-            observations.append(np.array(agent_observation, dtype=np.float32))
-        
-        return np.array(observations, dtype=np.float32)
-    
-    def get_goal_reward(self, goal_scored):
-        team_rewards = np.zeros(self.num_teams)
-        if goal_scored >= 0:  # A goal was scored
-            scoring_team = goal_scored
-            for team in range(self.num_teams):
-                if team == scoring_team:
-                    team_rewards[team] += 1  # Big reward for scoring team
-                else:
-                    team_rewards[team] += -0.5  # Penalty for conceding team
-        return team_rewards
-    
-    def get_stay_in_field_reward(self, agent_idx):
-        """Calculate reward for staying in the field"""
-        player = self.players[agent_idx]
-        # Check if player is in the field
-        if player.position.x > 0 and player.position.x < GAME_WIDTH and \
-            player.position.y > 0 and player.position.y < GAME_HEIGHT:
-            return 1.0
-        else:
-            return -1.0
-    
-    def are_actions_similar(self, action1, action2):
-        """Check if two actions are similar"""
-        return (action1, action2) in SIMILAR_ACTION_PAIRS or (action2, action1) in SIMILAR_ACTION_PAIRS
-
-    def get_smoothness_reward(self, agent_idx=None):
-        """Calculate reward for smoothness of actions"""
-        '''if len(self.action_history) < 2:
-            return 0.0
-            
-        current_action = self.action_history[-1][agent_idx]
-        previous_action = self.action_history[-2][agent_idx]
-        if self.are_actions_similar(current_action, previous_action):
-            return 1.0
-        else:
-            return -1.0'''
-        if len(self.local_position_history) < 2:
-            return 0.0
-        previous_position = self.local_position_history[0][agent_idx]
-        this_position = self.local_position_history[-1][agent_idx]
-        dist = np.linalg.norm(this_position - previous_position)
-        expected_dist = PLAYER_SIZE / FPS * 3
-        if dist >= expected_dist / 2:
-            return 1.0
-        else:
-            return -1.0
-        
-    def get_winning_the_ball_and_passing_reward(self):
-        """Calculate reward for winning the ball and passing"""
-        team_rewards = np.zeros(self.num_teams)
-        if self.ball_toucher is None:
-            return team_rewards
-        if len(self.ball_toucher_history) < 3: # less than 3 steps in
-            return team_rewards
-        if not (self.ball_toucher_history[-3] is None and self.ball_toucher_history[-2] is None):
-            return team_rewards
-        if self.last_ball_toucher == self.ball_toucher:
-            return team_rewards
-        for team in range(self.num_teams):
-            ball_toucher_team = self.ball_toucher // self.team_size
-            if team == ball_toucher_team:
-                team_rewards[team] += 1.0
-            else:
-                team_rewards[team] += -1.0
-        return team_rewards
-    
-    def get_normalized_distance(self, vector1 : Box2D.b2Vec2, vector2 : Box2D.b2Vec2, max_distance = GAME_WIDTH + GAME_HEIGHT):
-        distance = np.sqrt((vector1.x - vector2.x)**2 + (vector1.y - vector2.y)**2)
-        normalized_distance = distance / max_distance
-        return normalized_distance
-
-    def get_distance_based_passing_reward(self):
-        """Calculate reward for distance based passing"""
-        team_rewards = np.zeros(self.num_teams)
-        if self.ball_touch_coordinate is None:
-            return team_rewards
-        ball_touch_team = self.ball_toucher // self.team_size
-        if self.last_ball_touch_coordinate is None:
-            team_rewards[ball_touch_team] += 1.0
-            return team_rewards
-        if self.ball_toucher == self.last_ball_toucher:
-            return team_rewards
-        distance = self.get_normalized_distance(self.ball_touch_coordinate, self.last_ball_touch_coordinate, 1.0)
-        team_rewards[ball_touch_team] += piecewise_function(distance, PASSING_QUADRATIC_THRESHOLD, PASSING_THRESHOLD)
-        return team_rewards
-
-    def get_player_distance_reward(self):
-        """Calculate reward for player distance"""
-        team_rewards = np.zeros(self.num_teams)
-        for team in range(self.num_teams):
-            agents_in_team = [i for i in range(team * self.team_size, (team + 1) * self.team_size)]
-            # iterate over all pairs of agents
-            for i in range(len(agents_in_team)):
-                for j in range(i + 1, len(agents_in_team)):
-                    distance = self.get_normalized_distance(self.players[agents_in_team[i]].position, self.players[agents_in_team[j]].position, 1.0)
-                    if distance >= 8:
-                        continue
-                    team_rewards[team] += (PLAYER_DISTANCE_THRESHOLD - distance)**2 / PLAYER_DISTANCE_THRESHOLD**2
-        return team_rewards
-
-    def get_dist_to_ball_reward(self, agent_idx, only_beginning=True):
-        """Calculate reward for distance to ball"""
-        if only_beginning:
-            return 0.0
-        normalized_distance = self.get_normalized_distance(self.players[agent_idx].position, self.ball.position)
-        return 1.0 - normalized_distance
-    
-    def get_dist_to_goal_reward(self):
-        """Calculate reward for distance to goal"""
-        team_rewards = np.zeros(self.num_teams)
-        for team in range(self.num_teams):
-            pos_of_enemy_goal = Box2D.b2Vec2(GAME_WIDTH / 2, GAME_HEIGHT if team == 0 else 0)
-            normalized_distance = self.get_normalized_distance(self.ball.position, pos_of_enemy_goal)
-            team_rewards[team] = 1.0 - normalized_distance
-        return team_rewards
-    
-    def get_normalized_dot_product(self, vector1 : Box2D.b2Vec2, vector2 : Box2D.b2Vec2, max_value):
-        vector2_magnitude = np.sqrt(vector2.x**2 + vector2.y**2)
-        dot_product = (vector1.x * vector2.x + vector1.y * vector2.y) / (vector2_magnitude + 1e-6)
-        normalized_dot_product = dot_product / max_value
-        return normalized_dot_product
-
-    def get_velocity_to_ball_reward(self, agent_idx):
-        """Calculate reward for velocity towards the ball"""
-        player = self.players[agent_idx]
-        normalized_dot_product = self.get_normalized_dot_product(player.linearVelocity, self.ball.position - player.position, REALISTIC_MAXIMUM_VELOCITY)
-        return normalized_dot_product
-
-    def get_velocity_to_goal_reward(self):
-        """Calculate reward for velocity towards the goal"""
-        team_rewards = np.zeros(self.num_teams)
-        for team in range(self.num_teams):
-            pos_of_enemy_goal = Box2D.b2Vec2(GAME_WIDTH / 2, GAME_HEIGHT if team == 0 else 0)
-            normalized_dot_product = self.get_normalized_dot_product(self.ball.linearVelocity, pos_of_enemy_goal - self.ball.position, REALISTIC_MAXIMUM_VELOCITY)
-            team_rewards[team] = normalized_dot_product
-        return team_rewards
-
-    def get_stay_own_half_reward(self, agent_idx):
-        """Calculate reward for staying in own half defined as the cirle with the center of the own goal is the center of the circle and the radius as the distance to the ball"""
-        player = self.players[agent_idx]
-        team = agent_idx // self.team_size
-        pos_of_own_goal = Box2D.b2Vec2(GAME_WIDTH / 2, 0 if team == 0 else GAME_HEIGHT)
-        radius = self.get_normalized_distance(pos_of_own_goal, self.ball.position, max_distance = 1)
-        dist_to_own_goal = self.get_normalized_distance(player.position, pos_of_own_goal, max_distance = 1)
-        if dist_to_own_goal < radius:
-            return 1.0
-        else:
-            return 0.0
-
-    def get_first_touch_reward(self):
-        """Calculate reward for first touch"""
-        team_rewards = np.zeros(self.num_teams)
-        if self.first_touch_happened:
-            return team_rewards
-        if self.last_ball_toucher is None:
-            return team_rewards
-        first_touch_team = self.last_ball_toucher // self.team_size
-        other_team = 1 - first_touch_team
-        team_rewards[first_touch_team] = 1.0
-        team_rewards[other_team] = -0.5
-        self.first_touch_happened = True
-        return team_rewards
-    
-    def get_shooting_reward(self):
-        """Calculate reward for shooting"""
-        team_rewards = np.zeros(self.num_teams)
-        if self.last_ball_toucher is None:
-            return team_rewards
-        shooting_team = self.last_ball_toucher // self.team_size
-        ball_speed = np.sqrt(self.ball.linearVelocity.x**2 + self.ball.linearVelocity.y**2)
-        team_rewards[shooting_team] = ball_speed / REALISTIC_MAXIMUM_VELOCITY
-        return team_rewards
+    def get_body_states(self, out=None):
+        """Gather position and velocity [x, y, vx, vy] of every player and the ball into one array"""
+        if out is None:
+            out = self.body_states
+        if self.physics_backend == "numpy":
+            out[:-1, :2] = self.physics.player_position[self.physics_index]
+            out[:-1, 2:] = self.physics.player_velocity[self.physics_index]
+            out[-1, :2] = self.physics.ball_position[self.physics_index]
+            out[-1, 2:] = self.physics.ball_velocity[self.physics_index]
+            return out
+        for k, body in enumerate(self.bodies):
+            position = body.position
+            velocity = body.linearVelocity
+            out[k] = (position.x, position.y, velocity.x, velocity.y)
+        return out
+
+    def get_observations(self, out=None):
+        """Get observations for all agents
+
+        Each agent observes its own, its teammates', its enemies' and the ball's position and
+        velocity in its local frame. If out is given, the observations are written into it.
+        """
+        return self.observation_tables.compute(self.get_body_states(), out=out)
     
-    def get_base_negative_reward(self):
-        """Calculate reward for base negative reward"""
-        return np.ones(self.num_teams)
-        
-    def calculate_rewards(self, goal_scored):
-        """Calculate rewards for all agents"""
-        rewards = np.zeros(self.num_agents)
-        team_rewards = np.zeros(self.num_teams)
-        if "base_negative" in self.reward_specification:
-            team_rewards += self.reward_specification["base_negative"] * self.get_base_negative_reward()
-        if "goal" in self.reward_specification:
-            team_rewards += self.reward_specification["goal"] * self.get_goal_reward(goal_scored)
-        if "winning_the_ball_and_passing" in self.reward_specification:
-            team_rewards += self.reward_specification["winning_the_ball_and_passing"] * self.get_winning_the_ball_and_passing_reward()
-        if "distance_based_passing" in self.reward_specification:
-            team_rewards += self.reward_specification["distance_based_passing"] * self.get_distance_based_passing_reward()
-        if "player_distance" in self.reward_specification:
-            team_rewards += self.reward_specification["player_distance"] * self.get_player_distance_reward()
-        if "velocity_to_goal" in self.reward_specification:
-            team_rewards += self.reward_specification["velocity_to_goal"] * self.get_velocity_to_goal_reward()
-        if "dist_to_goal" in self.reward_specification:
-            team_rewards += self.reward_specification["dist_to_goal"] * self.get_dist_to_goal_reward()
-        if "first_touch" in self.reward_specification:
-            team_rewards += self.reward_specification["first_touch"] * self.get_first_touch_reward()
-        if "shooting" in self.reward_specification:
-            team_rewards += self.reward_specification["shooting"] * self.get_shooting_reward()
-        # calculate rewards
-        for team_idx in range(self.num_teams):
-            team_start = team_idx * self.team_size
-            team_end = (team_idx + 1) * self.team_size
-            for agent_idx in range(team_start, team_end):
-                if "stay_in_field" in self.reward_specification:
-                    team_rewards[team_idx] += 1/self.team_size * self.reward_specification["stay_in_field"] * self.get_stay_in_field_reward(agent_idx)
-                if "smoothness" in self.reward_specification:
-                    team_rewards[team_idx] += 1/self.team_size * self.reward_specification["smoothness"] * self.get_smoothness_reward(agent_idx)
-                if "velocity_to_ball" in self.reward_specification:
-                    team_rewards[team_idx] += 1/self.team_size * self.reward_specification["velocity_to_ball"] * self.get_velocity_to_ball_reward(agent_idx)
-            # Some rewards should only be calculated for one player
-            if "dist_to_ball" in self.reward_specification:
-                team_rewards[team_idx] += self.reward_specification["dist_to_ball"] * max([self.get_dist_to_ball_reward(agent_idx) for agent_idx in range(team_start, team_end)])
-            if "stay_own_half" in self.reward_specification:
-                team_rewards[team_idx] += self.reward_specification["stay_own_half"] * max([self.get_stay_own_half_reward(agent_idx) for agent_idx in range(team_start, team_end)])
+    def compile_reward_specification(self):
+        """Compile self.reward_specification into a RewardPipeline of its active terms"""
+        from ppo.environments.soccer_rewards import RewardState, RewardPipeline
+        self.reward_state = RewardState(1, self.num_agents, self.team_size, self.history_length)
+        self.reward_pipeline = RewardPipeline(self.reward_specification, 1, self.num_teams)
+        # Running per-term, per-team sums of the current episode
+        self.episode_reward_terms = np.zeros((len(self.reward_pipeline.names), self.num_teams))
+        self.state_dtype = self.get_state_dtype()
+
+    def calculate_rewards(self, goal_scored, body_states=None):
+        """Calculate rewards for all agents
+
+        body_states are the states gathered by get_body_states after the physics step,
+        they are gathered again if not given.
+        """
+        if body_states is None:
+            body_states = self.get_body_states()
+        self.reward_state.update(0, self, goal_scored, body_states)
+        self.reward_state.first_touch_happened[0] = self.first_touch_happened
+        team_rewards = self.reward_pipeline.calculate(self.reward_state)[0]
+        self.first_touch_happened = bool(self.reward_state.first_touch_happened[0])
         # Distribute team rewards to individual agents
         # Currently the reward needs to be the same for all agents in a tean!!!
-        for i in range(self.num_agents):
-            team = i // self.team_size
-            rewards[i] = team_rewards[team]
-        return rewards
+        return np.repeat(team_rewards, self.team_size)
     
     def process_action_to_velocity(self, action):
         """Convert action to local velocity vector"""
@@ -693,50 +710,153 @@ class Soccer(gym.Env):
         
         return local_vel
 
-    def step(self, actions):
-        """Take a step in the environment with the given actions"""
+    def register_numpy_touches(self):
+        """Update the touch state from the contacts the NumPy physics began in the last step"""
+        touching = np.flatnonzero(self.physics.began_contacts[self.physics_index])
+        if len(touching) == 0:
+            return
+        # Like consecutive BeginContact calls, the last player wins
+        player = self.players[touching[-1]]
+        self.ball_touched[player.userData['team']] = True
+        self.ball_toucher = player.userData['id']
+
+    def register_box2d_touches(self):
+        """Update the touch state from the ball-player contacts that began touching in the last Box2D step
+
+        Scans the contact list of the ball once instead of handling every contact of the world
+        in a Python callback. The list starts with the newest contact, which is also the order
+        in which Box2D begins contacts, so like with consecutive BeginContact calls the last
+        player wins. self.ball_contacts holds the players touching the ball after the last step.
+        """
+        previous_contacts = self.ball_contacts
+        contacts = [False] * self.num_agents
+        # body.contacts lists the contacts oldest first, the reverse of the linked list
+        for edge in reversed(self.ball.contacts):
+            if edge.contact.touching:
+                player = edge.other.userData
+                if player is not None: # walls have no userData
+                    agent = player['id']
+                    contacts[agent] = True
+                    if not previous_contacts[agent]:
+                        self.ball_touched[player['team']] = True
+                        self.ball_toucher = agent
+        self.ball_contacts = contacts
+
+    def build_action_velocities(self):
+        """Precompute the global velocity of every action for every agent, shape (num_agents, 9, 2)"""
+        action_velocities = np.zeros((self.num_agents, self.action_space.nvec[0], 2))
+        for i in range(self.num_agents):
+            for action in range(self.action_space.nvec[0]):
+                local_vel = self.process_action_to_velocity(action)
+                action_velocities[i, action] = self.get_global_velocity(local_vel, i)
+        return action_velocities
 
+    def get_action_velocities(self, actions):
+        """Look up the global velocities of integer actions of shape (..., num_agents), e.g. (N, 4) for N envs"""
+        return self.action_velocities[self.agent_indices, np.asarray(actions, dtype=np.intp)]
+
+    def apply_actions(self, actions):
+        """Set the velocity of every player from its action"""
+        velocities = self.get_action_velocities(actions)
+        if self.physics_backend == "numpy":
+            self.physics.player_velocity[self.physics_index] = velocities
+            return
+        for player, (vx, vy) in zip(self.players, velocities.tolist()):
+            player.linearVelocity = (vx, vy)
+
+    def begin_step(self, actions, apply_actions=True):
+        """Apply the actions and prepare the touch bookkeeping before the physics step
+
+        apply_actions=False skips setting the velocities, for callers that set them for many envs at once.
+        """
         self.add_to_action_history(actions)
 
         # Process actions for each agent
-        for i, action in enumerate(actions):
-            player = self.players[i]
-            local_vel = self.process_action_to_velocity(action)
-            global_vel = self.get_global_velocity(local_vel, i)
-            player.linearVelocity = Box2D.b2Vec2(global_vel[0], global_vel[1])
+        if apply_actions:
+            self.apply_actions(actions)
         
         self.update_ball_touch_variables()
 
-        # Update physics
-        self.world.Step(1.0/FPS, 6, 2)
+    def end_step(self):
+        """Update the histories after the physics step and gather the body states into self.body_states
 
+        Returns the index of the team that scored, or -1 if no goal was scored.
+        """
         self.add_to_ball_toucher_history(self.ball_toucher)
-        local_position = np.array([
-            self.get_local_position(
-                (self.players[i].position.x, self.players[i].position.y),
-                i,
-                normalize=False
-            ) for i in range(self.num_agents)
-        ])
-        self.add_to_local_position_history(local_position)
-        # Check for goals
-        goal_scored = self.check_goal()
-        
-        # Get observations
-        observations = self.get_observations()
-        
-        # Calculate rewards
-        rewards = self.calculate_rewards(goal_scored)
-        
-        # Check if episode is done
+        # The touch coordinate is the ball position at the end of the frame, whichever substep the touch began in
+        if self.ball_toucher is not None:
+            self.ball_touch_coordinate = self.get_ball_touch_coordinate()
+        # Gather the body states once, they are reused for the observations and rewards of the step
+        body_states = self.get_body_states()
+        # Local positions like get_local_position, written straight into the history
+        local_position = self.local_position_history.next_slot()
+        np.multiply(body_states[:-1, :2], self.observation_tables.sign[:, 0, :2], out=local_position)
+        local_position += self.observation_tables.offset[:, 0]
         self.step_count += 1
-        terminated = goal_scored >= 0  # Episode ends if a goal is scored
-        truncated = self.step_count >= self.max_steps  # Or if max steps reached
+        # Check for goals
+        return self.check_goal()
+
+    def simulate(self, actions):
+        """Apply the actions, advance the physics by one frame and update the touch bookkeeping
+
+        Returns the index of the team that scored, or -1 if no goal was scored.
+        """
+        self.begin_step(actions)
+
+        # Update physics, touches are registered after every substep
+        dt = 1.0 / (FPS * self.physics_substeps)
+        for _ in range(self.physics_substeps):
+            if self.physics_backend == "numpy":
+                self.physics.step(dt)
+                self.register_numpy_touches()
+            else:
+                self.world.Step(dt, self.velocity_iterations, self.position_iterations)
+                if self.contact_listener is None:
+                    self.register_box2d_touches()
+                else:
+                    self.contact_listener.continued_contacts = None
+
+        return self.end_step()
+
+    def step(self, actions):
+        """Take a step in the environment with the given actions
+
+        The actions are repeated for action_repeat frames, or until the episode ends, and the
+        rewards of the frames are summed. Every frame updates the touch histories and checks for
+        a goal like a step with action_repeat=1, the observations are those after the last frame.
+        """
+        rewards = 0.0
+        # Summed term rewards of the step, only needed for info["reward_terms"]
+        reward_terms = 0.0 if self.reward_breakdown else None
+        for _ in range(self.action_repeat):
+            goal_scored = self.simulate(actions)
+            
+            # Calculate rewards from the body states gathered by end_step
+            frame_rewards = self.calculate_rewards(goal_scored, self.body_states)
+            rewards = rewards + frame_rewards
+            if self.reward_breakdown:
+                reward_terms = reward_terms + self.reward_pipeline.term_rewards[:, 0]
+            if self.episode_statistics:
+                self.episode_reward_terms += self.reward_pipeline.term_rewards[:, 0]
+            
+            # Check if episode is done
+            terminated = goal_scored >= 0  # Episode ends if a goal is scored
+            truncated = self.step_count >= self.max_steps  # Or if max steps reached
+            
+            if self.video_recorder is not None and self.video_recorder.recording:
+                self.video_recorder.add_frame(self.video_renderer.render(self.body_states).copy())
+            if self.trajectory_writer is not None:
+                self.trajectory_writer.add_step(self.step_count, self.body_states, actions, frame_rewards, self.ball_toucher,
+                                                goal_scored, terminated, truncated)
+            if terminated or truncated:
+                break
         
+        # Get observations from the body states of the last frame
+        observations = self.observation_tables.compute(self.body_states)
+
         # Reset if needed
         if terminated or truncated:
-            # if self.render_mode is not None and (self.episode_count % self.video_log_freq == 0):
-            #     self.save_video()
+            self.save_video()
             
             # Don't actually reset here, just prepare for the next reset
             if terminated:
@@ -744,45 +864,111 @@ class Soccer(gym.Env):
         
         # Format rewards like in mappo_selfplay_test
         info = {"other_reward": rewards[1:]}
+        if self.reward_breakdown:
+            info["reward_terms"] = {name: reward_terms[k] for k, name in enumerate(self.reward_pipeline.names)}
+        if self.episode_statistics and (terminated or truncated):
+            info["episode"] = self.get_episode_statistics()
         
         return observations, rewards[0], terminated, truncated, info
     
+    def get_episode_statistics(self):
+        """Episode statistics like gymnasium's RecordEpisodeStatistics, plus per-term team returns
+
+        "r" is the return of every team, "l" the episode length, "t" the elapsed time in seconds
+        and "reward_terms" maps every active reward term to its return of every team.
+        """
+        return {
+            "r": self.episode_reward_terms.sum(axis=0),
+            "l": self.step_count,
+            "t": round(time.perf_counter() - self.episode_start_time, 6),
+            "reward_terms": {name: self.episode_reward_terms[k].copy() for k, name in enumerate(self.reward_pipeline.names)},
+        }
+
     def reset(self, seed=None, options=None):
-        """Reset the environment"""
+        """Reset the environment
+
+        The static walls and the player and ball bodies are kept between episodes, only the
+        dynamic bodies are moved back to their spawn positions. Pass options={"rebuild_world": True}
+        to recreate all bodies, which also happens when a physics parameter changed. Episodes are
+        reproducible for a given seed either way, but Box2D keeps contact and broadphase state in
+        reused bodies, so only rebuilt worlds match a fresh env bit for bit. In deterministic
+        mode the world is rebuilt on every reset.
+        """
         super().reset(seed=seed)
-        self.action_history = []
+        if self.reward_specification != self.reward_pipeline.reward_specification:
+            self.compile_reward_specification()
+        if self.episode_statistics:
+            self.episode_reward_terms[:] = 0.0
+            self.episode_start_time = time.perf_counter()
+        self.action_history.clear()
         self.first_touch_happened = False
-        self.local_position_history = []
+        self.local_position_history.clear()
         
-        # Clear the world
-        for body in self.world.bodies:
-            self.world.DestroyBody(body)
+        if self.physics_backend == "numpy":
+            self.physics.reset_env(self.physics_index)
         
         # Reset step counter
         self.step_count = 0
         self.episode_count += 1
         
-        # Create boundaries, players, and ball
-        self.create_boundaries()
-        self.create_players()
-        self.create_ball()
+        # Reuse the bodies of the last episode unless a rebuild is requested or the physics changed
+        rebuild_world = self.deterministic or (options is not None and options.get("rebuild_world", False))
+        if rebuild_world or self.players is None or self.physics_parameters != self.get_physics_parameters():
+            if self.deterministic and self.physics_backend == "box2d":
+                # The broadphase of a reused world still depends on the last episode
+                self.create_world()
+            self.build_world()
+        else:
+            self.reposition_players()
+            self.reset_ball()
+            if self.physics_backend == "box2d":
+                self.ball.angle = 0
+                self.ball.awake = True
         
         # Reset score
         self.score = [0, 0]  # [team1_score, team2_score]
         
-        # Clear frames for new episode
-        self.frames = []
-        
         # Get initial observations
         observations = self.get_observations()
+
+        # Start streaming the episode to disk if it is selected for recording
+        if self.video_recorder is not None:
+            self.video_recorder.finish()
+            if self.episode_count % self.video_log_freq == 0:
+                self.start_video()
+        if self.trajectory_writer is not None:
+            self.trajectory_writer.begin_episode(self.body_states)
         
         return observations, {}
     
     def render(self, mode="rgb_array"):
-        """Render the environment"""
+        """Render the environment
+
+        In the rgb_array_headless render mode the frame is an (H, W, 3) array drawn without pygame,
+        while the pygame modes return the window contents transposed as (W, H, 3).
+        """
         if self.render_mode is None:
             return
+        if self.render_mode == "rgb_array_headless":
+            return self.renderer.render(self.get_body_states()).copy()
+        
+        import pygame
+        self.draw(self.get_body_states())
+        
+        # Update display
+        if self.render_mode == "human":
+            pygame.display.flip()
+            self.clock.tick(FPS)
         
+        # Return rgb array
+        return pygame.surfarray.array3d(self.screen)
+
+    def draw(self, body_states):
+        """Draw the field and the bodies at body_states (num_agents + 1, 4) on the pygame screen
+
+        The states need not be the current ones, play_soccer draws states interpolated between two steps.
+        """
+        import pygame
         self.screen.fill(BLACK)
         
         # Draw walls
@@ -808,50 +994,174 @@ class Soccer(gym.Env):
         pygame.draw.rect(self.screen, GREEN, (wall_width, SCREEN_HEIGHT - 2, goal_width_pixels, 2))  # Bottom goal line
         
         # Draw players
-        for player in self.players:
-            pos = (int(player.position.x * PPM), int(player.position.y * PPM))
-            team = player.userData["team"]
+        for i, (x, y) in enumerate(body_states[:-1, :2].tolist()):
+            pos = (int(x * PPM), int(y * PPM))
+            team = i // self.team_size
             color = RED if team == 0 else BLUE
             pygame.draw.rect(self.screen, color, 
                             (pos[0] - PLAYER_SIZE*PPM/2, pos[1] - PLAYER_SIZE*PPM/2, 
                             PLAYER_SIZE*PPM, PLAYER_SIZE*PPM))
         
         # Draw ball
-        ball_pos = (int(self.ball.position.x * PPM), int(self.ball.position.y * PPM))
+        ball_x, ball_y = body_states[-1, :2].tolist()
+        ball_pos = (int(ball_x * PPM), int(ball_y * PPM))
         pygame.draw.circle(self.screen, WHITE, ball_pos, int(BALL_RADIUS * PPM))
-        
-        # Update display
-        if self.render_mode == "human":
-            pygame.display.flip()
-            self.clock.tick(FPS)
-        
-        # Return rgb array
-        return pygame.surfarray.array3d(self.screen)
     
+    def get_state_dtype(self):
+        """Structured dtype of the flat record returned by get_state"""
+        history_length = self.history_length
+        return np.dtype([
+            ("bodies", np.float64, (self.num_agents + 1, 6)), # x, y, vx, vy, angle, angular velocity
+            ("awake", np.bool_, (self.num_agents + 1,)),
+            ("ball_contacts", np.bool_, (self.num_agents,)), # players touching the ball after the last step
+            ("step_count", np.int64),
+            ("episode_count", np.int64),
+            ("score", np.int64, (self.num_teams,)),
+            ("ball_touched", np.bool_, (self.num_teams,)),
+            ("ball_toucher", np.int64),
+            ("last_ball_toucher", np.int64),
+            ("ball_toucher_history", np.int64, (history_length,)),
+            ("ball_toucher_history_length", np.int64),
+            ("has_ball_touch_coordinate", np.bool_),
+            ("last_ball_touch_coordinate", np.float64, (2,)),
+            ("has_last_ball_touch_coordinate", np.bool_),
+            ("local_position_history", np.float64, (history_length, self.num_agents, 2)),
+            ("local_position_history_length", np.int64),
+            ("action_history", np.int64, (history_length, self.num_agents)),
+            ("action_history_length", np.int64),
+            ("first_touch_happened", np.bool_),
+            ("episode_reward_terms", np.float64, self.episode_reward_terms.shape),
+            ("rng_state", np.uint64, (4,)), # PCG64 state and increment as (high, low) words
+            ("rng_has_uint32", np.int64),
+            ("rng_uinteger", np.uint64),
+        ])
+
+    def get_state(self, out=None):
+        """Capture the full state of the episode into a flat NumPy record, restored by set_state
+
+        Bookkeeping, score, episode returns and the RNG used by reset are included, so branches
+        stay identical across resets too. out can be a record of self.state_dtype to write into,
+        e.g. one row of a preallocated array. Capturing the state does not change the env.
+
+        With the numpy backend an env restored from the record continues exactly like the
+        original. With Box2D it does not: the record lacks the warm starting impulses, contact
+        order and broadphase bounds of the original world, which pybox2d cannot read or write, so
+        a restored env soon drifts from the original, often within a few steps of a contact.
+        Envs restored from the same record do continue identically.
+        """
+        if out is None:
+            out = np.zeros((), dtype=self.state_dtype)
+        if self.physics_backend == "numpy":
+            out["bodies"][:, :4] = self.get_body_states()
+            out["bodies"][:, 4:] = 0.0
+            out["awake"] = True
+            out["ball_contacts"] = self.physics.ball_contacts[self.physics_index]
+        else:
+            for k, body in enumerate(self.bodies):
+                position = body.position
+                velocity = body.linearVelocity
+                out["bodies"][k] = (position.x, position.y, velocity.x, velocity.y, body.angle, body.angularVelocity)
+                out["awake"][k] = body.awake
+            out["ball_contacts"] = self.ball_contacts
+        out["step_count"] = self.step_count
+        out["episode_count"] = self.episode_count
+        out["score"] = self.score
+        out["ball_touched"] = self.ball_touched
+        out["ball_toucher"] = NO_TOUCHER if self.ball_toucher is None else self.ball_toucher
+        out["last_ball_toucher"] = NO_TOUCHER if self.last_ball_toucher is None else self.last_ball_toucher
+        out["ball_toucher_history"] = NO_TOUCHER
+        out["ball_toucher_history"][:len(self.ball_toucher_history)] = self.ball_toucher_history.to_array()
+        out["ball_toucher_history_length"] = len(self.ball_toucher_history)
+        # The touch coordinate always refers to the current ball position, only whether it is set is stored
+        out["has_ball_touch_coordinate"] = self.ball_touch_coordinate is not None
+        out["has_last_ball_touch_coordinate"] = self.last_ball_touch_coordinate is not None
+        if self.last_ball_touch_coordinate is not None:
+            out["last_ball_touch_coordinate"] = tuple(self.last_ball_touch_coordinate)
+        out["local_position_history"][:len(self.local_position_history)] = self.local_position_history.to_array()
+        out["local_position_history_length"] = len(self.local_position_history)
+        out["action_history"][:len(self.action_history)] = self.action_history.to_array()
+        out["action_history_length"] = len(self.action_history)
+        out["first_touch_happened"] = self.first_touch_happened
+        out["episode_reward_terms"] = self.episode_reward_terms
+        rng_state = self.np_random.bit_generator.state
+        out["rng_state"] = [value >> shift & 0xFFFFFFFFFFFFFFFF for value in rng_state["state"].values() for shift in (64, 0)]
+        out["rng_has_uint32"] = rng_state["has_uint32"]
+        out["rng_uinteger"] = rng_state["uinteger"]
+        return out
+
+    def set_state(self, state):
+        """Restore a record captured by get_state, possibly from another env with the same settings
+
+        With Box2D the world is rebuilt, which takes a few hundred microseconds. The rebuilt world
+        only depends on the record, so every env restored from it continues with the same
+        trajectory, which is not the trajectory of the original, see get_state.
+        """
+        if self.physics_backend == "numpy":
+            self.physics.player_position[self.physics_index] = state["bodies"][:-1, :2]
+            self.physics.player_velocity[self.physics_index] = state["bodies"][:-1, 2:4]
+            self.physics.ball_position[self.physics_index] = state["bodies"][-1, :2]
+            self.physics.ball_velocity[self.physics_index] = state["bodies"][-1, 2:4]
+            self.physics.ball_contacts[self.physics_index] = state["ball_contacts"]
+        else:
+            # Contacts, sleep timers and broadphase proxy ids depend on the history of a world and
+            # cannot be saved, so the bodies are recreated in a new world (the RNG is restored below)
+            self.create_world()
+            self.build_world()
+            for body, (x, y, vx, vy, angle, angular_velocity), awake in zip(self.bodies, state["bodies"].tolist(), state["awake"].tolist()):
+                body.transform = ((x, y), angle)
+                body.linearVelocity = (vx, vy)
+                body.angularVelocity = angular_velocity
+                body.awake = awake
+            # The new world has no contacts yet, a player already touching the ball must not touch it again
+            if self.contact_listener is None:
+                self.ball_contacts = state["ball_contacts"].tolist()
+            else:
+                self.contact_listener.continued_contacts = state["ball_contacts"].tolist()
+        self.step_count = int(state["step_count"])
+        self.episode_count = int(state["episode_count"])
+        self.score = state["score"].tolist()
+        self.ball_touched = state["ball_touched"].tolist()
+        self.ball_toucher = None if state["ball_toucher"] == NO_TOUCHER else int(state["ball_toucher"])
+        self.last_ball_toucher = None if state["last_ball_toucher"] == NO_TOUCHER else int(state["last_ball_toucher"])
+        self.ball_toucher_history.clear()
+        for toucher in state["ball_toucher_history"][:state["ball_toucher_history_length"]]:
+            self.ball_toucher_history.append(toucher)
+        self.ball_touch_coordinate = self.get_ball_touch_coordinate() if state["has_ball_touch_coordinate"] else None
+        self.last_ball_touch_coordinate = self.get_ball_touch_coordinate(state["last_ball_touch_coordinate"].tolist()) if state["has_last_ball_touch_coordinate"] else None
+        self.local_position_history.clear()
+        for local_position in state["local_position_history"][:state["local_position_history_length"]]:
+            self.local_position_history.append(local_position)
+        self.action_history.clear()
+        for actions in state["action_history"][:state["action_history_length"]]:
+            self.action_history.append(actions)
+        self.first_touch_happened = bool(state["first_touch_happened"])
+        self.episode_reward_terms[:] = state["episode_reward_terms"]
+        high_state, low_state, high_inc, low_inc = (int(value) for value in state["rng_state"])
+        self.np_random.bit_generator.state = {
+            "bit_generator": "PCG64",
+            "state": {"state": high_state << 64 | low_state, "inc": high_inc << 64 | low_inc},
+            "has_uint32": int(state["rng_has_uint32"]),
+            "uinteger": int(state["rng_uinteger"]),
+        }
+
+    def start_video(self):
+        """Start streaming the current episode to a video file, beginning with its first frame"""
+        self.video_dir.mkdir(parents=True, exist_ok=True)
+        filename = self.video_dir / f"rl_video_episode_{self.episode_count}.mp4"
+        if self.video_recorder.start(filename):
+            self.video_recorder.add_frame(self.video_renderer.render(self.body_states).copy())
+
     def save_video(self):
-        """Save recorded frames as a video"""
-        if not self.frames:
-            return
-        
-        try:
-            import numpy as np
-            import imageio
-            video_dir = Path(__file__).parent / "videos"
-            video_dir.mkdir(parents=True, exist_ok=True)
-            current_datetime = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-            soccer_dir = video_dir / f"{self.env_id}__MAPPOSoccer__seed{self.seed}__{current_datetime}"
-            soccer_dir.mkdir(parents=True, exist_ok=True)
-            filename = soccer_dir / f"rl_video_episode_{self.episode_count}.mp4"
-            frames_array = np.array(self.frames)
-            imageio.mimsave(filename, frames_array, fps=FPS)
-            print(f"Recording saved as {filename}")
-            
-            # Clear frames after saving
-            self.frames = []
-        except ImportError:
-            print("Could not save video: imageio and/or numpy not installed")
+        """Finish the video of the current episode, the remaining frames are written in the background"""
+        if self.video_recorder is not None:
+            self.video_recorder.finish()
     
     def close(self):
         """Close the environment"""
-        if self.render_mode is not None:
+        if self.video_recorder is not None:
+            self.video_recorder.close()
+        if self.trajectory_writer is not None:
+            self.trajectory_writer.close()
+        if self.render_mode in ("human", "rgb_array"):
+            import pygame
             pygame.quit()
\ No newline at end of file
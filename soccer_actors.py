@@ -0,0 +1,101 @@
+# Actor models for the Soccer Environment
+#
+# Loads trained actors from .pth (torch) or .onnx (onnxruntime) files and samples actions
+# from their logits. Every actor maps a batch of observations (N, 20) to logits (N, 9), so
+# the observations of many players and matches can be evaluated in one forward pass.
+
+import warnings
+
+import numpy as np
+
+
+class TorchActor:
+    """Actor saved with torch.save(model), evaluated on the CPU"""
+    def __init__(self, model_path):
+        import torch
+        self.torch = torch
+        # Set weights_only=False to load the entire model (compatible with models saved using torch.save(model))
+        self.actor = torch.load(model_path, map_location="cpu", weights_only=False)
+        self.actor.eval()
+
+    def __call__(self, observations):
+        """Logits (N, 9) of a batch of observations (N, 20)"""
+        with self.torch.inference_mode():
+            return self.actor(self.torch.from_numpy(observations)).numpy()
+
+
+class OnnxActor:
+    """Actor exported to ONNX, evaluated with onnxruntime on the CPU"""
+    def __init__(self, model_path):
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = 1  # the network is too small to gain from threads
+        self.session = onnxruntime.InferenceSession(load_onnx_model(model_path), options, providers=["CPUExecutionProvider"])
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        self.fixed_batch_size = model_input.shape[0] if isinstance(model_input.shape[0], int) else None
+        self.model_path = model_path
+        self.warned_per_row = False
+
+    def __call__(self, observations):
+        """Logits (N, 9) of a batch of observations (N, 20)"""
+        if self.fixed_batch_size is None or self.fixed_batch_size == len(observations):
+            return self.session.run(None, {self.input_name: observations})[0]
+        # Models with a fixed batch size are run once per observation
+        if not self.warned_per_row:
+            warnings.warn(f"{self.model_path} has a fixed batch size of {self.fixed_batch_size}, running one session call "
+                          "per observation. Install the onnx package to evaluate a batch in one forward pass.")
+            self.warned_per_row = True
+        return np.concatenate([self.session.run(None, {self.input_name: observations[i:i + 1]})[0] for i in range(len(observations))])
+
+
+def load_onnx_model(model_path):
+    """Read an ONNX model and make its batch dimension dynamic if the onnx package is installed
+
+    The shipped models are exported with a batch size of 1, which onnxruntime enforces.
+    Without onnx the file is used as is.
+    """
+    try:
+        import onnx
+    except ImportError:
+        return str(model_path)
+    model = onnx.load(model_path)
+    for value in list(model.graph.input) + list(model.graph.output):
+        shape = value.type.tensor_type.shape
+        if len(shape.dim) > 0:
+            shape.dim[0].dim_param = "batch"
+    return model.SerializeToString()
+
+
+def get_actor_backend(model_path, backend="auto"):
+    """The backend an actor file is loaded with, "auto" chooses "onnx" for .onnx files and "torch" otherwise"""
+    if backend == "auto":
+        return "onnx" if str(model_path).endswith(".onnx") else "torch"
+    if backend not in ("torch", "onnx"):
+        raise ValueError(f"Unknown actor backend: {backend}")
+    return backend
+
+
+def load_actor(model_path, backend="auto"):
+    """Load an actor, backend is "torch", "onnx" or "auto", see get_actor_backend"""
+    if get_actor_backend(model_path, backend) == "onnx":
+        return OnnxActor(model_path)
+    return TorchActor(model_path)
+
+
+def sample_actions(logits, rng):
+    """Sample one action per row of logits (N, 9), like Categorical(logits=logits).sample()"""
+    logits = np.asarray(logits, dtype=np.float64)
+    probabilities = np.exp(logits - logits.max(axis=1, keepdims=True))
+    cumulative = np.cumsum(probabilities, axis=1)
+    cumulative /= cumulative[:, -1:]
+    samples = (cumulative <= rng.random((len(logits), 1))).sum(axis=1)
+    return np.minimum(samples, logits.shape[1] - 1)
+
+
+def get_log_probs(logits, actions):
+    """Log-probability of every action under its row of logits (N, 9), like Categorical(logits=logits).log_prob(actions)"""
+    logits = np.asarray(logits, dtype=np.float64)
+    maximum = logits.max(axis=1, keepdims=True)
+    log_normalizers = maximum[:, 0] + np.log(np.exp(logits - maximum).sum(axis=1))
+    return logits[np.arange(len(logits)), actions] - log_normalizers
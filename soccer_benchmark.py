@@ -0,0 +1,483 @@
+# Step-throughput benchmark for the Soccer Environment
+#
+# Measures steps/sec and per-phase latency of Soccer.step for a single env, the vectorized
+# SoccerVecEnv and the multiprocess SoccerProcessPool, with and without rendering and for
+# several reward specifications. The snapshot config times get_state/set_state and checks that
+# restored envs continue identically, the startup config the import and first reset latency
+# in fresh interpreters and the contacts config the cost of Box2D touch detection by contact
+# callbacks and by scanning the contacts of the ball and the profiles config the speed of every
+# physics profile and how far its play drifts from the default profile. Results are written as
+# JSON so commits can be compared:
+#
+#   python soccer_benchmark.py --configs single vector --steps 2000 --output results.json
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+import numpy as np
+
+from ppo.environments.soccer import (Soccer, SoccerContactListener, DEFAULT_REWARD_SPECIFICATION, FPS, PHYSICS_PROFILES,
+                                     chase_ball_policy)
+
+REWARD_SPECIFICATIONS = {
+    "default": DEFAULT_REWARD_SPECIFICATION,
+    "goal_only": {"goal": 100.0},
+    "all_terms": {
+        **DEFAULT_REWARD_SPECIFICATION,
+        "distance_based_passing": 1.0,
+        "player_distance": 0.05,
+        "velocity_to_goal": 0.05,
+        "dist_to_goal": 0.05,
+        "first_touch": 1.0,
+        "shooting": 0.05,
+        "velocity_to_ball": 0.05,
+        "dist_to_ball": 0.05,
+    },
+}
+
+PHASES = ["action_decode", "physics", "touch_bookkeeping", "observations", "rewards", "render"]
+
+STARTUP_RENDER_MODES = [None, "rgb_array_headless", "rgb_array"]
+
+# Run in a fresh interpreter by benchmark_startup, prints the measured latencies as JSON
+STARTUP_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+from ppo.environments.soccer import Soccer
+imported = time.perf_counter()
+env = Soccer(render_mode={render_mode!r}, episode_statistics=False)
+constructed = time.perf_counter()
+env.reset(seed=0)
+reset = time.perf_counter()
+print(json.dumps({{
+    "import_ms": 1e3 * (imported - start),
+    "construct_ms": 1e3 * (constructed - imported),
+    "first_reset_ms": 1e3 * (reset - constructed),
+    "pygame_imported": "pygame" in sys.modules,
+}}))
+"""
+
+
+def profiled_step(env, actions, phase_times):
+    """Run the phases of Soccer.step one by one, adding their durations in seconds to phase_times
+
+    Plays the action_repeat frames and physics_substeps of the env like Soccer.step. Returns
+    (observations, terminated, truncated) like Soccer.step, without building info.
+    """
+    dt = 1.0 / (FPS * env.physics_substeps)
+    for _ in range(env.action_repeat):
+        start = time.perf_counter()
+        env.add_to_action_history(actions)
+        env.update_ball_touch_variables()
+        bookkeeping_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        env.apply_actions(actions)
+        phase_times["action_decode"] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        for _ in range(env.physics_substeps):
+            if env.physics_backend == "numpy":
+                env.physics.step(dt)
+                env.register_numpy_touches()
+            else:
+                env.world.Step(dt, env.velocity_iterations, env.position_iterations)
+                if env.contact_listener is None:
+                    env.register_box2d_touches()
+        phase_times["physics"] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        goal_scored = env.end_step()
+        phase_times["touch_bookkeeping"] += bookkeeping_time + time.perf_counter() - start
+
+        start = time.perf_counter()
+        env.calculate_rewards(goal_scored, env.body_states)
+        phase_times["rewards"] += time.perf_counter() - start
+
+        terminated = goal_scored >= 0
+        truncated = env.step_count >= env.max_steps
+        if terminated or truncated:
+            break
+
+    start = time.perf_counter()
+    observations = env.get_observations()
+    phase_times["observations"] += time.perf_counter() - start
+    return observations, terminated, truncated
+
+
+def benchmark_single(steps, reward_specification, render=False, physics_backend="box2d", seed=0, team_size=2,
+                     action_repeat=1, physics_substeps=1):
+    env = Soccer(render_mode="rgb_array" if render else None, reward_specification=reward_specification,
+                 physics_backend=physics_backend, episode_statistics=False, team_size=team_size,
+                 action_repeat=action_repeat, physics_substeps=physics_substeps)
+    rng = np.random.default_rng(seed)
+    phase_times = {phase: 0.0 for phase in PHASES}
+    reset_time = 0.0
+    resets = 0
+
+    observations, _ = env.reset(seed=seed)
+    start = time.perf_counter()
+    for _ in range(steps):
+        observations, terminated, truncated = profiled_step(env, chase_ball_policy(observations, rng), phase_times)
+        if render:
+            render_start = time.perf_counter()
+            env.render()
+            phase_times["render"] += time.perf_counter() - render_start
+        if terminated or truncated:
+            reset_start = time.perf_counter()
+            observations, _ = env.reset()
+            reset_time += time.perf_counter() - reset_start
+            resets += 1
+    elapsed = time.perf_counter() - start
+    env.close()
+    return {
+        "steps_per_second": steps / elapsed,
+        "phase_latency_us": {phase: 1e6 * phase_times[phase] / steps for phase in PHASES},
+        "reset_latency_us": 1e6 * reset_time / max(resets, 1),
+        "resets": resets,
+    }
+
+
+def run_vector_env(env, steps, seed):
+    rng = np.random.default_rng(seed)
+    observations, _ = env.reset(seed=seed)
+    start = time.perf_counter()
+    for _ in range(steps):
+        observations, _, _, _, _ = env.step(chase_ball_policy(observations, rng))
+    elapsed = time.perf_counter() - start
+    env.close()
+    return {
+        "steps_per_second": steps * env.num_envs / elapsed,
+        "vector_step_latency_us": 1e6 * elapsed / steps,
+    }
+
+
+def benchmark_vector(steps, reward_specification, num_envs, physics_backend="box2d", seed=0, team_size=2,
+                     action_repeat=1, physics_substeps=1):
+    from ppo.environments.soccer_vec_env import SoccerVecEnv
+    env = SoccerVecEnv(num_envs, reward_specification=reward_specification, physics_backend=physics_backend,
+                       episode_statistics=False, copy=False, team_size=team_size, action_repeat=action_repeat,
+                       physics_substeps=physics_substeps)
+    return run_vector_env(env, steps, seed)
+
+
+def benchmark_multiprocess(steps, reward_specification, num_workers, envs_per_worker, seed=0, team_size=2,
+                           action_repeat=1, physics_substeps=1):
+    from ppo.environments.soccer_pool import SoccerProcessPool
+    env = SoccerProcessPool(num_workers, envs_per_worker, reward_specification=reward_specification, copy=False,
+                            team_size=team_size, action_repeat=action_repeat, physics_substeps=physics_substeps)
+    return run_vector_env(env, steps, seed)
+
+
+def play(env, observations, steps, seed):
+    """Play steps with the scripted policy, returning the stacked observations and rewards and the last observations"""
+    rng = np.random.default_rng(seed)
+    trajectory = []
+    for _ in range(steps):
+        observations, reward, terminated, truncated, info = env.step(chase_ball_policy(observations, rng))
+        trajectory.append(np.concatenate([observations.ravel(), [reward], info["other_reward"]]))
+        if terminated or truncated:
+            observations, _ = env.reset()
+    return np.array(trajectory), observations
+
+
+def benchmark_snapshot(steps, reward_specification, physics_backend="box2d", seed=0, snapshots=20):
+    """Time get_state/set_state and count the restored envs that do not continue like their source
+
+    Every snapshot is taken mid-episode from one env and restored into a second env with a
+    different history, then both play steps with the same policy. Only the numpy backend is
+    expected to have no mismatches, see Soccer.get_state.
+    """
+    source = Soccer(reward_specification=reward_specification, physics_backend=physics_backend)
+    target = Soccer(reward_specification=reward_specification, physics_backend=physics_backend)
+    observations, _ = source.reset(seed=seed)
+    target.reset(seed=seed + 1)
+    get_time = set_time = 0.0
+    mismatches = 0
+    for k in range(snapshots):
+        _, observations = play(source, observations, 17, seed + k)
+        play(target, target.get_observations(), 29, seed + snapshots + k)
+
+        start = time.perf_counter()
+        state = source.get_state()
+        get_time += time.perf_counter() - start
+        start = time.perf_counter()
+        target.set_state(state)
+        set_time += time.perf_counter() - start
+
+        source_trajectory, observations = play(source, observations, steps, seed + k)
+        target_trajectory, _ = play(target, target.get_observations(), steps, seed + k)
+        mismatches += not np.array_equal(source_trajectory, target_trajectory)
+    source.close()
+    target.close()
+    return {
+        "get_state_latency_us": 1e6 * get_time / snapshots,
+        "set_state_latency_us": 1e6 * set_time / snapshots,
+        "state_bytes": state.nbytes,
+        "snapshots": snapshots,
+        "mismatched_trajectories": mismatches,
+    }
+
+
+def benchmark_startup(render_mode, repeats=5):
+    """Median latency of importing soccer.py, constructing a Soccer and its first reset
+
+    Every repeat runs in a new interpreter, like a freshly spawned worker process.
+    process_ms is the wall time of the whole process, including interpreter startup.
+    """
+    environment = dict(os.environ, PYTHONPATH=os.pathsep.join(path for path in sys.path if path))
+    environment.setdefault("SDL_VIDEODRIVER", "dummy")
+    runs = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT.format(render_mode=render_mode)],
+                                capture_output=True, text=True, check=True, env=environment).stdout
+        process_ms = 1e3 * (time.perf_counter() - start)
+        runs.append({**json.loads(output.strip().splitlines()[-1]), "process_ms": process_ms})
+    result = {key: float(np.median([run[key] for run in runs])) for key in ["import_ms", "construct_ms", "first_reset_ms", "process_ms"]}
+    result["pygame_imported"] = runs[0]["pygame_imported"]
+    return result
+
+
+class CountingContactListener(SoccerContactListener):
+    """SoccerContactListener counting the calls Box2D makes into Python"""
+    def __init__(self, env):
+        super().__init__(env)
+        self.calls = 0
+
+    def BeginContact(self, contact):
+        self.calls += 1
+        super().BeginContact(contact)
+
+    def EndContact(self, contact):
+        self.calls += 1
+        super().EndContact(contact)
+
+    def PreSolve(self, contact, oldManifold):
+        self.calls += 1
+
+    def PostSolve(self, contact, impulse):
+        self.calls += 1
+
+
+def benchmark_contacts(steps, reward_specification, seed=0):
+    """Physics step latency and Python contact callbacks per step for both touch detections
+
+    Three envs play the same actions in lockstep: one per touch detection for the timing and
+    one with a CountingContactListener. toucher_mismatches counts the steps on which the touch
+    detections disagree on ball_toucher.
+    """
+    touch_detections = ["callback", "scan"]
+    envs = [Soccer(reward_specification=reward_specification, episode_statistics=False, touch_detection=touch_detection)
+            for touch_detection in touch_detections + ["callback"]]
+    counting_env = envs[-1]
+    counting_env.contact_listener = CountingContactListener(counting_env)
+    counting_env.world.contactListener = counting_env.contact_listener
+    rng = np.random.default_rng(seed)
+    for env in envs[1:]:
+        env.reset(seed=seed)
+    observations, _ = envs[0].reset(seed=seed)
+    physics_times = np.zeros(len(touch_detections))
+    mismatches = 0
+    for _ in range(steps):
+        actions = chase_ball_policy(observations, rng)
+        for k, env in enumerate(envs):
+            env.begin_step(actions)
+            start = time.perf_counter()
+            env.world.Step(1.0/FPS, env.velocity_iterations, env.position_iterations)
+            if env.contact_listener is None:
+                env.register_box2d_touches()
+            if k < len(touch_detections):
+                physics_times[k] += time.perf_counter() - start
+        mismatches += envs[0].ball_toucher != envs[1].ball_toucher
+        for env in envs[1:]:
+            env.end_step()
+        goal_scored = envs[0].end_step()
+        observations = envs[0].get_observations()
+        if goal_scored >= 0 or envs[0].step_count >= envs[0].max_steps:
+            for env in envs[1:]:
+                env.reset()
+            observations, _ = envs[0].reset()
+    for env in envs:
+        env.close()
+    result = {f"{touch_detection}_physics_latency_us": 1e6 * physics_times[k] / steps
+              for k, touch_detection in enumerate(touch_detections)}
+    result["callback_calls_per_step"] = counting_env.contact_listener.calls / steps
+    result["toucher_mismatches"] = int(mismatches)
+    return result
+
+
+def play_physics_profile(physics_profile, steps, reward_specification, seed):
+    """Play steps with the scripted policy, returning the elapsed seconds, goals, touch steps and ball speeds"""
+    env = Soccer(reward_specification=reward_specification, episode_statistics=False, physics_profile=physics_profile)
+    rng = np.random.default_rng(seed)
+    ball_speeds = np.zeros(steps)
+    goals = touches = 0
+    observations, _ = env.reset(seed=seed)
+    start = time.perf_counter()
+    for t in range(steps):
+        observations, _, terminated, truncated, _ = env.step(chase_ball_policy(observations, rng))
+        ball_speeds[t] = np.hypot(*env.body_states[-1, 2:])
+        touches += env.ball_toucher is not None
+        goals += bool(terminated)
+        if terminated or truncated:
+            observations, _ = env.reset()
+    elapsed = time.perf_counter() - start
+    env.close()
+    return elapsed, goals, touches, ball_speeds
+
+
+def benchmark_physics_profiles(steps, reward_specification, physics_profiles, seed=0, num_seeds=4):
+    """Steps/sec of every physics profile and the drift of its play from the default profile
+
+    Every profile plays the same seeds with the same scripted policy. Play diverges after the
+    first collisions, so the drift compares statistics rather than trajectories: goals and
+    touching steps per 1000 steps and the Kolmogorov-Smirnov distance of the ball speed
+    distribution to the one of the default profile.
+    """
+    played = {}
+    for physics_profile in dict.fromkeys(["default", *physics_profiles]):
+        runs = [play_physics_profile(physics_profile, steps, reward_specification, seed + k) for k in range(num_seeds)]
+        played[physics_profile] = (sum(run[0] for run in runs), sum(run[1] for run in runs), sum(run[2] for run in runs),
+                                   np.sort(np.concatenate([run[3] for run in runs])))
+    total_steps = steps * num_seeds
+    _, default_goals, default_touches, default_speeds = played["default"]
+    results = []
+    for physics_profile in physics_profiles:
+        elapsed, goals, touches, ball_speeds = played[physics_profile]
+        # Largest difference of the empirical distribution functions, evaluated at all samples
+        samples = np.concatenate([ball_speeds, default_speeds])
+        ball_speed_ks = np.abs(np.searchsorted(ball_speeds, samples, side="right")
+                               - np.searchsorted(default_speeds, samples, side="right")).max() / total_steps
+        results.append({
+            "physics_profile": physics_profile,
+            **PHYSICS_PROFILES[physics_profile],
+            "steps_per_second": total_steps / elapsed,
+            "goals_per_1000_steps": 1000 * goals / total_steps,
+            "touches_per_1000_steps": 1000 * touches / total_steps,
+            "ball_speed_percentiles": dict(zip(["p10", "p50", "p90", "p99"], np.percentile(ball_speeds, [10, 50, 90, 99]).tolist())),
+            "ball_speed_mean": float(ball_speeds.mean()),
+            "goal_rate_drift": 1000 * (goals - default_goals) / total_steps,
+            "touch_rate_drift": 1000 * (touches - default_touches) / total_steps,
+            "ball_speed_ks": float(ball_speed_ks),
+        })
+    return results
+
+
+def get_git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Soccer step throughput")
+    parser.add_argument("--configs", type=str, nargs="+", default=["single", "vector", "multiprocess"],
+                        choices=["single", "vector", "multiprocess", "snapshot", "startup", "contacts", "profiles"])
+    parser.add_argument("--reward-specs", type=str, nargs="+", default=list(REWARD_SPECIFICATIONS),
+                        choices=list(REWARD_SPECIFICATIONS))
+    parser.add_argument("--steps", type=int, default=2000, help="Steps per measurement (vector steps for batched configs)")
+    parser.add_argument("--num-envs", type=int, default=16, help="Envs of the vectorized config")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Workers of the multiprocess config")
+    parser.add_argument("--envs-per-worker", type=int, default=4)
+    parser.add_argument("--physics-backend", type=str, default="box2d", choices=["box2d", "numpy"])
+    parser.add_argument("--team-sizes", type=int, nargs="+", default=[2],
+                        help="Players per team to measure the single, vector and multiprocess configs with, e.g. 2 3 5")
+    parser.add_argument("--physics-profiles", type=str, nargs="+", default=list(PHYSICS_PROFILES), choices=list(PHYSICS_PROFILES),
+                        help="Physics profiles of the profiles config, compared with the default profile")
+    parser.add_argument("--action-repeat", type=int, default=1, help="Frames per step of the single, vector and multiprocess configs")
+    parser.add_argument("--physics-substeps", type=int, default=1, help="Physics steps per frame of the single, vector and multiprocess configs")
+    parser.add_argument("--render", action="store_true", help="Also measure the single env with rendering")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default=None, help="Path of the JSON results, printed if not given")
+    args = parser.parse_args()
+
+    if args.render:
+        os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+    frame_settings = {"action_repeat": args.action_repeat, "physics_substeps": args.physics_substeps}
+    results = []
+    if "startup" in args.configs:
+        for render_mode in STARTUP_RENDER_MODES:
+            result = {"config": "startup", "render_mode": render_mode, **benchmark_startup(render_mode)}
+            print(f"{'startup':>12} render_mode={render_mode!s:18} import={result['import_ms']:.0f}ms "
+                  f"construct={result['construct_ms']:.1f}ms first_reset={result['first_reset_ms']:.2f}ms "
+                  f"process={result['process_ms']:.0f}ms pygame={result['pygame_imported']}")
+            results.append(result)
+    for spec_name in args.reward_specs:
+        reward_specification = REWARD_SPECIFICATIONS[spec_name]
+        spec_results = []
+        for team_size in args.team_sizes:
+            if "single" in args.configs:
+                for render in ([False, True] if args.render else [False]):
+                    result = benchmark_single(args.steps, reward_specification, render, args.physics_backend, args.seed, team_size,
+                                              args.action_repeat, args.physics_substeps)
+                    spec_results.append({"config": "single", "render": render, "physics_backend": args.physics_backend,
+                                         "team_size": team_size, **frame_settings, **result})
+            if "vector" in args.configs:
+                result = benchmark_vector(args.steps, reward_specification, args.num_envs, args.physics_backend, args.seed, team_size,
+                                          args.action_repeat, args.physics_substeps)
+                spec_results.append({"config": "vector", "num_envs": args.num_envs, "physics_backend": args.physics_backend,
+                                     "team_size": team_size, **frame_settings, **result})
+            if "multiprocess" in args.configs:
+                result = benchmark_multiprocess(args.steps, reward_specification, args.workers, args.envs_per_worker, args.seed, team_size,
+                                                args.action_repeat, args.physics_substeps)
+                spec_results.append({"config": "multiprocess", "workers": args.workers, "envs_per_worker": args.envs_per_worker,
+                                     "team_size": team_size, **frame_settings, **result})
+        if "snapshot" in args.configs:
+            result = benchmark_snapshot(min(args.steps, 300), reward_specification, args.physics_backend, args.seed)
+            spec_results.append({"config": "snapshot", "physics_backend": args.physics_backend, **result})
+        if "contacts" in args.configs:
+            result = benchmark_contacts(args.steps, reward_specification, args.seed)
+            spec_results.append({"config": "contacts", **result})
+        if "profiles" in args.configs:
+            for result in benchmark_physics_profiles(args.steps, reward_specification, args.physics_profiles, args.seed):
+                spec_results.append({"config": "profiles", **result})
+        for result in spec_results:
+            result["reward_spec"] = spec_name
+            if result["config"] == "snapshot":
+                print(f"{'snapshot':>12} {spec_name:>10} get_state={result['get_state_latency_us']:.0f}us "
+                      f"set_state={result['set_state_latency_us']:.0f}us mismatches={result['mismatched_trajectories']}")
+                continue
+            if result["config"] == "contacts":
+                print(f"{'contacts':>12} {spec_name:>10} callback={result['callback_physics_latency_us']:.1f}us "
+                      f"({result['callback_calls_per_step']:.1f} calls/step) scan={result['scan_physics_latency_us']:.1f}us "
+                      f"(0 calls/step) toucher_mismatches={result['toucher_mismatches']}")
+                continue
+            if result["config"] == "profiles":
+                print(f"{'profiles':>12} {spec_name:>10} {result['physics_profile']:>8} steps/sec={result['steps_per_second']:.0f} "
+                      f"goals/1000={result['goals_per_1000_steps']:.2f} ({result['goal_rate_drift']:+.2f}) "
+                      f"touches/1000={result['touches_per_1000_steps']:.1f} ({result['touch_rate_drift']:+.1f}) "
+                      f"ball_speed_p50={result['ball_speed_percentiles']['p50']:.2f} ks={result['ball_speed_ks']:.3f}")
+                continue
+            print(f"{result['config']:>12} {spec_name:>10} render={result.get('render', False)!s:5} "
+                  f"team_size={result['team_size']} steps/sec={result['steps_per_second']:.0f}")
+        results.extend(spec_results)
+
+    report = {
+        "git_commit": get_git_commit(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "steps": args.steps,
+        "results": results,
+    }
+    if args.output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
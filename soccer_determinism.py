@@ -0,0 +1,184 @@
+# Determinism check for the Soccer Environment
+#
+# Plays the same seeded rollouts with single Soccer envs, one SoccerVecEnv and
+# SoccerProcessPools of different worker counts, all in deterministic mode, and hashes the
+# observations, rewards and done flags of every env. All configurations must give the same
+# hashes. The NumPy physics backend with physics substeps and every reward term is compared
+# between single envs and a SoccerVecEnv the same way. It also checks that get_state does not
+# change a rollout and that envs restored by set_state continue like the untouched original,
+# which only holds for the NumPy backend, Box2D divergences are reported as known. The process
+# exits with status 1 if any other check fails, so it can run as a regression check.
+#
+#   python soccer_determinism.py --num-envs 8 --workers 1 2 4 --steps 2000
+
+import argparse
+import copy
+import hashlib
+import sys
+
+import numpy as np
+
+from ppo.environments.soccer import Soccer, DEFAULT_REWARD_SPECIFICATION, chase_ball_policy, derive_seed
+from ppo.environments.soccer_rewards import REWARD_TERMS
+
+# Every reward term, so a term computed differently by Soccer and SoccerVecEnv changes the hashes
+ALL_TERMS_SPECIFICATION = {name: 1.0 for name in REWARD_TERMS}
+
+
+def get_policy_rngs(seed, num_envs):
+    """One action RNG per env, so the actions of an env do not depend on how the envs are batched"""
+    # spawn_key (i, 1) keeps the action streams apart from the env seeds derive_seed(seed, i)
+    return [np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(i, 1))) for i in range(num_envs)]
+
+
+def update_hash(digest, observations, rewards, terminated, truncated):
+    digest.update(np.ascontiguousarray(observations, dtype=np.float32).tobytes())
+    digest.update(np.ascontiguousarray(rewards, dtype=np.float64).tobytes())
+    digest.update(bytes([bool(terminated), bool(truncated)]))
+
+
+def hash_single_rollouts(num_envs, steps, seed, reward_specification=DEFAULT_REWARD_SPECIFICATION, team_size=2, **env_kwargs):
+    """SHA-256 of the rollout of every env, each played by its own Soccer env, env_kwargs are passed to Soccer"""
+    rngs = get_policy_rngs(seed, num_envs)
+    hashes = []
+    for i in range(num_envs):
+        env = Soccer(seed=derive_seed(seed, i), reward_specification=reward_specification, episode_statistics=False,
+                     team_size=team_size, deterministic=True, **env_kwargs)
+        digest = hashlib.sha256()
+        observations, _ = env.reset(seed=derive_seed(seed, i))
+        for _ in range(steps):
+            actions = chase_ball_policy(observations, rngs[i])
+            observations, reward, terminated, truncated, info = env.step(actions)
+            rewards = np.concatenate([[reward], info["other_reward"]])
+            if terminated or truncated:
+                # Like the same step autoreset of the vector envs
+                observations, _ = env.reset()
+            update_hash(digest, observations, rewards, terminated, truncated)
+        env.close()
+        hashes.append(digest.hexdigest())
+    return hashes
+
+
+def hash_vector_rollouts(env, steps, seed):
+    """SHA-256 of the rollout of every env of a SoccerVecEnv or SoccerProcessPool"""
+    rngs = get_policy_rngs(seed, env.num_envs)
+    digests = [hashlib.sha256() for _ in range(env.num_envs)]
+    observations, _ = env.reset(seed=seed)
+    for _ in range(steps):
+        actions = np.stack([chase_ball_policy(observations[i], rngs[i]) for i in range(env.num_envs)])
+        observations, rewards, terminated, truncated, _ = env.step(actions)
+        for i, digest in enumerate(digests):
+            update_hash(digest, observations[i], rewards[i], terminated[i], truncated[i])
+    env.close()
+    return [digest.hexdigest() for digest in digests]
+
+
+def play_step(env, observations, rng):
+    """One step of the scripted policy with the same step autoreset, returning the new observations and the step record"""
+    observations, reward, terminated, truncated, info = env.step(chase_ball_policy(observations, rng))
+    record = np.concatenate([observations.ravel(), [reward], info["other_reward"], [terminated, truncated]])
+    if terminated or truncated:
+        observations, _ = env.reset()
+    return observations, record
+
+
+def check_snapshots(steps, seed, physics_backend="box2d", team_size=2, interval=25):
+    """Count the changes caused by snapshots, returned as (snapshotted steps, diverged snapshots, snapshots)
+
+    snapshotted: the steps on which an env whose state is captured every interval steps differs
+    from one left alone. diverged: the snapshots after which a copy with its own history, restored
+    from the untouched source, differs from the source within the next interval steps of the
+    same actions. Box2D copies are known to diverge, see Soccer.get_state.
+    """
+    envs = [Soccer(seed=seed, physics_backend=physics_backend, team_size=team_size, episode_statistics=False)
+            for _ in range(4)]
+    plain, snapshotted, source, target = envs
+    observations = [env.reset(seed=seed)[0] for env in envs[:3]]
+    target.reset(seed=seed + 1)
+    rngs = [np.random.default_rng(seed) for _ in range(3)]
+    snapshot_mismatches = diverged = snapshots = 0
+    for t in range(steps):
+        if t % interval == 0:
+            snapshotted.get_state()
+            target.set_state(source.get_state())
+            target_observations = target.get_observations()
+            target_rng = copy.deepcopy(rngs[2])
+            snapshots += 1
+            branch_diverged = False
+        records = []
+        for i, env in enumerate(envs[:3]):
+            observations[i], record = play_step(env, observations[i], rngs[i])
+            records.append(record)
+        target_observations, target_record = play_step(target, target_observations, target_rng)
+        snapshot_mismatches += not np.array_equal(records[0], records[1])
+        if not branch_diverged and not np.array_equal(records[2], target_record):
+            branch_diverged = True
+            diverged += 1
+    for env in envs:
+        env.close()
+    return snapshot_mismatches, diverged, snapshots
+
+
+def compare_hashes(results, reference_name):
+    """Print the combined hash of every configuration, returning the number of envs that differ from the reference"""
+    reference = results[reference_name]
+    mismatches = 0
+    for name, hashes in results.items():
+        different = [i for i in range(len(reference)) if hashes[i] != reference[i]]
+        mismatches += len(different)
+        combined = hashlib.sha256("".join(hashes).encode()).hexdigest()
+        print(f"{name:>16} {combined[:16]} {'ok' if not different else f'envs {different} differ'}")
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that seeded Soccer rollouts are identical across env configurations")
+    parser.add_argument("--num-envs", type=int, default=8, help="Envs of every configuration")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4],
+                        help="Worker counts of the SoccerProcessPool configurations, must divide --num-envs")
+    parser.add_argument("--steps", type=int, default=2000, help="Steps per env")
+    parser.add_argument("--team-size", type=int, default=2)
+    parser.add_argument("--seed", type=int, default=0, help="Root seed the env seeds are derived from")
+    parser.add_argument("--context", type=str, default=None, help="multiprocessing start method")
+    parser.add_argument("--snapshot-steps", type=int, default=1000, help="Steps of the get_state/set_state checks")
+    parser.add_argument("--physics-substeps", type=int, default=2, help="Physics substeps of the NumPy backend configurations")
+    args = parser.parse_args()
+
+    from ppo.environments.soccer_vec_env import SoccerVecEnv
+    from ppo.environments.soccer_pool import SoccerProcessPool
+
+    results = {"single": hash_single_rollouts(args.num_envs, args.steps, args.seed, team_size=args.team_size)}
+    vector_env = SoccerVecEnv(args.num_envs, seed=args.seed, copy=False, episode_statistics=False,
+                              team_size=args.team_size, deterministic=True)
+    results["vector"] = hash_vector_rollouts(vector_env, args.steps, args.seed)
+    for num_workers in args.workers:
+        if args.num_envs % num_workers != 0:
+            parser.error(f"{num_workers} workers do not divide {args.num_envs} envs")
+        pool = SoccerProcessPool(num_workers, args.num_envs // num_workers, seed=args.seed, context=args.context,
+                                 copy=False, team_size=args.team_size, deterministic=True)
+        results[f"multiprocess-{num_workers}"] = hash_vector_rollouts(pool, args.steps, args.seed)
+
+    mismatches = compare_hashes(results, "single")
+
+    numpy_kwargs = dict(physics_backend="numpy", physics_substeps=args.physics_substeps)
+    results = {"numpy-single": hash_single_rollouts(args.num_envs, args.steps, args.seed, ALL_TERMS_SPECIFICATION,
+                                                    args.team_size, **numpy_kwargs)}
+    vector_env = SoccerVecEnv(args.num_envs, reward_specification=ALL_TERMS_SPECIFICATION, seed=args.seed, copy=False,
+                              episode_statistics=False, team_size=args.team_size, deterministic=True, **numpy_kwargs)
+    results["numpy-vector"] = hash_vector_rollouts(vector_env, args.steps, args.seed)
+    mismatches += compare_hashes(results, "numpy-single")
+
+    for physics_backend in ["box2d", "numpy"]:
+        snapshotted, diverged, snapshots = check_snapshots(args.snapshot_steps, args.seed, physics_backend, args.team_size)
+        # A restored Box2D world lacks the contact history of the source, its copies are reported but do not fail
+        known = physics_backend == "box2d"
+        mismatches += snapshotted + (0 if known else diverged)
+        restored = "ok" if not diverged else f"{diverged} of {snapshots} copies diverge" + (" (known)" if known else "")
+        print(f"{'snapshot-' + physics_backend:>16} snapshotted {'ok' if not snapshotted else f'{snapshotted} steps differ'}, "
+              f"restored {restored}")
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+# Actor export pipeline for the Soccer Environment
+#
+# Exports a torch actor checkpoint to ONNX with a dynamic batch dimension and derives
+# optimized, fp16 and int8 variants from it. Every variant is checked for parity with the
+# source model on observations the source actor itself meets in Soccer, and its CPU latency
+# is measured per batch size. An .onnx source, like the models shipped with the web app, is
+# re-exported with a dynamic batch dimension and checked the same way. The process exits
+# with status 1 if a variant fails its parity check.
+#
+#   python soccer_export.py actor.pth --output-dir exported --variants fp32 optimized int8 --batch-sizes 1 8 64 256
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+from ppo.environments.soccer import Soccer
+from ppo.environments.soccer_actors import OnnxActor, TorchActor, get_actor_backend, load_actor, load_onnx_model, sample_actions
+
+VARIANTS = ["fp32", "optimized", "fp16", "int8"]
+
+# Variants that must reproduce the logits of the source model up to float rounding,
+# the others are lossy and only need to agree on the most likely action
+EXACT_VARIANTS = ["fp32", "optimized"]
+
+
+def export_onnx(model_path, output_path, observation_size=20, opset=17):
+    """Export a torch actor to ONNX with float32 observations (batch, observation_size) and logits (batch, 9)
+
+    .onnx sources are written with their batch dimension made dynamic, see load_onnx_model.
+    """
+    if get_actor_backend(model_path) == "onnx":
+        model = load_onnx_model(model_path)
+        if isinstance(model, str):
+            raise RuntimeError("Re-exporting an ONNX model requires the onnx package")
+        Path(output_path).write_bytes(model)
+        return
+    import torch
+    actor = TorchActor(model_path).actor
+    torch.onnx.export(actor, (torch.zeros(1, observation_size),), str(output_path), opset_version=opset,
+                      input_names=["observations"], output_names=["logits"],
+                      dynamic_axes={"observations": {0: "batch"}, "logits": {0: "batch"}})
+
+
+def optimize_onnx(input_path, output_path, level="basic"):
+    """Save the graph after onnxruntime's graph optimizations
+
+    "basic" only folds constants and removes redundant nodes, so the model still runs in
+    onnxruntime-web. "extended" also fuses nodes into onnxruntime specific operators.
+    """
+    import onnxruntime
+    options = onnxruntime.SessionOptions()
+    options.graph_optimization_level = {
+        "basic": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+        "extended": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    }[level]
+    options.optimized_model_filepath = str(output_path)
+    onnxruntime.InferenceSession(str(input_path), options, providers=["CPUExecutionProvider"])
+
+
+def quantize_int8(input_path, output_path):
+    """Dynamic int8 quantization of the weights, activations are quantized at run time"""
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    quantize_dynamic(str(input_path), str(output_path), weight_type=QuantType.QInt8)
+
+
+def convert_fp16(input_path, output_path):
+    """Store weights and compute in float16, keeping float32 observations and logits"""
+    import onnx
+    from onnxconverter_common import float16
+    model = float16.convert_float_to_float16(onnx.load(str(input_path)), keep_io_types=True)
+    onnx.save(model, str(output_path))
+
+
+def sample_observations(actor, num_observations, seed=0, team_size=2):
+    """Observations of all players of Soccer matches in which every player is controlled by actor"""
+    env = Soccer(episode_statistics=False, team_size=team_size)
+    rng = np.random.default_rng(seed)
+    samples = []
+    observations, _ = env.reset(seed=seed)
+    while len(samples) * env.num_agents < num_observations:
+        samples.append(observations)
+        actions = sample_actions(actor(np.ascontiguousarray(observations, dtype=np.float32)), rng)
+        observations, _, terminated, truncated, _ = env.step(actions)
+        if terminated or truncated:
+            observations, _ = env.reset()
+    env.close()
+    return np.concatenate(samples)[:num_observations].astype(np.float32)
+
+
+def check_parity(reference_logits, logits):
+    """Largest logit and action probability errors and the fraction of rows with the same argmax"""
+    def softmax(x):
+        exponentials = np.exp(x - x.max(axis=1, keepdims=True))
+        return exponentials / exponentials.sum(axis=1, keepdims=True)
+    reference_logits = np.asarray(reference_logits, dtype=np.float64)
+    logits = np.asarray(logits, dtype=np.float64)
+    return {
+        "max_logit_error": float(np.abs(logits - reference_logits).max()),
+        "max_probability_error": float(np.abs(softmax(logits) - softmax(reference_logits)).max()),
+        "argmax_agreement": float((logits.argmax(axis=1) == reference_logits.argmax(axis=1)).mean()),
+    }
+
+
+def measure_latency(actor, observations, batch_sizes, repeats=200):
+    """Median latency in microseconds of one forward pass per batch size"""
+    latencies = {}
+    for batch_size in batch_sizes:
+        batch = np.ascontiguousarray(np.resize(observations, (batch_size, observations.shape[1])))
+        actor(batch)
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            actor(batch)
+            times.append(time.perf_counter() - start)
+        latencies[batch_size] = 1e6 * float(np.median(times))
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export an actor to ONNX variants and check their parity and latency")
+    parser.add_argument("model", type=str, help="Actor checkpoint saved with torch.save(model), or an .onnx model")
+    parser.add_argument("--output-dir", type=str, default="exported", help="Directory of the exported variants")
+    parser.add_argument("--variants", type=str, nargs="+", default=["fp32", "optimized", "int8"], choices=VARIANTS,
+                        help="fp16 requires the onnxconverter-common package")
+    parser.add_argument("--optimization-level", type=str, default="basic", choices=["basic", "extended"],
+                        help="Graph optimizations of the optimized variant, extended models may not run in onnxruntime-web")
+    parser.add_argument("--opset", type=int, default=17)
+    parser.add_argument("--team-size", type=int, default=2, help="Players per team of the matches the observations are sampled from")
+    parser.add_argument("--num-observations", type=int, default=4096, help="Sampled observations of the parity check")
+    parser.add_argument("--atol", type=float, default=1e-4, help="Largest logit error of the fp32 and optimized variants")
+    parser.add_argument("--min-agreement", type=float, default=0.95,
+                        help="Smallest argmax agreement of the lossy fp16 and int8 variants")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 64, 256])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    stem = Path(args.model).stem
+    paths = {variant: output_dir / f"{stem}_{variant}.onnx" for variant in VARIANTS}
+    observation_size = 4 * (2 * args.team_size + 1)
+
+    export_onnx(args.model, paths["fp32"], observation_size, args.opset)
+    converters = {
+        "optimized": lambda source, path: optimize_onnx(source, path, args.optimization_level),
+        "fp16": convert_fp16,
+        "int8": quantize_int8,
+    }
+    variants = []
+    for variant in args.variants:
+        if variant == "fp32":
+            variants.append(variant)
+            continue
+        try:
+            converters[variant](paths["fp32"], paths[variant])
+            variants.append(variant)
+        except ImportError as e:
+            print(f"Skipping {variant}: {e}")
+
+    reference = load_actor(args.model)
+    observations = sample_observations(reference, args.num_observations, args.seed, args.team_size)
+    reference_logits = reference(observations)
+
+    failed = False
+    print(f"{'variant':<10} {'size':>8} {'logit err':>10} {'prob err':>10} {'argmax':>8} "
+          + " ".join(f"{f'b={batch_size}':>9}" for batch_size in args.batch_sizes) + "  (us per batch)")
+    for name, actor, size in [("source", reference, Path(args.model).stat().st_size)] + [
+            (variant, OnnxActor(paths[variant]), paths[variant].stat().st_size) for variant in variants]:
+        parity = check_parity(reference_logits, actor(observations))
+        if name in EXACT_VARIANTS:
+            passed = parity["max_logit_error"] <= args.atol
+        else:
+            passed = parity["argmax_agreement"] >= args.min_agreement
+        failed |= not passed
+        latencies = measure_latency(actor, observations, args.batch_sizes)
+        print(f"{name:<10} {size / 1024:7.1f}K {parity['max_logit_error']:10.2e} {parity['max_probability_error']:10.2e} "
+              f"{parity['argmax_agreement']:8.4f} " + " ".join(f"{latencies[batch_size]:9.1f}" for batch_size in args.batch_sizes)
+              + ("" if passed else "  FAILED"))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,299 @@
+# Centralized batched inference for Soccer rollout workers
+#
+# Rollout processes that evaluate their own copy of the actor spend most of every forward
+# pass on framework overhead, as their batches only hold the players of a few matches. An
+# InferenceServer process evaluates one actor for many client processes instead. Clients
+# write their observations into shared memory and send a tiny request through a pipe. The
+# server gathers requests until max_batch_size rows are waiting, every client is waiting or
+# the oldest request is max_delay seconds old, runs one forward pass and writes the sampled
+# actions and their log-probabilities back into shared memory.
+#
+#   python soccer_inference.py public/models/actor1.onnx --workers 4 --envs-per-worker 2 --steps 2000
+
+import argparse
+import multiprocessing as mp
+import os
+import time
+import traceback
+from multiprocessing.connection import wait
+
+import numpy as np
+
+from ppo.environments.soccer_actors import load_actor, sample_actions, get_log_probs
+from ppo.environments.soccer_pool import SharedBuffers
+
+
+class InferenceClient:
+    """One client slot of an InferenceServer, handed to a rollout process and used there
+
+    The shared memory is attached on the first request, so the client can be passed to a
+    process before it is used.
+    """
+    def __init__(self, buffer_specs, client_index, connection):
+        self.buffer_specs = buffer_specs
+        self.client_index = client_index
+        self.connection = connection
+        self.buffers = None
+
+    def infer(self, observations):
+        """Sampled actions (N,) and their log-probabilities (N,) for float32 observations (N, observation_size)"""
+        if self.buffers is None:
+            self.buffers = SharedBuffers.attach(self.buffer_specs)
+        num_rows = len(observations)
+        self.buffers["observations"][self.client_index, :num_rows] = observations
+        self.connection.send(("infer", num_rows))
+        try:
+            status, data = self.connection.recv()
+        except (EOFError, ConnectionError):
+            raise RuntimeError("Inference server closed the connection")
+        if status == "error":
+            raise RuntimeError(f"Inference server raised an exception:\n{data}")
+        return (self.buffers["actions"][self.client_index, :num_rows].copy(),
+                self.buffers["log_probs"][self.client_index, :num_rows].copy())
+
+    def close(self):
+        """Detach from the server, which stops waiting for requests of this client"""
+        if self.buffers is not None:
+            self.buffers.close()
+            self.buffers = None
+        try:
+            self.connection.send(("close", None))
+        except (BrokenPipeError, ConnectionError, OSError):
+            pass
+        self.connection.close()
+
+
+def server_loop(model_path, backend, buffer_specs, connections, control_connection, max_batch_size, max_delay, seed):
+    """Load the actor and answer the requests of the clients in batches until the control connection closes"""
+    buffers = SharedBuffers.attach(buffer_specs)
+    observations = buffers["observations"]
+    actions = buffers["actions"]
+    log_probs = buffers["log_probs"]
+    queue_depth = buffers["queue_depth"]
+    batch_sizes = buffers["batch_sizes"]
+    latencies = buffers["latencies"]
+    latency_count = buffers["latency_count"]
+    clients = {connection: client_index for client_index, connection in enumerate(connections)}
+    pending = [] # (client index, rows, arrival time) of the requests waiting for the next batch
+    try:
+        actor = load_actor(model_path, backend)
+        rng = np.random.default_rng(seed)
+        control_connection.send(("ok", None))
+        while True:
+            timeout = None if not pending else max(0.0, pending[0][2] + max_delay - time.perf_counter())
+            ready = wait(list(clients) + [control_connection], timeout)
+            if control_connection in ready:
+                break
+            for connection in ready:
+                try:
+                    command, num_rows = connection.recv()
+                except (EOFError, ConnectionError):
+                    command = "close"
+                if command == "close":
+                    # The client is done or its process exited
+                    del clients[connection]
+                    continue
+                pending.append((clients[connection], num_rows, time.perf_counter()))
+            pending_rows = sum(num_rows for _, num_rows, _ in pending)
+            queue_depth[0] = pending_rows
+            if not pending or (pending_rows < max_batch_size and len(pending) < len(clients)
+                               and time.perf_counter() < pending[0][2] + max_delay):
+                continue
+
+            batch = np.concatenate([observations[client_index, :num_rows] for client_index, num_rows, _ in pending])
+            logits = actor(batch)
+            batch_actions = sample_actions(logits, rng)
+            batch_log_probs = get_log_probs(logits, batch_actions)
+            start = 0
+            for client_index, num_rows, _ in pending:
+                actions[client_index, :num_rows] = batch_actions[start:start + num_rows]
+                log_probs[client_index, :num_rows] = batch_log_probs[start:start + num_rows]
+                start += num_rows
+            batch_sizes[len(batch)] += 1
+            queue_depth[0] = 0
+            end_time = time.perf_counter()
+            for client_index, _, arrival_time in pending:
+                latencies[latency_count[0] % len(latencies)] = end_time - arrival_time
+                latency_count[0] += 1
+                try:
+                    connections[client_index].send(("ok", None))
+                except (BrokenPipeError, ConnectionError):
+                    pass
+            pending = []
+    except KeyboardInterrupt:
+        pass
+    except Exception:
+        error = traceback.format_exc()
+        for connection in [control_connection] + [connections[client_index] for client_index, _, _ in pending]:
+            try:
+                connection.send(("error", error))
+            except (BrokenPipeError, ConnectionError):
+                pass
+    finally:
+        del observations, actions, log_probs, queue_depth, batch_sizes, latencies, latency_count
+        buffers.close()
+        for connection in connections:
+            connection.close()
+        control_connection.close()
+
+
+class InferenceServer:
+    """Process evaluating one actor for num_clients rollout processes in dynamic batches
+
+    Args:
+        model_path: actor checkpoint (.onnx or .pth), see soccer_actors.load_actor
+        num_clients: client slots, get_client(i) returns the handle of slot i
+        max_rows_per_client: most observations one request may hold, e.g. envs per worker * num_agents
+        max_batch_size: rows at which a batch is evaluated without waiting for more requests
+        max_delay: seconds the oldest request of a batch waits for more requests at most
+        latency_window: latest requests whose latencies get_statistics reports percentiles of
+
+    A batch is also evaluated as soon as every connected client is waiting, as no more
+    requests can arrive then. Latencies are measured from the arrival of a request at the
+    server to its reply.
+    """
+    def __init__(self, model_path, num_clients, max_rows_per_client, observation_size=20, backend="auto",
+                 max_batch_size=256, max_delay=0.002, seed=0, context=None, latency_window=10000):
+        self.num_clients = num_clients
+        self.max_rows_per_client = max_rows_per_client
+        self.context = mp.get_context(context)
+        self.buffers = SharedBuffers.create({
+            "observations": ((num_clients, max_rows_per_client, observation_size), np.float32),
+            "actions": ((num_clients, max_rows_per_client), np.int64),
+            "log_probs": ((num_clients, max_rows_per_client), np.float64),
+            "queue_depth": ((1,), np.int64),
+            "batch_sizes": ((num_clients * max_rows_per_client + 1,), np.int64),
+            "latencies": ((latency_window,), np.float64),
+            "latency_count": ((1,), np.int64),
+        })
+
+        server_connections, self.client_connections = zip(*[self.context.Pipe() for _ in range(num_clients)])
+        self.control_connection, child_control_connection = self.context.Pipe()
+        self.process = self.context.Process(
+            target=server_loop,
+            args=(model_path, backend, self.buffers.specs, server_connections, child_control_connection,
+                  max_batch_size, max_delay, seed),
+            daemon=True,
+        )
+        self.process.start()
+        for connection in server_connections:
+            connection.close()
+        child_control_connection.close()
+        status, data = self.control_connection.recv()
+        if status == "error":
+            self.close()
+            raise RuntimeError(f"Inference server failed to start:\n{data}")
+
+    def get_client(self, client_index):
+        return InferenceClient(self.buffers.specs, client_index, self.client_connections[client_index])
+
+    def get_statistics(self):
+        """Current queue depth in rows, histogram of evaluated batch sizes and p50/p99 request latency"""
+        batch_sizes = self.buffers["batch_sizes"].copy()
+        latency_count = int(self.buffers["latency_count"][0])
+        latencies = self.buffers["latencies"][:min(latency_count, len(self.buffers["latencies"]))]
+        batches = int(batch_sizes.sum())
+        return {
+            "queue_depth": int(self.buffers["queue_depth"][0]),
+            "requests": latency_count,
+            "batches": batches,
+            "mean_batch_size": float(np.arange(len(batch_sizes)) @ batch_sizes / batches) if batches else 0.0,
+            "batch_size_histogram": {int(size): int(batch_sizes[size]) for size in np.flatnonzero(batch_sizes)},
+            "latency_p50_us": 1e6 * float(np.percentile(latencies, 50)) if len(latencies) else 0.0,
+            "latency_p99_us": 1e6 * float(np.percentile(latencies, 99)) if len(latencies) else 0.0,
+        }
+
+    def close(self):
+        try:
+            self.control_connection.send(("close", None))
+        except (BrokenPipeError, ConnectionError):
+            pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.kill()
+        self.control_connection.close()
+        for connection in self.client_connections:
+            connection.close()
+        self.buffers.close(unlink=True)
+
+
+def rollout_worker(policy, num_envs, steps, seed, backend, team_size, connection):
+    """Play steps of a SoccerVecEnv with an InferenceClient, or with a local actor if policy is a model path"""
+    from ppo.environments.soccer_vec_env import SoccerVecEnv
+
+    env = SoccerVecEnv(num_envs, seed=seed, copy=False, episode_statistics=False, team_size=team_size)
+    if isinstance(policy, InferenceClient):
+        infer = policy.infer
+    else:
+        actor = load_actor(policy, backend)
+        rng = np.random.default_rng(seed)
+        def infer(observations):
+            logits = actor(observations)
+            actions = sample_actions(logits, rng)
+            return actions, get_log_probs(logits, actions)
+
+    observations, _ = env.reset(seed=seed)
+    start = time.perf_counter()
+    for _ in range(steps):
+        actions, _ = infer(observations.reshape(-1, observations.shape[-1]))
+        observations, _, _, _, _ = env.step(actions.reshape(num_envs, env.num_agents))
+    connection.send(time.perf_counter() - start)
+    env.close()
+    if isinstance(policy, InferenceClient):
+        policy.close()
+
+
+def run_rollout_workers(policies, num_envs, steps, backend, team_size, context):
+    """Env steps per second of one rollout worker per policy, all running at the same time"""
+    result_connections = []
+    processes = []
+    for worker_index, policy in enumerate(policies):
+        parent_connection, child_connection = context.Pipe()
+        process = context.Process(target=rollout_worker,
+                                  args=(policy, num_envs, steps, worker_index, backend, team_size, child_connection), daemon=True)
+        process.start()
+        child_connection.close()
+        result_connections.append(parent_connection)
+        processes.append(process)
+    elapsed = max(connection.recv() for connection in result_connections)
+    for process in processes:
+        process.join()
+    return len(policies) * num_envs * steps / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare rollout workers using an InferenceServer with workers evaluating their own actor")
+    parser.add_argument("model", type=str, help="Actor checkpoint (.onnx or .pth)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Rollout worker processes")
+    parser.add_argument("--envs-per-worker", type=int, default=1, help="Matches stepped by each worker")
+    parser.add_argument("--steps", type=int, default=2000, help="Vector steps per worker")
+    parser.add_argument("--max-batch-size", type=int, default=256)
+    parser.add_argument("--max-delay-ms", type=float, default=2.0, help="Longest wait of a request for more requests")
+    parser.add_argument("--team-size", type=int, default=2, help="Players per team, the actor must match its observation size")
+    parser.add_argument("--backend", type=str, default="auto", choices=["auto", "onnx", "torch"], help="Inference backend")
+    parser.add_argument("--context", type=str, default=None, help="multiprocessing start method")
+    args = parser.parse_args()
+
+    context = mp.get_context(args.context)
+    num_agents = 2 * args.team_size
+    local_steps_per_second = run_rollout_workers([args.model] * args.workers, args.envs_per_worker, args.steps,
+                                                 args.backend, args.team_size, context)
+    print(f"{'local':>8} {args.workers} workers x {args.envs_per_worker} envs: {local_steps_per_second:.0f} env steps/sec")
+
+    server = InferenceServer(args.model, args.workers, args.envs_per_worker * num_agents, 4 * (num_agents + 1), args.backend,
+                             max_batch_size=args.max_batch_size, max_delay=args.max_delay_ms / 1e3, context=args.context)
+    try:
+        clients = [server.get_client(i) for i in range(args.workers)]
+        server_steps_per_second = run_rollout_workers(clients, args.envs_per_worker, args.steps, args.backend,
+                                                      args.team_size, context)
+        statistics = server.get_statistics()
+    finally:
+        server.close()
+    print(f"{'server':>8} {args.workers} workers x {args.envs_per_worker} envs: {server_steps_per_second:.0f} env steps/sec")
+    print(f"{statistics['batches']} batches of {statistics['mean_batch_size']:.1f} rows on average, "
+          f"latency p50={statistics['latency_p50_us']:.0f}us p99={statistics['latency_p99_us']:.0f}us")
+    print("batch size histogram: " + " ".join(f"{size}:{count}" for size, count in statistics["batch_size_histogram"].items()))
+
+
+if __name__ == "__main__":
+    main()
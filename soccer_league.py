@@ -0,0 +1,219 @@
+# Self-play league for the Soccer Environment
+#
+# Plays headless matches between a pool of actor checkpoints and keeps their Elo ratings
+# in a JSON file. Matches run in the envs of a SoccerProcessPool, or of an in-process
+# SoccerVecEnv with --workers 0. Every step, the observations of all players driven by the
+# same checkpoint are evaluated in one forward pass over all running matches. Soccer
+# already mirrors the observations of the blue team, so every actor can play either side.
+#
+#   python soccer_league.py public/models/actor1.onnx public/models/actor2.onnx --schedule elo --matches 500
+
+import argparse
+import json
+import os
+import time
+from itertools import islice
+from pathlib import Path
+
+import numpy as np
+
+from ppo.environments.soccer import NO_OP
+from ppo.environments.soccer_actors import load_actor, sample_actions
+
+
+class RatingTable:
+    """Elo ratings and win/draw/loss counts of the league players, stored as JSON at path"""
+    def __init__(self, path=None, initial_rating=1000.0, k_factor=16.0):
+        self.path = Path(path) if path is not None else None
+        self.initial_rating = initial_rating
+        self.k_factor = k_factor
+        self.players = {}
+        if self.path is not None and self.path.exists():
+            self.players = json.loads(self.path.read_text())["players"]
+
+    def add_player(self, name):
+        self.players.setdefault(name, {"rating": self.initial_rating, "matches": 0, "wins": 0, "draws": 0, "losses": 0})
+
+    def rating(self, name):
+        return self.players[name]["rating"]
+
+    def expected_score(self, name, opponent):
+        """Probability that name beats opponent, counting a draw as half a win"""
+        return 1.0 / (1.0 + 10.0 ** ((self.rating(opponent) - self.rating(name)) / 400.0))
+
+    def record(self, home, away, score):
+        """Update both players after a match, score is 1 for a home win, 0.5 for a draw and 0 for a loss"""
+        change = self.k_factor * (score - self.expected_score(home, away))
+        for name, player_score, sign in ((home, score, 1.0), (away, 1.0 - score, -1.0)):
+            player = self.players[name]
+            player["rating"] += sign * change
+            player["matches"] += 1
+            player["wins" if player_score == 1.0 else "losses" if player_score == 0.0 else "draws"] += 1
+
+    def save(self):
+        if self.path is None:
+            return
+        # Written to a temporary file first, so an interrupted run never leaves a broken table
+        temporary_path = self.path.with_name(self.path.name + ".tmp")
+        temporary_path.write_text(json.dumps({"players": self.players}, indent=2))
+        os.replace(temporary_path, self.path)
+
+    def standings(self):
+        """(name, stats) of all players, highest rating first"""
+        return sorted(self.players.items(), key=lambda item: -item[1]["rating"])
+
+
+def round_robin_schedule(num_players, rounds=1):
+    """Every ordered pair (home, away) of distinct players once per round, so each pair plays both sides"""
+    return [(home, away) for _ in range(rounds) for home in range(num_players) for away in range(num_players) if home != away]
+
+
+def elo_schedule(table, names, rng):
+    """Endless matches between players of similar rating
+
+    The first player is drawn uniformly, the opponent with weight p * (1 - p) of the expected
+    score p, which is largest for even matches. Ratings are read when a match is drawn, so
+    the schedule follows the table as results come in.
+    """
+    while True:
+        home = int(rng.integers(len(names)))
+        opponents = np.array([k for k in range(len(names)) if k != home])
+        expected = np.array([table.expected_score(names[home], names[k]) for k in opponents])
+        weights = expected * (1.0 - expected)
+        away = int(rng.choice(opponents, p=weights / weights.sum()))
+        yield (home, away) if rng.random() < 0.5 else (away, home)
+
+
+class League:
+    """Plays scheduled matches between actor checkpoints and records the results in a RatingTable
+
+    Args:
+        model_paths: actor checkpoints (.onnx or .pth), see soccer_actors.load_actor
+        ratings_path: JSON file holding the rating table, created if it does not exist
+        num_workers: worker processes of the SoccerProcessPool, 0 runs the matches in this process
+        envs_per_worker: matches running at the same time in every worker
+    """
+    def __init__(self, model_paths, ratings_path=None, backend="auto", num_workers=0, envs_per_worker=8,
+                 seed=0, k_factor=16.0, context=None):
+        stems = [Path(path).stem for path in model_paths]
+        self.names = [stem if stems.count(stem) == 1 else str(path) for stem, path in zip(stems, model_paths)]
+        self.actors = [load_actor(path, backend) for path in model_paths]
+        self.table = RatingTable(ratings_path, k_factor=k_factor)
+        for name in self.names:
+            self.table.add_player(name)
+
+        if num_workers > 0:
+            from ppo.environments.soccer_pool import SoccerProcessPool
+            self.env = SoccerProcessPool(num_workers, envs_per_worker, seed=seed, context=context, copy=False)
+        else:
+            from ppo.environments.soccer_vec_env import SoccerVecEnv
+            self.env = SoccerVecEnv(envs_per_worker, seed=seed, copy=False, episode_statistics=False)
+        self.num_envs = self.env.num_envs
+        self.num_agents = self.env.num_agents
+        self.team_size = self.num_agents // 2
+        self.seed = seed
+        self.rng = np.random.default_rng(seed)
+
+        # Throughput statistics
+        self.matches_played = 0
+        self.total_time = 0.0
+
+    def run(self, schedule, num_matches=None):
+        """Play the (home, away) player index pairs of schedule, the first num_matches of them if given
+
+        Home plays as the red team. Returns the results as dicts with the player names and the home score.
+        """
+        start_time = time.perf_counter()
+        matches = iter(schedule if num_matches is None else islice(schedule, num_matches))
+        # Player index controlling every agent of every env, -1 for envs without a match
+        controllers = np.full((self.num_envs, self.num_agents), -1)
+        assigned = [None] * self.num_envs
+        actions = np.full((self.num_envs, self.num_agents), NO_OP)
+        results = []
+
+        def assign(i):
+            assigned[i] = next(matches, None)
+            controllers[i] = -1 if assigned[i] is None else np.repeat(assigned[i], self.team_size)
+
+        observations, _ = self.env.reset(seed=int(self.rng.integers(2**31)))
+        for i in range(self.num_envs):
+            assign(i)
+
+        while any(match is not None for match in assigned):
+            actions[:] = NO_OP
+            for player in np.unique(controllers[controllers >= 0]):
+                mask = controllers == player
+                actions[mask] = sample_actions(self.actors[player](observations[mask]), self.rng)
+
+            observations, _, terminated, truncated, infos = self.env.step(actions)
+            done = terminated | truncated
+            if not done.any():
+                continue
+            restarted = infos.get("worker_restarted", np.zeros(self.num_envs, dtype=bool))
+            for i in np.flatnonzero(done):
+                if assigned[i] is None or restarted[i]:
+                    # A match cut short by a crashed worker is played again in the fresh env
+                    continue
+                home, away = self.names[assigned[i][0]], self.names[assigned[i][1]]
+                goal_scored = infos["goal_scored"][i]
+                score = 0.5 if goal_scored < 0 else 1.0 if goal_scored == 0 else 0.0
+                self.table.record(home, away, score)
+                results.append({"home": home, "away": away, "score": score})
+                assign(i)
+            self.table.save()
+
+        self.matches_played += len(results)
+        self.total_time += time.perf_counter() - start_time
+        return results
+
+    @property
+    def matches_per_hour(self):
+        if self.total_time == 0:
+            return 0.0
+        return 3600.0 * self.matches_played / self.total_time
+
+    def close(self):
+        self.table.save()
+        self.env.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Play a self-play league between actor checkpoints and rate them with Elo")
+    parser.add_argument("models", type=str, nargs="+", help="Actor checkpoints (.onnx or .pth)")
+    parser.add_argument("--ratings", type=str, default="league_ratings.json", help="JSON rating table, updated after every match")
+    parser.add_argument("--schedule", type=str, default="round-robin", choices=["round-robin", "elo"],
+                        help="round-robin plays every ordered pair --rounds times, elo samples --matches even matches")
+    parser.add_argument("--rounds", type=int, default=10, help="Round-robin rounds")
+    parser.add_argument("--matches", type=int, default=100, help="Matches of the elo schedule")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="Worker processes stepping the matches, 0 to step them in this process")
+    parser.add_argument("--envs-per-worker", type=int, default=8, help="Matches running at the same time in every worker")
+    parser.add_argument("--backend", type=str, default="auto", choices=["auto", "onnx", "torch"], help="Inference backend")
+    parser.add_argument("--k-factor", type=float, default=16.0, help="Elo K-factor")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--context", type=str, default=None, help="multiprocessing start method")
+    args = parser.parse_args()
+    if len(args.models) < 2:
+        parser.error("a league needs at least two models")
+
+    league = League(args.models, args.ratings, args.backend, args.workers, args.envs_per_worker,
+                    args.seed, args.k_factor, args.context)
+    if args.schedule == "round-robin":
+        schedule, num_matches = round_robin_schedule(len(league.names), args.rounds), None
+    else:
+        schedule, num_matches = elo_schedule(league.table, league.names, league.rng), args.matches
+    try:
+        results = league.run(schedule, num_matches)
+    finally:
+        league.close()
+
+    print(f"{len(results)} matches in {league.total_time:.1f}s ({league.matches_per_hour:.0f} matches/hour), "
+          f"{league.num_envs} running at once")
+    print(f"{'player':<30} {'rating':>8} {'matches':>8} {'wins':>6} {'draws':>6} {'losses':>7}")
+    for name, player in league.table.standings():
+        print(f"{name:<30} {player['rating']:8.1f} {player['matches']:8d} {player['wins']:6d} "
+              f"{player['draws']:6d} {player['losses']:7d}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,398 @@
+# Pure-NumPy physics backend for the Soccer Environment
+#
+# The game only has four axis-aligned player boxes, one ball and static walls, so the
+# dynamics can be written as a handful of array operations over many matches at once.
+# Players are treated as non-rotating boxes whose velocity is set every step, the ball
+# as a damped restitutive circle with friction against walls and players. Collisions of
+# players with walls and each other are resolved after integrating positions. Ball-player
+# contacts follow the order of a Box2D step, which decides how often the ball is touched:
+# contacts are found before integrating, their velocities solved with restitution and
+# friction and the remaining overlap only partly corrected afterwards. compare_backends
+# checks the result against Box2D.
+
+import argparse
+import sys
+
+import Box2D
+import numpy as np
+
+from ppo.environments.soccer import (
+    GAME_WIDTH,
+    GAME_HEIGHT,
+    GOAL_WIDTH,
+    WALL_THICKNESS,
+    PLAYER_SIZE,
+    PLAYER_DENSITY,
+    PLAYER_FRICTION,
+    BALL_RADIUS,
+    BALL_DENSITY,
+    BALL_FRICTION,
+    BALL_RESTITUTION,
+    FPS,
+    PHYSICS_PROFILES,
+)
+
+PLAYER_MASS = PLAYER_SIZE**2 * PLAYER_DENSITY
+BALL_MASS = np.pi * BALL_RADIUS**2 * BALL_DENSITY
+MAX_TRANSLATION = Box2D.b2_maxTranslation  # maximum distance a body moves per step
+VELOCITY_THRESHOLD = Box2D.b2_velocityThreshold  # below this relative speed collisions are inelastic
+TOUCH_SKIN = Box2D.b2_polygonRadius  # Box2D reports polygon contacts within this distance
+LINEAR_SLOP = Box2D.b2_linearSlop  # overlap Box2D leaves uncorrected
+MAX_LINEAR_CORRECTION = Box2D.b2_maxLinearCorrection  # largest position correction per iteration
+BAUMGARTE = 0.2  # fraction of the overlap Box2D corrects per position iteration
+POSITION_ITERATIONS = PHYSICS_PROFILES["default"]["position_iterations"]
+CONTACT_FRICTION = np.sqrt(BALL_FRICTION * PLAYER_FRICTION)  # Box2D mixes friction with the geometric mean
+WALL_CONTACT_FRICTION = np.sqrt(BALL_FRICTION * Box2D.b2FixtureDef().friction)  # walls use the default friction
+
+
+def get_wall_boxes():
+    """Static walls as (center_x, center_y, half_width, half_height), same layout as Soccer.create_boundaries"""
+    wall_width = (GAME_WIDTH - GOAL_WIDTH) / 2
+    return np.array([
+        (0, GAME_HEIGHT/2, WALL_THICKNESS, GAME_HEIGHT/2),
+        (GAME_WIDTH, GAME_HEIGHT/2, WALL_THICKNESS, GAME_HEIGHT/2),
+        (wall_width/2, 0, wall_width/2, WALL_THICKNESS),
+        (GAME_WIDTH - wall_width/2, 0, wall_width/2, WALL_THICKNESS),
+        (wall_width/2, GAME_HEIGHT, wall_width/2, WALL_THICKNESS),
+        (GAME_WIDTH - wall_width/2, GAME_HEIGHT, wall_width/2, WALL_THICKNESS),
+    ], dtype=np.float64)
+
+
+class NumpyPhysics:
+    """Batched physics state of num_envs matches
+
+    Positions and velocities are float64 arrays with a leading env axis. After every
+    step, began_contacts (num_envs, num_agents) tells which players started touching
+    the ball, mirroring SoccerContactListener.BeginContact. Like in Box2D, the contacts of
+    a step are those found at its start, so a touch is reported one step after the overlap.
+    """
+    def __init__(self, num_envs, num_agents=4):
+        self.num_envs = num_envs
+        self.num_agents = num_agents
+        self.player_position = np.zeros((num_envs, num_agents, 2))
+        self.player_velocity = np.zeros((num_envs, num_agents, 2))
+        self.ball_position = np.zeros((num_envs, 2))
+        self.ball_velocity = np.zeros((num_envs, 2))
+        self.ball_contacts = np.zeros((num_envs, num_agents), dtype=bool)
+        self.began_contacts = np.zeros((num_envs, num_agents), dtype=bool)
+
+        walls = get_wall_boxes()
+        self.wall_min = walls[:, :2] - walls[:, 2:]
+        self.wall_max = walls[:, :2] + walls[:, 2:]
+        pair_a, pair_b = np.triu_indices(num_agents, k=1)
+        self.player_pairs = (pair_a, pair_b)
+
+    def reset_env(self, index):
+        """Zero the velocities and contact state of one env, positions are set by the caller"""
+        self.player_velocity[index] = 0.0
+        self.ball_velocity[index] = 0.0
+        self.ball_contacts[index] = False
+        self.began_contacts[index] = False
+
+    def step(self, dt=1.0/FPS):
+        self.ball_velocity *= 1.0 / (1.0 + dt * BALL_FRICTION)
+        touching = self.solve_ball_player_velocities()
+        self.integrate(self.player_position, self.player_velocity, dt)
+        self.integrate(self.ball_position, self.ball_velocity, dt)
+        self.solve_player_walls()
+        self.solve_player_pairs()
+        self.solve_ball_walls()
+        self.correct_ball_player_positions(touching)
+        self.began_contacts[:] = touching & ~self.ball_contacts
+        self.ball_contacts[:] = touching
+
+    def integrate(self, position, velocity, dt):
+        translation = velocity * dt
+        length = np.linalg.norm(translation, axis=-1, keepdims=True)
+        too_far = length > MAX_TRANSLATION
+        if too_far.any():
+            scale = np.where(too_far, MAX_TRANSLATION / np.maximum(length, 1e-12), 1.0)
+            velocity *= scale
+            translation *= scale
+        position += translation
+
+    def solve_player_walls(self):
+        """Push players out of walls along the axis of least overlap, stopping them in that direction"""
+        half = PLAYER_SIZE / 2
+        position = self.player_position[:, :, None, :]
+        overlap_low = position + half - self.wall_min
+        overlap_high = self.wall_max - (position - half)
+        overlap = np.minimum(overlap_low, overlap_high)
+        colliding = (overlap > 0).all(axis=-1)
+        if not colliding.any():
+            return
+        axis = np.argmin(overlap, axis=-1)
+        # One wall at a time, so a player touching two walls is pushed out of them in order
+        for wall in range(self.wall_min.shape[0]):
+            env, agent = np.nonzero(colliding[:, :, wall])
+            if len(env) == 0:
+                continue
+            k = axis[env, agent, wall]
+            direction = np.where(overlap_low[env, agent, wall, k] < overlap_high[env, agent, wall, k], -1.0, 1.0)
+            self.player_position[env, agent, k] += direction * overlap[env, agent, wall, k]
+            velocity = self.player_velocity[env, agent, k]
+            self.player_velocity[env, agent, k] = np.where(velocity * direction < 0, 0.0, velocity)
+
+    def solve_player_pairs(self):
+        """Separate overlapping players equally and make the collision perfectly inelastic"""
+        pair_a, pair_b = self.player_pairs
+        delta = self.player_position[:, pair_b] - self.player_position[:, pair_a]
+        overlap = PLAYER_SIZE - np.abs(delta)
+        colliding = (overlap > 0).all(axis=-1)
+        if not colliding.any():
+            return
+        axis = np.argmin(overlap, axis=-1)
+        # One pair at a time, so a player in several collisions sees the velocities of the earlier ones
+        for pair in range(len(pair_a)):
+            env = np.flatnonzero(colliding[:, pair])
+            if len(env) == 0:
+                continue
+            a, b, k = pair_a[pair], pair_b[pair], axis[env, pair]
+            direction = np.where(delta[env, pair, k] >= 0, 1.0, -1.0)
+            correction = direction * overlap[env, pair, k] / 2
+            self.player_position[env, a, k] -= correction
+            self.player_position[env, b, k] += correction
+            velocity_a = self.player_velocity[env, a, k]
+            velocity_b = self.player_velocity[env, b, k]
+            approaching = (velocity_b - velocity_a) * direction < 0
+            mean = (velocity_a + velocity_b) / 2
+            self.player_velocity[env, a, k] = np.where(approaching, mean, velocity_a)
+            self.player_velocity[env, b, k] = np.where(approaching, mean, velocity_b)
+
+    def circle_box_contact(self, box_min, box_max):
+        """Contact normal (pointing to the ball), distance and penetration of the ball against static boxes"""
+        closest = np.clip(self.ball_position[:, None, :], box_min, box_max)
+        delta = self.ball_position[:, None, :] - closest
+        distance = np.linalg.norm(delta, axis=-1)
+        # Ball center inside the box, push it towards the field center
+        inside = distance < 1e-9
+        if inside.any():
+            delta = np.where(inside[..., None], np.array([GAME_WIDTH/2, GAME_HEIGHT/2]) - self.ball_position[:, None, :], delta)
+            distance = np.where(inside, 0.0, distance)
+        normal = delta / np.maximum(np.linalg.norm(delta, axis=-1, keepdims=True), 1e-12)
+        penetration = BALL_RADIUS - distance
+        return normal, distance, penetration
+
+    def solve_ball_walls(self):
+        normal, _, penetration = self.circle_box_contact(self.wall_min, self.wall_max)
+        colliding = penetration > 0
+        if not colliding.any():
+            return
+        for wall in range(self.wall_min.shape[0]):
+            hit = colliding[:, wall]
+            if not hit.any():
+                continue
+            n = normal[hit, wall]
+            self.ball_position[hit] += n * penetration[hit, wall, None]
+            normal_velocity = (self.ball_velocity[hit] * n).sum(axis=-1)
+            restitution = np.where(-normal_velocity > VELOCITY_THRESHOLD, BALL_RESTITUTION, 0.0)
+            impulse = np.where(normal_velocity < 0, -(1 + restitution) * normal_velocity, 0.0)
+            tangent = np.stack([-n[:, 1], n[:, 0]], axis=-1)
+            tangent_velocity = (self.ball_velocity[hit] * tangent).sum(axis=-1)
+            max_friction = WALL_CONTACT_FRICTION * impulse
+            friction = np.clip(-tangent_velocity, -max_friction, max_friction)
+            self.ball_velocity[hit] += impulse[:, None] * n + friction[:, None] * tangent
+
+    def ball_player_contacts(self):
+        """Contact normals (num_envs, num_agents, 2) pointing to the ball and penetrations of the ball into every player"""
+        half = PLAYER_SIZE / 2
+        delta = self.ball_position[:, None, :] - self.player_position
+        offset = delta - np.clip(delta, -half, half)
+        distance = np.linalg.norm(offset, axis=-1)
+        # Ball center inside the player, push it away from the player center
+        inside = distance < 1e-9
+        offset = np.where(inside[..., None], delta, offset)
+        normal = offset / np.maximum(np.linalg.norm(offset, axis=-1, keepdims=True), 1e-12)
+        return normal, BALL_RADIUS - np.where(inside, 0.0, distance)
+
+    def solve_ball_player_velocities(self):
+        """Exchange momentum between the ball and the players it touches, returns which players touch it
+
+        Approaching contacts bounce with restitution and the tangential velocity is reduced by
+        Coulomb friction. The ball has no spin in this backend, so friction acts on its
+        linear velocity alone.
+        """
+        normal, penetration = self.ball_player_contacts()
+        touching = penetration > -TOUCH_SKIN
+        if not touching.any():
+            return touching
+        inverse_mass_sum = 1 / BALL_MASS + 1 / PLAYER_MASS
+        for agent in range(self.num_agents):
+            hit = touching[:, agent]
+            if not hit.any():
+                continue
+            n = normal[hit, agent]
+            tangent = np.stack([-n[:, 1], n[:, 0]], axis=-1)
+            relative_velocity = self.ball_velocity[hit] - self.player_velocity[hit, agent]
+            normal_velocity = (relative_velocity * n).sum(axis=-1)
+            restitution = np.where(-normal_velocity > VELOCITY_THRESHOLD, BALL_RESTITUTION, 0.0)
+            impulse = np.where(normal_velocity < 0, -(1 + restitution) * normal_velocity / inverse_mass_sum, 0.0)
+            tangent_velocity = (relative_velocity * tangent).sum(axis=-1)
+            max_friction = CONTACT_FRICTION * impulse
+            friction = np.clip(-tangent_velocity / inverse_mass_sum, -max_friction, max_friction)
+            total_impulse = impulse[:, None] * n + friction[:, None] * tangent
+            self.ball_velocity[hit] += total_impulse / BALL_MASS
+            self.player_velocity[hit, agent] -= total_impulse / PLAYER_MASS
+        return touching
+
+    def correct_ball_player_positions(self, touching):
+        """Push the ball out of the players it touches by part of the overlap, like the Box2D position solver"""
+        inverse_mass_sum = 1 / BALL_MASS + 1 / PLAYER_MASS
+        for _ in range(POSITION_ITERATIONS):
+            normal, penetration = self.ball_player_contacts()
+            for agent in range(self.num_agents):
+                correction = np.clip(BAUMGARTE * (penetration[:, agent] + TOUCH_SKIN - LINEAR_SLOP), 0.0, MAX_LINEAR_CORRECTION)
+                correction = np.where(touching[:, agent], correction, 0.0)
+                impulse = normal[:, agent] * (correction / inverse_mass_sum)[:, None]
+                self.ball_position += impulse / BALL_MASS
+                self.player_position[:, agent] -= impulse / PLAYER_MASS
+
+
+class NumpyBody:
+    """Stand-in for a Box2D body backed by one row of a NumpyPhysics state array
+
+    Exposes position and linearVelocity as b2Vec2 so the rest of Soccer works unchanged.
+    """
+    def __init__(self, positions, velocities, index, userData=None):
+        self.positions = positions
+        self.velocities = velocities
+        self.index = index
+        self.userData = userData
+
+    @property
+    def position(self):
+        x, y = self.positions[self.index]
+        return Box2D.b2Vec2(float(x), float(y))
+
+    @position.setter
+    def position(self, value):
+        self.positions[self.index] = (value[0], value[1])
+
+    @property
+    def linearVelocity(self):
+        x, y = self.velocities[self.index]
+        return Box2D.b2Vec2(float(x), float(y))
+
+    @linearVelocity.setter
+    def linearVelocity(self, value):
+        self.velocities[self.index] = (value[0], value[1])
+
+    @property
+    def angularVelocity(self):
+        return 0.0
+
+    @angularVelocity.setter
+    def angularVelocity(self, value):
+        pass  # bodies do not rotate in the NumPy backend
+
+
+# Rollouts compare_backends plays with chase_ball_policy: "chase" goes for the ball and almost
+# always scores, the mostly random "noisy" one scores in about 60% of the episodes
+FIDELITY_SCENARIOS = {
+    "chase": {"epsilon": 0.2, "max_steps": 600},
+    "noisy": {"epsilon": 0.9, "max_steps": 300},
+}
+# The first ball contacts of "chase" happen around step 18, later horizons show how fast the
+# trajectories of the backends diverge after them
+TRAJECTORY_HORIZONS = (10, 20, 25, 30)
+
+# Largest accepted mean position errors in meters after every horizon, and relative
+# differences |numpy - box2d| / box2d of the goal and touch rates
+FIDELITY_TOLERANCES = {
+    "ball_position_error": {10: 0.01, 20: 0.1, 25: 1.0, 30: 3.2},
+    "player_position_error": {10: 0.001, 20: 0.04, 25: 0.2, 30: 0.9},
+    "goal_rate": 0.25,
+    "touches_per_step": 0.2,
+}
+
+
+def compare_backends(num_episodes=100, seed=0, horizons=TRAJECTORY_HORIZONS, scenarios=FIDELITY_SCENARIOS):
+    """Run both physics backends on the same seeds with the scripted chase_ball_policy
+
+    Returns, for every scenario, the mean ball and player position errors after each horizon
+    and the goal and touch rates of each backend, which is what the NumPy backend is tuned against.
+    """
+    from ppo.environments.soccer import Soccer, chase_ball_policy
+
+    envs = {backend: Soccer(physics_backend=backend) for backend in ("box2d", "numpy")}
+    results = {}
+    for scenario, settings in scenarios.items():
+        ball_errors = {horizon: [] for horizon in horizons}
+        player_errors = {horizon: [] for horizon in horizons}
+        goals = {backend: 0 for backend in envs}
+        touches = {backend: 0 for backend in envs}
+        steps = {backend: 0 for backend in envs}
+        for episode in range(num_episodes):
+            states = {backend: {} for backend in envs}
+            for backend, env in envs.items():
+                env.max_steps = settings["max_steps"]
+                observations, _ = env.reset(seed=seed + episode)
+                rng = np.random.default_rng(seed + episode)
+                while True:
+                    actions = chase_ball_policy(observations, rng, epsilon=settings["epsilon"])
+                    observations, _, terminated, truncated, _ = env.step(actions)
+                    steps[backend] += 1
+                    touches[backend] += env.ball_toucher is not None
+                    if env.step_count in ball_errors:
+                        states[backend][env.step_count] = env.get_body_states().copy()
+                    if terminated or truncated:
+                        goals[backend] += terminated
+                        break
+            # Only horizons both backends reached before their episode ended
+            for horizon in states["box2d"].keys() & states["numpy"].keys():
+                error = np.linalg.norm(states["box2d"][horizon][:, :2] - states["numpy"][horizon][:, :2], axis=-1)
+                player_errors[horizon].append(error[:-1].mean())
+                ball_errors[horizon].append(error[-1])
+        results[scenario] = {
+            "ball_position_error": {h: float(np.mean(e)) if e else float("nan") for h, e in ball_errors.items()},
+            "player_position_error": {h: float(np.mean(e)) if e else float("nan") for h, e in player_errors.items()},
+            "goal_rate": {backend: goals[backend] / num_episodes for backend in envs},
+            "touches_per_step": {backend: touches[backend] / max(steps[backend], 1) for backend in envs},
+        }
+    return results
+
+
+def relative_difference(rates):
+    """|numpy - box2d| / box2d of a pair of rates, 0 if both are 0"""
+    if rates["box2d"] == rates["numpy"]:
+        return 0.0
+    return abs(rates["numpy"] - rates["box2d"]) / max(rates["box2d"], 1e-12)
+
+
+def check_fidelity(results, tolerances=FIDELITY_TOLERANCES):
+    """Metrics of compare_backends results that exceed their tolerance, as {"scenario/metric[@horizon]": (error, tolerance)}"""
+    failures = {}
+    for scenario, metrics in results.items():
+        for key, tolerance in tolerances.items():
+            value = metrics[key]
+            if isinstance(tolerance, dict):
+                checks = {f"{scenario}/{key}@{h}": (value[h], tolerance[h]) for h in tolerance if h in value}
+            else:
+                checks = {f"{scenario}/{key}": (relative_difference(value), tolerance)}
+            for name, (error, limit) in checks.items():
+                # nan errors, e.g. no episode reached a horizon, fail as well
+                if not error <= limit:
+                    failures[name] = (error, limit)
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the NumPy physics backend against Box2D")
+    parser.add_argument("--episodes", type=int, default=100, help="Episodes per scenario and backend")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--horizons", type=int, nargs="+", default=list(TRAJECTORY_HORIZONS),
+                        help="Steps after which the positions of both backends are compared")
+    args = parser.parse_args()
+    results = compare_backends(args.episodes, args.seed, args.horizons)
+    for scenario, metrics in results.items():
+        for key, value in metrics.items():
+            print(f"{scenario} {key}: {value}")
+    failures = check_fidelity(results)
+    for name, (error, tolerance) in failures.items():
+        print(f"FAILED {name}: {error} exceeds {tolerance}")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
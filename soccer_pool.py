@@ -0,0 +1,395 @@
+# Multiprocess rollout pool for the Box2D Soccer Environment
+#
+# Box2D stepping holds the GIL, so one process can only use one core. SoccerProcessPool
+# spreads the envs over worker processes, each running a SoccerVecEnv. Observations,
+# rewards and done flags are written by the workers into shared memory and the parent
+# writes the actions there as well, so only tiny command messages go through the pipes.
+
+import argparse
+import multiprocessing as mp
+import os
+import time
+import traceback
+import warnings
+from multiprocessing import shared_memory
+from multiprocessing.connection import wait
+
+import numpy as np
+from gymnasium.vector import VectorEnv, AutoresetMode
+from gymnasium.vector.utils import batch_space
+
+from ppo.environments.soccer import Soccer, DEFAULT_REWARD_SPECIFICATION, derive_seed
+
+
+class WorkerCrashed(RuntimeError):
+    pass
+
+
+class SharedBuffers:
+    """Named NumPy arrays living in multiprocessing.shared_memory blocks"""
+    def __init__(self, specs, create):
+        self.specs = specs
+        self.blocks = {}
+        self.arrays = {}
+        for name, (block_name, shape, dtype) in specs.items():
+            if create:
+                size = max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize)
+                block = shared_memory.SharedMemory(create=True, size=size)
+                specs[name] = (block.name, shape, dtype)
+            else:
+                block = shared_memory.SharedMemory(name=block_name)
+            self.blocks[name] = block
+            self.arrays[name] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+            if create:
+                self.arrays[name][...] = 0
+
+    @classmethod
+    def create(cls, shapes):
+        return cls({name: (None, shape, dtype) for name, (shape, dtype) in shapes.items()}, create=True)
+
+    @classmethod
+    def attach(cls, specs):
+        return cls(dict(specs), create=False)
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def close(self, unlink=False):
+        self.arrays = {}
+        for block in self.blocks.values():
+            block.close()
+            if unlink:
+                block.unlink()
+        self.blocks = {}
+
+
+def worker_loop(worker_index, buffer_specs, env_slice, env_kwargs, connection, cpu):
+    """Run a SoccerVecEnv for the envs in env_slice and serve step/reset commands from the parent"""
+    from ppo.environments.soccer_vec_env import SoccerVecEnv
+
+    if cpu is not None and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, {cpu})
+    buffers = SharedBuffers.attach(buffer_specs)
+    actions = buffers["actions"][env_slice]
+    observations = buffers["observations"][env_slice]
+    rewards = buffers["rewards"][env_slice]
+    terminated = buffers["terminated"][env_slice]
+    truncated = buffers["truncated"][env_slice]
+    final_observations = buffers["final_observations"][env_slice]
+    has_final_observation = buffers["has_final_observation"][env_slice]
+    goal_scored = buffers["goal_scored"][env_slice]
+    episode_returns = buffers["episode_returns"][env_slice]
+    episode_lengths = buffers["episode_lengths"][env_slice]
+    episode_reward_terms = buffers["episode_reward_terms"][:, env_slice]
+
+    env = SoccerVecEnv(env_slice.stop - env_slice.start, copy=False, first_env_index=env_slice.start, **env_kwargs)
+    try:
+        while True:
+            command, data = connection.recv()
+            if command == "step":
+                step_observations, step_rewards, step_terminated, step_truncated, infos = env.step(actions)
+                rewards[:] = step_rewards
+                terminated[:] = step_terminated
+                truncated[:] = step_truncated
+                has_final_observation[:] = False
+                goal_scored[:] = -1
+                episode_returns[:] = 0.0
+                episode_lengths[:] = 0
+                episode_reward_terms[:] = 0.0
+                if "final_obs" in infos:
+                    for i in np.flatnonzero(infos["_final_obs"]):
+                        final_observations[i] = infos["final_obs"][i]
+                        has_final_observation[i] = True
+                    goal_scored[:] = infos["goal_scored"]
+                if "episode" in infos:
+                    episode_returns[:] = infos["episode"]["r"]
+                    episode_lengths[:] = infos["episode"]["l"]
+                    for k, name in enumerate(env.reward_pipeline.names):
+                        episode_reward_terms[k] = infos["episode"]["reward_terms"][name]
+                # Written last, a worker failing before keeps the observations of the last step for the parent
+                observations[:] = step_observations
+                connection.send(("ok", None))
+            elif command == "reset":
+                seeds, options = data
+                reset_observations, _ = env.reset(seed=seeds, options=options)
+                observations[:] = reset_observations
+                connection.send(("ok", None))
+            elif command == "close":
+                break
+    except KeyboardInterrupt:
+        pass
+    except Exception:
+        connection.send(("error", traceback.format_exc()))
+    finally:
+        env.close()
+        del actions, observations, rewards, terminated, truncated, final_observations, has_final_observation, goal_scored
+        del episode_returns, episode_lengths, episode_reward_terms
+        buffers.close()
+        connection.close()
+
+
+class SoccerProcessPool(VectorEnv):
+    """Vector env running num_workers * envs_per_worker Soccer matches in worker processes
+
+    Args:
+        num_workers: number of worker processes
+        envs_per_worker: number of matches stepped by each worker
+        cpus: optional list of CPU ids, worker w is pinned to cpus[w % len(cpus)]
+        context: multiprocessing start method, e.g. "fork", "forkserver" or "spawn"
+        step_timeout: seconds to wait for a worker before treating it as crashed
+        team_size: players per team of every match
+        deterministic: run the envs in deterministic mode with seeds derived from seed and the
+            global env index, so results do not depend on num_workers, see SoccerVecEnv
+        action_repeat, physics_substeps: frames per step and physics steps per frame, see Soccer
+        physics_profile: Box2D solver settings of the envs, see soccer.PHYSICS_PROFILES
+        physics_backend, episode_statistics, history_length: passed to the SoccerVecEnv of every worker
+        trajectory_dir: directory every env records its trajectory files to, see SoccerVecEnv
+
+    With episode_statistics, info["episode"] holds the returns of finished episodes like in
+    SoccerVecEnv. A crashed worker is restarted with its envs reset to the seeds of the last
+    reset, which are reported as truncated in that step and flagged in info["worker_restarted"].
+    """
+    metadata = {"autoreset_mode": AutoresetMode.SAME_STEP, "render_modes": []}
+
+    def __init__(self, num_workers, envs_per_worker=1, reward_specification=DEFAULT_REWARD_SPECIFICATION,
+                 env_id="Soccer-v0", seed=1, cpus=None, context=None, step_timeout=60.0, copy=True, team_size=2,
+                 deterministic=False, action_repeat=1, physics_substeps=1, physics_profile="default",
+                 physics_backend="box2d", episode_statistics=True, history_length=3, trajectory_dir=None):
+        self.num_workers = num_workers
+        self.envs_per_worker = envs_per_worker
+        self.num_envs = num_workers * envs_per_worker
+        self.cpus = list(cpus) if cpus is not None else None
+        self.step_timeout = step_timeout
+        self.copy = copy
+        self.deterministic = deterministic
+        self.episode_statistics = episode_statistics
+        self.env_kwargs = {"reward_specification": reward_specification, "env_id": env_id, "seed": seed, "team_size": team_size,
+                           "deterministic": deterministic, "action_repeat": action_repeat, "physics_substeps": physics_substeps,
+                           "physics_profile": physics_profile, "physics_backend": physics_backend,
+                           "episode_statistics": episode_statistics, "history_length": history_length,
+                           "trajectory_dir": trajectory_dir}
+        # Seeds and options of the last reset, a restarted worker resets its envs with them
+        self.env_seeds = self.get_env_seeds(seed)
+        self.reset_options = None
+        self.context = mp.get_context(context)
+
+        dummy_env = Soccer(reward_specification=reward_specification, team_size=team_size)
+        self.num_agents = dummy_env.num_agents
+        self.num_teams = dummy_env.num_teams
+        self.reward_term_names = list(dummy_env.reward_pipeline.names)
+        self.single_observation_space = dummy_env.observation_space
+        self.single_action_space = dummy_env.action_space
+        dummy_env.close()
+        self.observation_space = batch_space(self.single_observation_space, self.num_envs)
+        self.action_space = batch_space(self.single_action_space, self.num_envs)
+
+        observation_shape = (self.num_envs,) + self.single_observation_space.shape
+        self.buffers = SharedBuffers.create({
+            "actions": ((self.num_envs, self.num_agents), np.int64),
+            "observations": (observation_shape, np.float32),
+            "rewards": ((self.num_envs, self.num_agents), np.float64),
+            "terminated": ((self.num_envs,), np.bool_),
+            "truncated": ((self.num_envs,), np.bool_),
+            "final_observations": (observation_shape, np.float32),
+            "has_final_observation": ((self.num_envs,), np.bool_),
+            "goal_scored": ((self.num_envs,), np.int64),
+            "episode_returns": ((self.num_envs, self.num_teams), np.float64),
+            "episode_lengths": ((self.num_envs,), np.int64),
+            "episode_reward_terms": ((len(self.reward_term_names), self.num_envs, self.num_teams), np.float64),
+        })
+
+        self.processes = [None] * num_workers
+        self.connections = [None] * num_workers
+        self.restart_count = 0
+        for worker_index in range(num_workers):
+            self.start_worker(worker_index)
+
+        # Throughput statistics
+        self.total_env_steps = 0
+        self.total_step_time = 0.0
+
+    def worker_slice(self, worker_index):
+        start = worker_index * self.envs_per_worker
+        return slice(start, start + self.envs_per_worker)
+
+    def start_worker(self, worker_index):
+        parent_connection, child_connection = self.context.Pipe()
+        cpu = self.cpus[worker_index % len(self.cpus)] if self.cpus else None
+        process = self.context.Process(
+            target=worker_loop,
+            args=(worker_index, self.buffers.specs, self.worker_slice(worker_index), self.env_kwargs, child_connection, cpu),
+            daemon=True,
+        )
+        process.start()
+        child_connection.close()
+        self.processes[worker_index] = process
+        self.connections[worker_index] = parent_connection
+
+    def restart_worker(self, worker_index):
+        """Kill a crashed worker, start a new one and reset its envs"""
+        process = self.processes[worker_index]
+        if process.is_alive():
+            process.kill()
+        process.join()
+        self.connections[worker_index].close()
+        self.restart_count += 1
+        self.start_worker(worker_index)
+        seeds = self.env_seeds[self.worker_slice(worker_index)]
+        self.connections[worker_index].send(("reset", (seeds, self.reset_options)))
+        self.receive(worker_index)
+
+    def receive(self, worker_index):
+        connection = self.connections[worker_index]
+        process = self.processes[worker_index]
+        ready = wait([connection, process.sentinel], timeout=self.step_timeout)
+        if connection not in ready:
+            raise WorkerCrashed(f"Worker {worker_index} died or timed out")
+        try:
+            status, data = connection.recv()
+        except (EOFError, ConnectionError):
+            raise WorkerCrashed(f"Worker {worker_index} closed its connection")
+        if status == "error":
+            raise WorkerCrashed(f"Worker {worker_index} raised an exception:\n{data}")
+        return data
+
+    def send_all(self, command, data_per_worker):
+        """Send a command to every worker and return the indices of workers that crashed"""
+        crashed = []
+        for worker_index, connection in enumerate(self.connections):
+            try:
+                connection.send((command, data_per_worker[worker_index]))
+            except (BrokenPipeError, ConnectionError):
+                warnings.warn(f"Restarting worker: Worker {worker_index} closed its connection", RuntimeWarning)
+                crashed.append(worker_index)
+        for worker_index in range(self.num_workers):
+            if worker_index in crashed:
+                continue
+            try:
+                self.receive(worker_index)
+            except WorkerCrashed as error:
+                warnings.warn(f"Restarting worker: {error}", RuntimeWarning)
+                crashed.append(worker_index)
+        for worker_index in crashed:
+            # The restart resets the envs, the observations of the last step become their final observations
+            env_slice = self.worker_slice(worker_index)
+            self.buffers["final_observations"][env_slice] = self.buffers["observations"][env_slice]
+            self.restart_worker(worker_index)
+        return crashed
+
+    def reset(self, seed=None, options=None):
+        """Reset all envs, seeding env i with seed + i if seed is an int, or a derived seed in deterministic mode"""
+        if seed is None or isinstance(seed, int):
+            seeds = [None] * self.num_envs if seed is None else self.get_env_seeds(seed)
+        else:
+            seeds = list(seed)
+            assert len(seeds) == self.num_envs, f"Expected {self.num_envs} seeds, got {len(seeds)}"
+        if seed is not None:
+            self.env_seeds = seeds
+        self.reset_options = options
+        seeds_per_worker = [(seeds[self.worker_slice(w)], options) for w in range(self.num_workers)]
+        self.send_all("reset", seeds_per_worker)
+        return self._output(self.buffers["observations"]), {}
+
+    def get_env_seeds(self, seed):
+        """Seeds of all envs for a root seed, like SoccerVecEnv.get_env_seed with the global env index"""
+        if self.deterministic:
+            return [derive_seed(seed, i) for i in range(self.num_envs)]
+        return [seed + i for i in range(self.num_envs)]
+
+    def step(self, actions):
+        start_time = time.perf_counter()
+        self.buffers["actions"][:] = np.asarray(actions).reshape(self.num_envs, self.num_agents)
+        crashed = self.send_all("step", [None] * self.num_workers)
+
+        terminated = self.buffers["terminated"]
+        truncated = self.buffers["truncated"]
+        has_final_observation = self.buffers["has_final_observation"]
+        infos = {}
+        # Envs whose episode statistics are returned, those of a crashed worker are lost
+        has_episode = has_final_observation
+        if crashed:
+            # The envs of a crashed worker are truncated and autoreset like any other, with the
+            # observations of the last step as final observations and no episode statistics
+            restarted = np.zeros(self.num_envs, dtype=bool)
+            for worker_index in crashed:
+                restarted[self.worker_slice(worker_index)] = True
+            self.buffers["rewards"][restarted] = 0.0
+            terminated[restarted] = False
+            truncated[restarted] = True
+            has_final_observation[restarted] = True
+            self.buffers["goal_scored"][restarted] = -1
+            has_episode = has_final_observation & ~restarted
+            infos["worker_restarted"] = restarted
+        if has_final_observation.any():
+            final_observations = self.buffers["final_observations"]
+            infos["final_obs"] = np.array([final_observations[i].copy() if has_final_observation[i] else None for i in range(self.num_envs)], dtype=object)
+            infos["_final_obs"] = has_final_observation.copy()
+            infos["goal_scored"] = self.buffers["goal_scored"].copy()
+            infos["_goal_scored"] = has_final_observation.copy()
+            if self.episode_statistics:
+                episode_reward_terms = self.buffers["episode_reward_terms"]
+                infos["episode"] = {
+                    "r": self.buffers["episode_returns"].copy(),
+                    "l": self.buffers["episode_lengths"].copy(),
+                    "reward_terms": {name: episode_reward_terms[k].copy() for k, name in enumerate(self.reward_term_names)},
+                }
+                infos["_episode"] = has_episode.copy()
+
+        self.total_env_steps += self.num_envs
+        self.total_step_time += time.perf_counter() - start_time
+        return (
+            self._output(self.buffers["observations"]),
+            self._output(self.buffers["rewards"]),
+            self._output(terminated),
+            self._output(truncated),
+            infos,
+        )
+
+    @property
+    def steps_per_second(self):
+        """Env steps per second spent inside step(), summed over all envs"""
+        if self.total_step_time == 0:
+            return 0.0
+        return self.total_env_steps / self.total_step_time
+
+    def _output(self, array):
+        return array.copy() if self.copy else array
+
+    def close_extras(self, **kwargs):
+        for worker_index, connection in enumerate(self.connections):
+            try:
+                connection.send(("close", None))
+            except (BrokenPipeError, ConnectionError):
+                pass
+        for process in self.processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.kill()
+        for connection in self.connections:
+            connection.close()
+        self.buffers.close(unlink=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the throughput of SoccerProcessPool")
+    parser.add_argument("--workers", type=int, nargs="+", default=[os.cpu_count() or 1],
+                        help="Numbers of worker processes to measure, e.g. 8 16 32 64")
+    parser.add_argument("--envs-per-worker", type=int, default=4, help="Matches stepped by each worker")
+    parser.add_argument("--steps", type=int, default=1000, help="Vector steps per measurement")
+    parser.add_argument("--pin", action="store_true", help="Pin worker w to CPU w")
+    parser.add_argument("--context", type=str, default=None, help="multiprocessing start method")
+    args = parser.parse_args()
+
+    for num_workers in args.workers:
+        cpus = sorted(os.sched_getaffinity(0)) if args.pin and hasattr(os, "sched_getaffinity") else None
+        pool = SoccerProcessPool(num_workers, args.envs_per_worker, cpus=cpus, context=args.context, copy=False)
+        pool.reset(seed=0)
+        rng = np.random.default_rng(0)
+        for _ in range(args.steps):
+            pool.step(rng.integers(0, 9, size=(pool.num_envs, pool.num_agents)))
+        print(f"workers={num_workers} envs={pool.num_envs} steps/sec={pool.steps_per_second:.0f} restarts={pool.restart_count}")
+        pool.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+# Headless renderer for the Soccer Environment
+#
+# Rasterizes the field, players and ball straight into NumPy uint8 (H, W, 3) buffers,
+# without pygame or a display. The picture matches Soccer.render, optionally downscaled,
+# and many envs can be drawn at once from their stacked body states.
+
+import numpy as np
+
+from ppo.environments.soccer import (
+    SCREEN_WIDTH,
+    SCREEN_HEIGHT,
+    PPM,
+    GOAL_WIDTH,
+    WALL_THICKNESS,
+    PLAYER_SIZE,
+    BALL_RADIUS,
+    BLACK,
+    WHITE,
+    RED,
+    BLUE,
+    GREEN,
+)
+
+
+class ArrayRenderer:
+    """Draws body states of shape (..., num_agents + 1, 4), as gathered by Soccer.get_body_states
+
+    Args:
+        scale: factor applied to the 600x800 window size, e.g. 0.25 gives 150x200 frames
+        num_agents, team_size: layout of the players, teams alternate between red and blue
+    """
+    def __init__(self, scale=1.0, num_agents=4, team_size=2):
+        self.scale = scale
+        self.ppm = PPM * scale
+        self.width = int(round(SCREEN_WIDTH * scale))
+        self.height = int(round(SCREEN_HEIGHT * scale))
+        self.num_agents = num_agents
+        self.background = self.draw_background()
+        self.buffer = np.empty((self.height, self.width, 3), dtype=np.uint8)
+
+        # Pixel offsets of a player square and of the ball disk
+        self.player_pixels = int(PLAYER_SIZE * self.ppm)
+        self.player_offsets = np.arange(self.player_pixels)
+        radius = int(BALL_RADIUS * self.ppm)
+        dy, dx = np.mgrid[-radius:radius + 1, -radius:radius + 1]
+        inside = dx**2 + dy**2 <= radius**2
+        self.ball_offsets = (dy[inside], dx[inside])
+        self.player_colors = np.array([RED if i // team_size == 0 else BLUE for i in range(num_agents)], dtype=np.uint8)
+
+    def fill_rect(self, image, x, y, width, height, color):
+        x0, y0 = max(int(x), 0), max(int(y), 0)
+        x1, y1 = min(int(x + width), self.width), min(int(y + height), self.height)
+        image[y0:y1, x0:x1] = color
+
+    def draw_background(self):
+        """Walls, goal openings and goal lines, drawn once like in Soccer.render"""
+        image = np.empty((self.height, self.width, 3), dtype=np.uint8)
+        image[:] = BLACK
+        wall = WALL_THICKNESS * self.ppm
+        goal_width_pixels = GOAL_WIDTH * self.ppm
+        wall_width = (self.width - goal_width_pixels) / 2
+        line = max(1, int(round(2 * self.scale)))
+
+        self.fill_rect(image, 0, 0, wall, self.height, WHITE)
+        self.fill_rect(image, self.width - wall, 0, wall, self.height, WHITE)
+        for y in (0, self.height - wall):
+            self.fill_rect(image, 0, y, wall_width, wall, WHITE)
+            self.fill_rect(image, wall_width + goal_width_pixels, y, wall_width, wall, WHITE)
+        self.fill_rect(image, wall_width, 0, goal_width_pixels, line, GREEN)
+        self.fill_rect(image, wall_width, self.height - line, goal_width_pixels, line, GREEN)
+        return image
+
+    def render(self, body_states, out=None):
+        """Render one env into out, or into a buffer reused by every call if out is None"""
+        if out is None:
+            out = self.buffer
+        self.render_batch(body_states[None], out=out[None])
+        return out
+
+    def render_batch(self, body_states, out=None):
+        """Render N envs from body states (N, num_agents + 1, 4) into frames (N, H, W, 3)"""
+        num_envs = body_states.shape[0]
+        if out is None:
+            out = np.empty((num_envs, self.height, self.width, 3), dtype=np.uint8)
+        out[:] = self.background
+        env_index = np.arange(num_envs)
+
+        # Players as squares around their truncated pixel position
+        corners = (body_states[:, :self.num_agents, :2] * self.ppm).astype(np.int64) - self.player_pixels // 2
+        cols = corners[..., 0, None, None] + self.player_offsets[None, :]
+        rows = corners[..., 1, None, None] + self.player_offsets[:, None]
+        cols, rows = np.broadcast_arrays(cols, rows)
+        valid = (cols >= 0) & (cols < self.width) & (rows >= 0) & (rows < self.height)
+        envs = np.broadcast_to(env_index[:, None, None, None], valid.shape)
+        colors = np.broadcast_to(self.player_colors[None, :, None, None, :], valid.shape + (3,))
+        out[envs[valid], rows[valid], cols[valid]] = colors[valid]
+
+        # Ball as a disk, drawn over the players
+        center = (body_states[:, self.num_agents, :2] * self.ppm).astype(np.int64)
+        rows = center[:, 1, None] + self.ball_offsets[0]
+        cols = center[:, 0, None] + self.ball_offsets[1]
+        valid = (cols >= 0) & (cols < self.width) & (rows >= 0) & (rows < self.height)
+        envs = np.broadcast_to(env_index[:, None], valid.shape)
+        out[envs[valid], rows[valid], cols[valid]] = WHITE
+        return out
@@ -0,0 +1,336 @@
+# Batched reward terms for the Box2D Soccer Environment
+#
+# Every term works on a RewardState holding the state of N environments at once and
+# writes team rewards of shape (N, num_teams) into a given output array, so the reward
+# math of many matches runs as a few array operations instead of N Python passes.
+
+import numpy as np
+
+from ppo.environments.soccer import (
+    GAME_WIDTH,
+    GAME_HEIGHT,
+    PLAYER_SIZE,
+    FPS,
+    REALISTIC_MAXIMUM_VELOCITY,
+    PASSING_QUADRATIC_THRESHOLD,
+    PASSING_THRESHOLD,
+    PLAYER_DISTANCE_THRESHOLD,
+    NO_TOUCHER,
+)
+from ppo.environments.utils import piecewise_function
+
+
+class RewardState:
+    """Snapshot of everything the reward terms need, for N environments
+
+    Touchers are stored as agent indices with NO_TOUCHER for None, touch coordinates
+    come with a boolean mask telling whether they are set.
+
+    A single Soccer env copies its bookkeeping in with update. SoccerVecEnv instead keeps the
+    bookkeeping of all its envs here and advances it with step_envs, one array pass per frame.
+    """
+    def __init__(self, num_envs, num_agents, team_size, history_length=3):
+        self.num_envs = num_envs
+        self.num_agents = num_agents
+        self.team_size = team_size
+        self.num_teams = num_agents // team_size
+        self.history_length = history_length
+
+        self.goal_scored = np.full(num_envs, -1, dtype=np.int64)
+        self.player_positions = np.zeros((num_envs, num_agents, 2))
+        self.player_velocities = np.zeros((num_envs, num_agents, 2))
+        self.ball_position = np.zeros((num_envs, 2))
+        self.ball_velocity = np.zeros((num_envs, 2))
+
+        self.ball_toucher = np.full(num_envs, NO_TOUCHER, dtype=np.int64)
+        self.last_ball_toucher = np.full(num_envs, NO_TOUCHER, dtype=np.int64)
+        self.ball_toucher_history = np.full((num_envs, history_length), NO_TOUCHER, dtype=np.int64)
+        self.ball_toucher_history_length = np.zeros(num_envs, dtype=np.int64)
+        self.ball_touch_coordinate = np.zeros((num_envs, 2))
+        self.has_ball_touch_coordinate = np.zeros(num_envs, dtype=bool)
+        self.last_ball_touch_coordinate = np.zeros((num_envs, 2))
+        self.has_last_ball_touch_coordinate = np.zeros(num_envs, dtype=bool)
+
+        # Oldest and newest entry of the local position history
+        self.first_local_positions = np.zeros((num_envs, num_agents, 2))
+        self.last_local_positions = np.zeros((num_envs, num_agents, 2))
+        self.local_position_history_length = np.zeros(num_envs, dtype=np.int64)
+        # Full local position history, newest last, only kept by step_envs
+        self.local_position_history = np.zeros((num_envs, history_length, num_agents, 2))
+
+        # Persistent across steps, cleared by reset_envs
+        self.first_touch_happened = np.zeros(num_envs, dtype=bool)
+
+        self.teams = np.arange(self.num_teams)
+        self.agent_teams = np.arange(num_agents) // team_size
+        # Own goal of each team, the enemy goal is the other one
+        self.own_goals = np.array([[GAME_WIDTH / 2, 0.0 if team == 0 else GAME_HEIGHT] for team in range(self.num_teams)])
+        self.enemy_goals = np.array([[GAME_WIDTH / 2, GAME_HEIGHT if team == 0 else 0.0] for team in range(self.num_teams)])
+        # Index pairs of teammates for the player distance term
+        pair_a, pair_b = np.triu_indices(team_size, k=1)
+        self.teammate_pairs = (pair_a, pair_b)
+
+    def reset_envs(self, mask):
+        """Clear the per-episode state of the environments selected by mask, like Soccer.reset"""
+        self.first_touch_happened[mask] = False
+        self.ball_toucher[mask] = NO_TOUCHER
+        self.last_ball_toucher[mask] = NO_TOUCHER
+        self.ball_toucher_history_length[mask] = 0
+        self.has_ball_touch_coordinate[mask] = False
+        self.has_last_ball_touch_coordinate[mask] = False
+        self.local_position_history_length[mask] = 0
+
+    def step_envs(self, indices, goal_scored, ball_toucher, body_states, local_positions):
+        """Advance the bookkeeping of the envs at indices by one frame, like Soccer.begin_step and end_step
+
+        goal_scored, ball_toucher (NO_TOUCHER if nobody began touching the ball), body_states
+        (num_agents + 1, 4) and local_positions (num_agents, 2) are the outcome of the frame
+        for each of the envs at indices.
+        """
+        # The touch of the previous frame becomes the last touch
+        previous_toucher = self.ball_toucher[indices]
+        touched = previous_toucher != NO_TOUCHER
+        self.last_ball_toucher[indices] = np.where(touched, previous_toucher, self.last_ball_toucher[indices])
+        touched = self.has_ball_touch_coordinate[indices]
+        self.last_ball_touch_coordinate[indices] = np.where(touched[:, None], self.ball_touch_coordinate[indices],
+                                                            self.last_ball_touch_coordinate[indices])
+        self.has_last_ball_touch_coordinate[indices] |= touched
+
+        self.goal_scored[indices] = goal_scored
+        self.player_positions[indices] = body_states[:, :-1, :2]
+        self.player_velocities[indices] = body_states[:, :-1, 2:]
+        self.ball_position[indices] = body_states[:, -1, :2]
+        self.ball_velocity[indices] = body_states[:, -1, 2:]
+
+        # Like the live Box2D ball position, the touch coordinate is the ball position at the end of the frame
+        self.ball_toucher[indices] = ball_toucher
+        self.has_ball_touch_coordinate[indices] = ball_toucher != NO_TOUCHER
+        self.ball_touch_coordinate[indices] = body_states[:, -1, :2]
+
+        history = self.ball_toucher_history[indices]
+        history[:, :-1] = history[:, 1:]
+        history[:, -1] = ball_toucher
+        self.ball_toucher_history[indices] = history
+        self.ball_toucher_history_length[indices] = np.minimum(self.ball_toucher_history_length[indices] + 1, self.history_length)
+
+        history = self.local_position_history[indices]
+        history[:, :-1] = history[:, 1:]
+        history[:, -1] = local_positions
+        self.local_position_history[indices] = history
+        length = np.minimum(self.local_position_history_length[indices] + 1, self.history_length)
+        self.local_position_history_length[indices] = length
+        self.first_local_positions[indices] = history[np.arange(len(history)), self.history_length - length]
+        self.last_local_positions[indices] = local_positions
+
+    def update(self, index, env, goal_scored, body_states):
+        """Copy the touch bookkeeping of a Soccer env and its gathered body states into slot index"""
+        self.goal_scored[index] = goal_scored
+        self.player_positions[index] = body_states[:-1, :2]
+        self.player_velocities[index] = body_states[:-1, 2:]
+        self.ball_position[index] = body_states[-1, :2]
+        self.ball_velocity[index] = body_states[-1, 2:]
+
+        self.ball_toucher[index] = NO_TOUCHER if env.ball_toucher is None else env.ball_toucher
+        self.last_ball_toucher[index] = NO_TOUCHER if env.last_ball_toucher is None else env.last_ball_toucher
+        history = env.ball_toucher_history
+        length = min(len(history), self.history_length)
+        self.ball_toucher_history_length[index] = length
+        for k in range(length):
+            self.ball_toucher_history[index, self.history_length - length + k] = history[k - length]
+
+        coordinate = env.ball_touch_coordinate
+        self.has_ball_touch_coordinate[index] = coordinate is not None
+        if coordinate is not None:
+            self.ball_touch_coordinate[index] = tuple(coordinate)
+        coordinate = env.last_ball_touch_coordinate
+        self.has_last_ball_touch_coordinate[index] = coordinate is not None
+        if coordinate is not None:
+            self.last_ball_touch_coordinate[index] = tuple(coordinate)
+
+        self.local_position_history_length[index] = len(env.local_position_history)
+        if env.local_position_history:
+            self.first_local_positions[index] = env.local_position_history[0]
+            self.last_local_positions[index] = env.local_position_history[-1]
+
+
+def team_mean(state, agent_values):
+    """Average per-agent values (N, num_agents) over each team, giving (N, num_teams)"""
+    return agent_values.reshape(state.num_envs, state.num_teams, state.team_size).sum(axis=-1) / state.team_size
+
+
+def team_max(state, agent_values):
+    return agent_values.reshape(state.num_envs, state.num_teams, state.team_size).max(axis=-1)
+
+
+def normalized_dot_product(vector1, vector2, max_value):
+    vector2_magnitude = np.sqrt(vector2[..., 0]**2 + vector2[..., 1]**2)
+    dot_product = (vector1[..., 0] * vector2[..., 0] + vector1[..., 1] * vector2[..., 1]) / (vector2_magnitude + 1e-6)
+    return dot_product / max_value
+
+
+def get_base_negative_reward(state, out):
+    out[:] = 1.0
+    return out
+
+
+def get_goal_reward(state, out):
+    scored = state.goal_scored[:, None]
+    out[:] = np.where(state.teams == scored, 1.0, -0.5) * (scored >= 0)
+    return out
+
+
+def get_winning_the_ball_and_passing_reward(state, out):
+    """Reward the team that wins the ball after two steps nobody touched it"""
+    history = state.ball_toucher_history
+    won = (
+        (state.ball_toucher != NO_TOUCHER)
+        & (state.ball_toucher_history_length >= 3)
+        & (history[:, -3] == NO_TOUCHER)
+        & (history[:, -2] == NO_TOUCHER)
+        & (state.last_ball_toucher != state.ball_toucher)
+    )
+    toucher_team = state.ball_toucher[:, None] // state.team_size
+    out[:] = np.where(state.teams == toucher_team, 1.0, -1.0) * won[:, None]
+    return out
+
+
+def get_distance_based_passing_reward(state, out):
+    out[:] = 0.0
+    touched = np.flatnonzero(state.has_ball_touch_coordinate)
+    for index in touched:
+        ball_touch_team = state.ball_toucher[index] // state.team_size
+        if not state.has_last_ball_touch_coordinate[index]:
+            out[index, ball_touch_team] += 1.0
+            continue
+        if state.ball_toucher[index] == state.last_ball_toucher[index]:
+            continue
+        distance = np.linalg.norm(state.ball_touch_coordinate[index] - state.last_ball_touch_coordinate[index])
+        out[index, ball_touch_team] += piecewise_function(distance, PASSING_QUADRATIC_THRESHOLD, PASSING_THRESHOLD)
+    return out
+
+
+def get_player_distance_reward(state, out):
+    positions = state.player_positions.reshape(state.num_envs, state.num_teams, state.team_size, 2)
+    pair_a, pair_b = state.teammate_pairs
+    distance = np.linalg.norm(positions[:, :, pair_a] - positions[:, :, pair_b], axis=-1)
+    penalty = (PLAYER_DISTANCE_THRESHOLD - distance)**2 / PLAYER_DISTANCE_THRESHOLD**2
+    out[:] = np.where(distance < PLAYER_DISTANCE_THRESHOLD, penalty, 0.0).sum(axis=-1)
+    return out
+
+
+def get_velocity_to_goal_reward(state, out):
+    to_goal = state.enemy_goals - state.ball_position[:, None, :]
+    out[:] = normalized_dot_product(state.ball_velocity[:, None, :], to_goal, REALISTIC_MAXIMUM_VELOCITY)
+    return out
+
+
+def get_dist_to_goal_reward(state, out):
+    distance = np.linalg.norm(state.ball_position[:, None, :] - state.enemy_goals, axis=-1)
+    out[:] = 1.0 - distance / (GAME_WIDTH + GAME_HEIGHT)
+    return out
+
+
+def get_first_touch_reward(state, out):
+    """Reward the team that touches the ball first, once per episode"""
+    first_touch = ~state.first_touch_happened & (state.last_ball_toucher != NO_TOUCHER)
+    first_touch_team = state.last_ball_toucher[:, None] // state.team_size
+    out[:] = np.where(state.teams == first_touch_team, 1.0, -0.5) * first_touch[:, None]
+    state.first_touch_happened |= first_touch
+    return out
+
+
+def get_shooting_reward(state, out):
+    ball_speed = np.sqrt(state.ball_velocity[:, 0]**2 + state.ball_velocity[:, 1]**2)
+    shooting_team = state.last_ball_toucher[:, None] // state.team_size
+    shot = (state.teams == shooting_team) & (state.last_ball_toucher[:, None] != NO_TOUCHER)
+    out[:] = np.where(shot, ball_speed[:, None] / REALISTIC_MAXIMUM_VELOCITY, 0.0)
+    return out
+
+
+def get_stay_in_field_reward(state, out):
+    x = state.player_positions[..., 0]
+    y = state.player_positions[..., 1]
+    in_field = (x > 0) & (x < GAME_WIDTH) & (y > 0) & (y < GAME_HEIGHT)
+    out[:] = team_mean(state, np.where(in_field, 1.0, -1.0))
+    return out
+
+
+def get_smoothness_reward(state, out):
+    dist = np.linalg.norm(state.last_local_positions - state.first_local_positions, axis=-1)
+    expected_dist = PLAYER_SIZE / FPS * 3
+    smooth = np.where(dist >= expected_dist / 2, 1.0, -1.0)
+    smooth *= (state.local_position_history_length >= 2)[:, None]
+    out[:] = team_mean(state, smooth)
+    return out
+
+
+def get_velocity_to_ball_reward(state, out):
+    to_ball = state.ball_position[:, None, :] - state.player_positions
+    out[:] = team_mean(state, normalized_dot_product(state.player_velocities, to_ball, REALISTIC_MAXIMUM_VELOCITY))
+    return out
+
+
+def get_dist_to_ball_reward(state, out):
+    # Only meant for the beginning of training, the term has always been hard-coded to 0
+    out[:] = 0.0
+    return out
+
+
+def get_stay_own_half_reward(state, out):
+    """Reward a team if one of its players is closer to its own goal than the ball is"""
+    radius = np.linalg.norm(state.own_goals - state.ball_position[:, None, :], axis=-1)
+    agent_own_goals = state.own_goals[state.agent_teams]
+    dist_to_own_goal = np.linalg.norm(state.player_positions - agent_own_goals, axis=-1)
+    inside = dist_to_own_goal < radius[:, state.agent_teams]
+    out[:] = team_max(state, inside.astype(np.float64))
+    return out
+
+
+# All reward terms in the order Soccer.calculate_rewards accumulates them
+REWARD_TERMS = {
+    "base_negative": get_base_negative_reward,
+    "goal": get_goal_reward,
+    "winning_the_ball_and_passing": get_winning_the_ball_and_passing_reward,
+    "distance_based_passing": get_distance_based_passing_reward,
+    "player_distance": get_player_distance_reward,
+    "velocity_to_goal": get_velocity_to_goal_reward,
+    "dist_to_goal": get_dist_to_goal_reward,
+    "first_touch": get_first_touch_reward,
+    "shooting": get_shooting_reward,
+    "stay_in_field": get_stay_in_field_reward,
+    "smoothness": get_smoothness_reward,
+    "velocity_to_ball": get_velocity_to_ball_reward,
+    "dist_to_ball": get_dist_to_ball_reward,
+    "stay_own_half": get_stay_own_half_reward,
+}
+
+
+class RewardPipeline:
+    """Reward specification compiled into a fixed list of active terms with their weights
+
+    Each term writes its team rewards into a preallocated slice of term_rewards, which
+    is then weighted in place and summed into team_rewards. After calculate, term_rewards
+    holds the weighted contribution of every term, in the order of names.
+    """
+    def __init__(self, reward_specification, num_envs, num_teams):
+        unknown = set(reward_specification) - set(REWARD_TERMS)
+        if unknown:
+            raise ValueError(f"Unknown reward terms: {sorted(unknown)}")
+        self.reward_specification = dict(reward_specification)
+        self.names = [name for name in REWARD_TERMS if name in reward_specification]
+        self.terms = [REWARD_TERMS[name] for name in self.names]
+        self.weights = np.array([reward_specification[name] for name in self.names], dtype=np.float64)
+        self.term_rewards = np.zeros((len(self.names), num_envs, num_teams))
+        self.team_rewards = np.zeros((num_envs, num_teams))
+
+    def calculate(self, state):
+        """Calculate the team rewards (N, num_teams) of all envs in state"""
+        for term, term_rewards in zip(self.terms, self.term_rewards):
+            term(state, term_rewards)
+        self.term_rewards *= self.weights[:, None, None]
+        np.sum(self.term_rewards, axis=0, out=self.team_rewards)
+        return self.team_rewards
+
+    def get_breakdown(self, index=0):
+        """Weighted team rewards of every term for env index, as {name: array of shape (num_teams,)}"""
+        return {name: self.term_rewards[k, index].copy() for k, name in enumerate(self.names)}
@@ -0,0 +1,266 @@
+# Compact binary trajectory recording and replay for the Soccer Environment
+#
+# Every reset and step is stored as a fixed-width record (body states, actions, rewards,
+# ball toucher, goal) in a chunked columnar file: a small JSON header followed by chunks
+# that hold each field as one contiguous array. Files can be memory-mapped and read
+# without parsing, and replay reconstructs observations and rewards under any reward
+# specification from the recorded states, without simulating the physics again.
+#
+#   python soccer_trajectory.py trajectories_20261016-120000-4242_0.soctrj --reward-specification '{"goal": 100.0}'
+#
+# File layout:
+#   MAGIC | uint32 header length | JSON header | chunk*
+#   chunk = uint32 number of records | field_0 array | field_1 array | ...
+
+import argparse
+import json
+import os
+import struct
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+
+from ppo.environments.soccer import ObservationTables
+from ppo.environments.soccer_rewards import RewardState, RewardPipeline, NO_TOUCHER
+
+MAGIC = b"SOCCTRJ1"
+
+
+def get_record_fields(num_agents):
+    """(name, dtype, shape) of every column, one record per reset or step"""
+    return [
+        ("episode", "<u4", ()),
+        ("step", "<u2", ()),
+        ("body_states", "<f4", (num_agents + 1, 4)),
+        ("actions", "u1", (num_agents,)),
+        ("rewards", "<f4", (num_agents,)),
+        ("ball_toucher", "i1", ()),
+        ("goal_scored", "i1", ()),
+        ("terminated", "?", ()),
+        ("truncated", "?", ()),
+    ]
+
+
+class TrajectoryWriter:
+    """Buffers records column by column and appends them to disk chunk_size records at a time
+
+    A new file is started every episodes_per_file episodes, named trajectories_<run id>_<n>.soctrj
+    with a run id made of the start time and the process id. Files are never overwritten: if
+    another writer, e.g. a second env of the same process, already created a name, the next
+    free n is used.
+    """
+    def __init__(self, directory, num_agents=4, team_size=2, chunk_size=4096, episodes_per_file=100, metadata=None):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.num_agents = num_agents
+        self.team_size = team_size
+        self.chunk_size = chunk_size
+        self.episodes_per_file = episodes_per_file
+        self.metadata = metadata or {}
+        self.fields = get_record_fields(num_agents)
+        self.columns = {name: np.zeros((chunk_size,) + shape, dtype=dtype) for name, dtype, shape in self.fields}
+        self.num_records = 0
+        self.file = None
+        self.file_count = 0
+        self.run_id = f"{datetime.now():%Y%m%d-%H%M%S}-{os.getpid()}"
+        self.episode = -1
+        self.episodes_in_file = 0
+
+    def open_file(self):
+        self.close_file()
+        header = json.dumps({
+            "num_agents": self.num_agents,
+            "team_size": self.team_size,
+            "fields": [[name, dtype, list(shape)] for name, dtype, shape in self.fields],
+            "metadata": self.metadata,
+        }).encode()
+        while True:
+            path = self.directory / f"trajectories_{self.run_id}_{self.file_count}.soctrj"
+            self.file_count += 1
+            try:
+                self.file = open(path, "xb")
+                break
+            except FileExistsError:
+                continue
+        self.file.write(MAGIC)
+        self.file.write(struct.pack("<I", len(header)))
+        self.file.write(header)
+        self.episodes_in_file = 0
+        return path
+
+    def begin_episode(self, body_states):
+        """Record the state after a reset as step 0 of a new episode"""
+        # An episode reset again before its first step is replaced, if it is still buffered
+        if self.num_records > 0 and self.columns["step"][self.num_records - 1] == 0:
+            self.num_records -= 1
+            self.episode -= 1
+            self.episodes_in_file -= 1
+        if self.file is None or self.episodes_in_file >= self.episodes_per_file:
+            self.open_file()
+        self.episode += 1
+        self.episodes_in_file += 1
+        self.add_record(0, body_states, None, None, None, -1, False, False)
+
+    def add_step(self, step, body_states, actions, rewards, ball_toucher, goal_scored, terminated, truncated):
+        self.add_record(step, body_states, actions, rewards, ball_toucher, goal_scored, terminated, truncated)
+
+    def add_record(self, step, body_states, actions, rewards, ball_toucher, goal_scored, terminated, truncated):
+        i = self.num_records
+        columns = self.columns
+        columns["episode"][i] = self.episode
+        columns["step"][i] = step
+        columns["body_states"][i] = body_states
+        columns["actions"][i] = 0 if actions is None else actions
+        columns["rewards"][i] = 0 if rewards is None else rewards
+        columns["ball_toucher"][i] = NO_TOUCHER if ball_toucher is None else ball_toucher
+        columns["goal_scored"][i] = goal_scored
+        columns["terminated"][i] = terminated
+        columns["truncated"][i] = truncated
+        self.num_records += 1
+        if self.num_records == self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.num_records == 0 or self.file is None:
+            return
+        self.file.write(struct.pack("<I", self.num_records))
+        for name, _, _ in self.fields:
+            self.file.write(self.columns[name][:self.num_records].tobytes())
+        self.num_records = 0
+
+    def close_file(self):
+        if self.file is not None:
+            self.flush()
+            self.file.close()
+            self.file = None
+
+    def close(self):
+        self.close_file()
+
+
+class TrajectoryReader:
+    """Memory-maps a trajectory file, columns of single chunks are returned without copying"""
+    def __init__(self, path):
+        self.path = Path(path)
+        self.data = np.memmap(self.path, dtype=np.uint8, mode="r")
+        if bytes(self.data[:len(MAGIC)]) != MAGIC:
+            raise ValueError(f"{path} is not a soccer trajectory file")
+        offset = len(MAGIC)
+        (header_length,) = struct.unpack("<I", bytes(self.data[offset:offset + 4]))
+        offset += 4
+        self.header = json.loads(bytes(self.data[offset:offset + header_length]))
+        offset += header_length
+        self.num_agents = self.header["num_agents"]
+        self.team_size = self.header["team_size"]
+        self.fields = [(name, np.dtype(dtype), tuple(shape)) for name, dtype, shape in self.header["fields"]]
+
+        self.chunks = []
+        while offset < len(self.data):
+            (num_records,) = struct.unpack("<I", bytes(self.data[offset:offset + 4]))
+            offset += 4
+            chunk = {}
+            for name, dtype, shape in self.fields:
+                size = num_records * dtype.itemsize * int(np.prod(shape, dtype=np.int64))
+                chunk[name] = self.data[offset:offset + size].view(dtype).reshape((num_records,) + shape)
+                offset += size
+            self.chunks.append(chunk)
+
+    def column(self, name):
+        if len(self.chunks) == 1:
+            return self.chunks[0][name]
+        return np.concatenate([chunk[name] for chunk in self.chunks])
+
+    def episodes(self):
+        """Yield every episode as a dict of columns, starting with its reset record"""
+        columns = {name: self.column(name) for name, _, _ in self.fields}
+        episode = columns["episode"]
+        boundaries = np.flatnonzero(np.diff(episode)) + 1
+        for start, end in zip(np.r_[0, boundaries], np.r_[boundaries, len(episode)]):
+            yield {name: column[start:end] for name, column in columns.items()}
+
+
+def replay_observations(episode, num_agents=4, team_size=2):
+    """Observations (num_records, num_agents, 20) of an episode, including the one after the reset"""
+    tables = ObservationTables(num_agents, team_size)
+    return tables.compute(episode["body_states"].astype(np.float64))
+
+
+def replay_rewards(episode, reward_specification, num_agents=4, team_size=2, history_length=3):
+    """Recompute the rewards (steps, num_agents) of an episode under reward_specification
+
+    The touch bookkeeping of Soccer (last toucher, toucher and position histories, touch
+    coordinates) is reconstructed from the recorded ball touchers, so all steps are scored
+    with a single pass of the reward pipeline. history_length must match the recording env.
+    """
+    body_states = episode["body_states"].astype(np.float64)
+    toucher = episode["ball_toucher"].astype(np.int64)
+    num_steps = len(body_states) - 1
+    state = RewardState(num_steps, num_agents, team_size, history_length)
+    steps = np.arange(1, num_steps + 1)
+
+    state.goal_scored[:] = episode["goal_scored"][1:]
+    state.player_positions[:] = body_states[1:, :-1, :2]
+    state.player_velocities[:] = body_states[1:, :-1, 2:]
+    state.ball_position[:] = body_states[1:, -1, :2]
+    state.ball_velocity[:] = body_states[1:, -1, 2:]
+
+    # Last step before each step on which the ball was touched
+    touched = toucher != NO_TOUCHER
+    touched[0] = False
+    last_touch_step = np.maximum.accumulate(np.where(touched, np.arange(len(toucher)), -1))
+    previous_touch_step = np.r_[-1, last_touch_step[:-1]][1:]
+    has_previous_touch = previous_touch_step >= 0
+    state.ball_toucher[:] = toucher[1:]
+    state.last_ball_toucher[:] = np.where(has_previous_touch, toucher[previous_touch_step], NO_TOUCHER)
+    state.has_ball_touch_coordinate[:] = touched[1:]
+    state.ball_touch_coordinate[:] = body_states[1:, -1, :2]
+    state.has_last_ball_touch_coordinate[:] = has_previous_touch
+    state.last_ball_touch_coordinate[:] = body_states[previous_touch_step, -1, :2]
+
+    history_length = state.history_length
+    padded_toucher = np.r_[np.full(history_length - 1, NO_TOUCHER), toucher[1:]]
+    for k in range(history_length):
+        state.ball_toucher_history[:, k] = padded_toucher[k:k + num_steps]
+    state.ball_toucher_history_length[:] = np.minimum(steps, history_length)
+
+    tables = ObservationTables(num_agents, team_size)
+    local_positions = body_states[:, :-1, :2] * tables.sign[:, 0, :2] + tables.offset[:, 0]
+    state.last_local_positions[:] = local_positions[1:]
+    state.first_local_positions[:] = local_positions[np.maximum(steps - (history_length - 1), 1)]
+    state.local_position_history_length[:] = np.minimum(steps, history_length)
+
+    # The first touch reward is paid once, on the first step with a last toucher
+    has_last_toucher = state.last_ball_toucher != NO_TOUCHER
+    state.first_touch_happened[:] = np.r_[False, np.logical_or.accumulate(has_last_toucher)[:-1]]
+
+    pipeline = RewardPipeline(reward_specification, num_steps, num_agents // team_size)
+    team_rewards = pipeline.calculate(state)
+    return np.repeat(team_rewards, team_size, axis=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded Soccer trajectories and rescore them")
+    parser.add_argument("paths", type=str, nargs="+", help="Trajectory files written by Soccer(trajectory_dir=...)")
+    parser.add_argument("--reward-specification", type=json.loads, default=None,
+                        help="JSON reward specification to rescore with, the recorded one if not given")
+    args = parser.parse_args()
+
+    for path in args.paths:
+        reader = TrajectoryReader(path)
+        recorded_specification = reader.header["metadata"].get("reward_specification")
+        reward_specification = args.reward_specification or recorded_specification
+        print(f"{path}: {sum(chunk['step'].shape[0] for chunk in reader.chunks)} records")
+        for episode in reader.episodes():
+            rewards = replay_rewards(episode, reward_specification, reader.num_agents, reader.team_size,
+                                     reader.header["metadata"].get("history_length", 3))
+            recorded = episode["rewards"][1:]
+            line = (f"  episode {episode['episode'][0]:>5} steps {len(recorded):>4} "
+                    f"recorded return {recorded[:, 0].sum():9.3f} replayed return {rewards[:, 0].sum():9.3f}")
+            if args.reward_specification is None:
+                line += f" max error {np.abs(rewards - recorded).max(initial=0.0):.2e}"
+            print(line)
+
+
+if __name__ == "__main__":
+    main()
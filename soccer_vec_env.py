@@ -0,0 +1,239 @@
+# Vectorized Box2D Soccer Environment stepping N matches in one call
+
+import numpy as np
+from gymnasium.vector import VectorEnv, AutoresetMode
+from gymnasium.vector.utils import batch_space
+
+from ppo.environments.soccer import Soccer, DEFAULT_REWARD_SPECIFICATION, FPS, GAME_HEIGHT, NO_TOUCHER, derive_seed
+from ppo.environments.soccer_rewards import RewardState, RewardPipeline
+from ppo.environments.soccer_numpy_physics import NumpyPhysics
+from ppo.environments.soccer_renderer import ArrayRenderer
+
+
+class SoccerVecEnv(VectorEnv):
+    """Holds N Soccer matches, each with its own Box2D world, and steps them together
+
+    Actions are an (N, num_agents) integer array with num_agents = 2 * team_size. step returns
+    observations (N, num_agents, 4 * (num_agents + 1)), rewards (N, num_agents) and
+    terminated/truncated arrays (N,). Only the Box2D stepping runs per env, observations
+    and rewards are computed as array operations over all N envs.
+    With physics_backend="numpy" all N matches share one NumpyPhysics and step together,
+    touches, body states and goals are read from its arrays without going through the envs.
+    Finished envs are reset in the same step, their last observation is in info["final_obs"]
+    and the team that scored their final goal (-1 if none) in info["goal_scored"].
+    With episode_statistics, info["episode"] holds the returns of finished episodes, see
+    Soccer.get_episode_statistics.
+    With deterministic=True the envs run in Soccer's deterministic mode and env i is seeded
+    with derive_seed(seed, first_env_index + i), both at construction and by reset(seed=int),
+    so its trajectory does not depend on the other envs or on how they are split over workers.
+    action_repeat and physics_substeps work like in Soccer, an env that finishes its episode
+    during a repeated step stops there while the others play on. physics_profile selects the
+    Box2D solver settings of all envs, see PHYSICS_PROFILES.
+    With trajectory_dir, every env records its resets and frames like Soccer(trajectory_dir=...),
+    each into its own files in trajectory_dir.
+    """
+    metadata = {"autoreset_mode": AutoresetMode.SAME_STEP, "render_modes": ["rgb_array_headless"]}
+
+    def __init__(self, num_envs, reward_specification=DEFAULT_REWARD_SPECIFICATION, env_id="Soccer-v0", seed=1, copy=True,
+                 physics_backend="box2d", episode_statistics=True, render_mode=None, render_scale=1.0, history_length=3,
+                 team_size=2, deterministic=False, first_env_index=0, action_repeat=1, physics_substeps=1,
+                 physics_profile="default", trajectory_dir=None):
+        self.num_envs = num_envs
+        self.reward_specification = reward_specification
+        self.copy = copy
+        self.physics_backend = physics_backend
+        self.episode_statistics = episode_statistics
+        self.render_mode = render_mode
+        self.deterministic = deterministic
+        self.first_env_index = first_env_index # global index of the first env, for derived seeds
+        self.action_repeat = action_repeat
+        self.physics_substeps = physics_substeps
+        self.record_trajectories = trajectory_dir is not None
+        self.physics = None
+        if physics_backend == "numpy":
+            self.physics = NumpyPhysics(num_envs, 2 * team_size)
+        self.envs = [
+            Soccer(env_id=env_id, seed=derive_seed(seed, first_env_index + i) if deterministic else seed,
+                   reward_specification=reward_specification, physics_backend=physics_backend,
+                   numpy_physics=self.physics, numpy_physics_index=i, episode_statistics=False,
+                   history_length=history_length, team_size=team_size, deterministic=deterministic,
+                   action_repeat=action_repeat, physics_substeps=physics_substeps, physics_profile=physics_profile,
+                   trajectory_dir=trajectory_dir)
+            for i in range(num_envs)
+        ]
+
+        env = self.envs[0]
+        self.num_agents = env.num_agents
+        self.team_size = env.team_size
+        self.num_teams = env.num_teams
+        self.single_observation_space = env.observation_space
+        self.single_action_space = env.action_space
+        self.observation_space = batch_space(self.single_observation_space, num_envs)
+        self.action_space = batch_space(self.single_action_space, num_envs)
+        self.observation_tables = env.observation_tables
+
+        # Preallocated buffers shared by all steps
+        self.body_states = np.zeros((num_envs, self.num_agents + 1, 4))
+        self.observations = np.zeros((num_envs, self.num_agents, self.observation_tables.observation_size), dtype=np.float32)
+        self.rewards = np.zeros((num_envs, self.num_agents))
+        self.active = np.ones(num_envs, dtype=bool) # envs still playing the current step
+        self.terminated = np.zeros(num_envs, dtype=bool)
+        self.truncated = np.zeros(num_envs, dtype=bool)
+        # Outcome of the last frame and episode length of every env
+        self.goal_scored = np.full(num_envs, -1, dtype=np.int64)
+        self.ball_toucher = np.full(num_envs, NO_TOUCHER, dtype=np.int64)
+        self.step_counts = np.zeros(num_envs, dtype=np.int64)
+        self.max_steps = env.max_steps
+        self.reward_state = RewardState(num_envs, self.num_agents, self.team_size, history_length)
+        self.reward_pipeline = RewardPipeline(reward_specification, num_envs, self.num_teams)
+        if render_mode == "rgb_array_headless":
+            self.renderer = ArrayRenderer(render_scale, self.num_agents, self.team_size)
+            self.frames = np.zeros((num_envs, self.renderer.height, self.renderer.width, 3), dtype=np.uint8)
+        # Running per-term, per-team sums of the current episode of every env
+        self.episode_reward_terms = np.zeros_like(self.reward_pipeline.term_rewards)
+
+    def reset(self, seed=None, options=None):
+        """Reset all envs, seeding env i with seed + i if seed is an int, or a derived seed in deterministic mode"""
+        if seed is None or isinstance(seed, int):
+            seeds = [None if seed is None else self.get_env_seed(seed, i) for i in range(self.num_envs)]
+        else:
+            seeds = list(seed)
+            assert len(seeds) == self.num_envs, f"Expected {self.num_envs} seeds, got {len(seeds)}"
+        for i, env in enumerate(self.envs):
+            env.reset(seed=seeds[i], options=options)
+            env.get_body_states(out=self.body_states[i])
+        self.reward_state.reset_envs(slice(None))
+        self.step_counts[:] = 0
+        self.episode_reward_terms[:] = 0.0
+        self.observation_tables.compute(self.body_states, out=self.observations)
+        return self._output(self.observations), {}
+
+    def get_env_seed(self, seed, index):
+        if self.deterministic:
+            return derive_seed(seed, self.first_env_index + index)
+        return seed + index
+
+    def step(self, actions):
+        actions = np.asarray(actions).reshape(self.num_envs, self.num_agents)
+        self.rewards[:] = 0.0
+        self.terminated[:] = False
+        self.truncated[:] = False
+        self.active[:] = True
+        for _ in range(self.action_repeat):
+            self.step_frame(actions)
+            self.active &= ~(self.terminated | self.truncated)
+            if not self.active.any():
+                break
+        self.observation_tables.compute(self.body_states, out=self.observations)
+
+        infos = {}
+        done = self.terminated | self.truncated
+        if done.any():
+            infos["final_obs"] = np.array([self.observations[i].copy() if done[i] else None for i in range(self.num_envs)], dtype=object)
+            infos["_final_obs"] = done.copy()
+            # Team that scored the final goal, -1 for truncated episodes
+            infos["goal_scored"] = np.where(done, self.reward_state.goal_scored, -1)
+            infos["_goal_scored"] = done.copy()
+            if self.episode_statistics:
+                infos["episode"] = self.get_episode_statistics(done)
+                infos["_episode"] = done.copy()
+            for i in np.flatnonzero(done):
+                self.envs[i].reset()
+                self.envs[i].get_body_states(out=self.body_states[i])
+            self.reward_state.reset_envs(done)
+            self.step_counts[done] = 0
+            self.observations[done] = self.observation_tables.compute(self.body_states[done])
+
+        return (
+            self._output(self.observations),
+            self._output(self.rewards),
+            self._output(self.terminated),
+            self._output(self.truncated),
+            infos,
+        )
+
+    def step_frame(self, actions):
+        """Advance the active envs by one frame and add their rewards to self.rewards"""
+        active = np.flatnonzero(self.active)
+        if self.physics is not None:
+            self.step_numpy_physics(actions, active)
+        else:
+            # Only the outcome of every env is gathered per env, the reward state is updated in one pass
+            for i in active:
+                env = self.envs[i]
+                self.goal_scored[i] = env.simulate(actions[i])
+                # simulate gathered the body states of the env
+                self.body_states[i] = env.body_states
+                self.ball_toucher[i] = NO_TOUCHER if env.ball_toucher is None else env.ball_toucher
+        self.step_counts[active] += 1
+
+        body_states = self.body_states[active]
+        local_positions = body_states[:, :-1, :2] * self.observation_tables.sign[:, 0, :2]
+        local_positions += self.observation_tables.offset[:, 0]
+        goal_scored = self.goal_scored[active]
+        self.reward_state.step_envs(active, goal_scored, self.ball_toucher[active], body_states, local_positions)
+        self.terminated[active] = goal_scored >= 0
+        self.truncated[active] = self.step_counts[active] >= self.max_steps
+
+        team_rewards = self.reward_pipeline.calculate(self.reward_state)
+        self.rewards[active] += np.repeat(team_rewards[active], self.team_size, axis=1)
+        if self.episode_statistics:
+            self.episode_reward_terms[:, active] += self.reward_pipeline.term_rewards[:, active]
+        if self.record_trajectories:
+            self.record_frame(actions, active, team_rewards)
+
+    def record_frame(self, actions, active, team_rewards):
+        """Append the last frame of the active envs to their trajectory files, like Soccer.step"""
+        frame_rewards = np.repeat(team_rewards, self.team_size, axis=1)
+        for i in active:
+            self.envs[i].trajectory_writer.add_step(self.step_counts[i], self.body_states[i], actions[i], frame_rewards[i],
+                                                    self.ball_toucher[i], self.goal_scored[i], self.terminated[i], self.truncated[i])
+
+    def step_numpy_physics(self, actions, active):
+        """Step the shared NumPy physics and gather the touches, body states and goals of the active envs
+
+        Works on the physics arrays of all envs at once, the Soccer envs are only used to reset.
+        """
+        physics = self.physics
+        physics.player_velocity[:] = self.envs[0].get_action_velocities(actions)
+        # The shared physics steps every env, finished ones are reset before they are observed again
+        self.ball_toucher[:] = NO_TOUCHER
+        dt = 1.0 / (FPS * self.physics_substeps)
+        for _ in range(self.physics_substeps):
+            physics.step(dt)
+            touched = physics.began_contacts.any(axis=1)
+            if touched.any():
+                # Like consecutive BeginContact calls, the last player wins
+                began = physics.began_contacts[touched]
+                self.ball_toucher[touched] = self.num_agents - 1 - np.argmax(began[:, ::-1], axis=1)
+        self.body_states[active, :-1, :2] = physics.player_position[active]
+        self.body_states[active, :-1, 2:] = physics.player_velocity[active]
+        self.body_states[active, -1, :2] = physics.ball_position[active]
+        self.body_states[active, -1, 2:] = physics.ball_velocity[active]
+        ball_y = physics.ball_position[active, 1]
+        # Like Soccer.check_goal, team 1 scores in the bottom goal and team 0 in the top goal
+        self.goal_scored[active] = np.where(ball_y < 0, 1, np.where(ball_y > GAME_HEIGHT, 0, -1))
+
+    def get_episode_statistics(self, done):
+        """Returns (N, num_teams), lengths (N,) and per-term returns of the envs in done, zero elsewhere"""
+        episode_reward_terms = np.where(done[None, :, None], self.episode_reward_terms, 0.0)
+        self.episode_reward_terms[:, done] = 0.0
+        return {
+            "r": episode_reward_terms.sum(axis=0),
+            "l": np.where(done, self.step_counts, 0),
+            "reward_terms": {name: episode_reward_terms[k] for k, name in enumerate(self.reward_pipeline.names)},
+        }
+
+    def render(self):
+        """Render all envs at once into frames of shape (N, H, W, 3)"""
+        if self.render_mode != "rgb_array_headless":
+            return None
+        self.renderer.render_batch(self.body_states, out=self.frames)
+        return self._output(self.frames)
+
+    def _output(self, array):
+        return array.copy() if self.copy else array
+
+    def close_extras(self, **kwargs):
+        for env in self.envs:
+            env.close()
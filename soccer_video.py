@@ -0,0 +1,103 @@
+# Streaming video recorder for the Soccer Environment
+#
+# Frames are handed to a background thread through a bounded queue and encoded to disk
+# as they arrive, so a clip is never held in memory as a whole. Adding a frame never
+# blocks the training loop: when the encoder falls behind and the queue is full, the
+# frame is dropped, counted in dropped_frames and reported by a warning when the clip is
+# finished. Finishing a clip does not wait for the encoder either, it only signals the
+# thread. There is one encoder thread at a time: starting the next clip waits for the
+# previous one, at most the frames left in its queue, and close waits for the last.
+
+import queue
+import threading
+import warnings
+
+from ppo.environments.soccer import FPS
+
+
+class VideoRecorder:
+    def __init__(self, fps=FPS, queue_size=64):
+        self.fps = fps
+        self.queue_size = queue_size
+        self.frame_queue = None
+        self.stop_event = None # set by finish, the writer then stops once the queue is empty
+        self.thread = None
+        self.filename = None
+        self.dropped_frames = 0 # over all clips
+        self.clip_dropped_frames = 0
+
+    @property
+    def recording(self):
+        return self.frame_queue is not None
+
+    def start(self, filename):
+        """Start encoding a new clip to filename, finishing the current one and waiting for its encoder first"""
+        self.finish()
+        self.join()
+        try:
+            import imageio  # noqa: F401
+        except ImportError:
+            print("Could not save video: imageio not installed")
+            return False
+        self.frame_queue = queue.Queue(maxsize=self.queue_size)
+        self.stop_event = threading.Event()
+        self.filename = filename
+        self.clip_dropped_frames = 0
+        self.thread = threading.Thread(target=self.write_frames, args=(filename, self.frame_queue, self.stop_event), daemon=True)
+        self.thread.start()
+        return True
+
+    def add_frame(self, frame):
+        """Queue an (H, W, 3) uint8 frame, the recorder keeps a reference so it must not be reused"""
+        if self.frame_queue is None:
+            return
+        try:
+            self.frame_queue.put_nowait(frame)
+        except queue.Full:
+            self.dropped_frames += 1
+            self.clip_dropped_frames += 1
+
+    def finish(self):
+        """End the current clip without blocking, the background thread writes the remaining frames and closes the file"""
+        if self.frame_queue is None:
+            return
+        self.stop_event.set()
+        try:
+            # Wakes the writer right away, with a full queue it sees the event once the queue is drained
+            self.frame_queue.put_nowait(None)
+        except queue.Full:
+            pass
+        if self.clip_dropped_frames:
+            warnings.warn(f"Dropped {self.clip_dropped_frames} frames of {self.filename}, the video encoder fell behind")
+        self.frame_queue = None
+        self.stop_event = None
+
+    def join(self):
+        """Wait until the encoder thread has written the last clip"""
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def close(self):
+        """Finish the current clip and wait until it is written"""
+        self.finish()
+        self.join()
+
+    def write_frames(self, filename, frame_queue, stop_event, poll_interval=0.1):
+        import imageio
+        try:
+            with imageio.get_writer(filename, fps=self.fps) as writer:
+                while True:
+                    try:
+                        frame = frame_queue.get(timeout=poll_interval)
+                    except queue.Empty:
+                        if stop_event.is_set():
+                            break
+                        continue
+                    if frame is None:
+                        break
+                    writer.append_data(frame)
+            print(f"Recording saved as {filename}")
+        except Exception as error:
+            # add_frame and finish never wait, so a dead writer cannot stall the env
+            print(f"Could not save video {filename}: {error}")